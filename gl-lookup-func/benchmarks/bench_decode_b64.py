@@ -0,0 +1,89 @@
+"""
+Micro-benchmark for receipt attachment decoding (_decode_b64 / _coerce_bytes).
+
+Encodes every sample receipt in ../Reciepts the ways clients actually send them (clean base64,
+MIME line-wrapped, URL-safe without padding, data: URL, JSON int array) and times the current
+decoder against the previous implementation.
+
+Run from gl-lookup-func with the function app requirements installed:
+    python benchmarks/bench_decode_b64.py
+"""
+import base64
+import json
+import sys
+import timeit
+import tracemalloc
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+import function_app  # noqa: E402
+
+SAMPLES_DIR = Path(__file__).resolve().parents[2] / "Reciepts"
+
+
+def _legacy_decode_b64(data_b64: str) -> bytes:
+    raw = (data_b64 or "").strip()
+    if len(raw) >= 2 and raw[0] in {"'", '"'} and raw[-1] == raw[0]:
+        raw = raw[1:-1].strip()
+    if raw.startswith("data:") and "," in raw:
+        raw = raw.split(",", 1)[1]
+    raw = "".join(raw.split())
+    raw = raw.replace("-", "+").replace("_", "/")
+    missing = len(raw) % 4
+    if missing:
+        raw += "=" * (4 - missing)
+    return base64.b64decode(raw, validate=True)
+
+
+def _legacy_coerce_bytes(value) -> bytes:
+    if isinstance(value, str):
+        raw = value.strip()
+        if raw.startswith("[") and raw.endswith("]"):
+            parsed = json.loads(raw)
+            if isinstance(parsed, list) and all(isinstance(x, int) for x in parsed):
+                return bytes(parsed)
+        return _legacy_decode_b64(raw)
+    raise TypeError(type(value))
+
+
+def _variants(data: bytes) -> dict:
+    clean = base64.b64encode(data).decode("ascii")
+    return {
+        "clean": clean,
+        "mime-wrapped": base64.encodebytes(data).decode("ascii"),
+        "urlsafe-nopad": base64.urlsafe_b64encode(data).decode("ascii").rstrip("="),
+        "data-url": "data:application/octet-stream;base64," + clean,
+        "int-array": json.dumps(list(data)),
+    }
+
+
+def _measure(fn, value, expected: bytes, number: int) -> tuple[float, int]:
+    assert fn(value) == expected
+    seconds = min(timeit.repeat(lambda: fn(value), number=number, repeat=3)) / number
+    tracemalloc.start()
+    fn(value)
+    _current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return seconds, peak
+
+
+def main() -> None:
+    files = sorted(p for p in SAMPLES_DIR.iterdir() if p.is_file())
+    if not files:
+        raise SystemExit(f"No sample receipts found in {SAMPLES_DIR}")
+    print(f"{'file':<16}{'variant':<16}{'legacy ms':>11}{'new ms':>9}{'legacy peak KB':>16}{'new peak KB':>13}")
+    for path in files:
+        data = path.read_bytes()
+        for name, value in _variants(data).items():
+            number = 3 if name == "int-array" else 20
+            old_s, old_peak = _measure(_legacy_coerce_bytes, value, data, number)
+            new_s, new_peak = _measure(function_app._coerce_bytes, value, data, number)
+            print(
+                f"{path.name:<16}{name:<16}{old_s * 1000:>11.2f}{new_s * 1000:>9.2f}"
+                f"{old_peak // 1024:>16}{new_peak // 1024:>13}"
+            )
+
+
+if __name__ == "__main__":
+    main()
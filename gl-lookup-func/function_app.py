@@ -1,23 +1,39 @@
 import azure.functions as func
 import csv
+import hashlib
 import json
 from pathlib import Path
 from io import StringIO
 import base64
 import os
 import logging
+import mimetypes
 from typing import Optional
 import binascii
+import contextlib
 from io import BytesIO
 import zipfile
+import zlib
 from datetime import date, datetime, timedelta, timezone
 import re
+import random
+import shutil
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from email.message import Message
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlsplit
 from pypdf import PdfReader, PdfWriter
-from PIL import Image
+from PIL import Image, ImageDraw, ImageFilter, ImageOps, features as pil_features
 
 import requests
+from requests.adapters import HTTPAdapter
+from azure.core import MatchConditions
+from azure.core.exceptions import HttpResponseError, ResourceExistsError, ResourceModifiedError, ResourceNotFoundError
 from azure.identity import DefaultAzureCredential
-from azure.storage.blob import BlobServiceClient, ContentSettings
+from azure.storage.blob import BlobSasPermissions, BlobServiceClient, ContentSettings, generate_blob_sas
 from azure.ai.documentintelligence import DocumentIntelligenceClient
 from azure.ai.documentintelligence.models import AnalyzeDocumentRequest
 
@@ -276,6 +292,178 @@ def _map_department_name_to_code(department_name: str):
     return "", "", "none", candidates
 
 
+def _env_int(name: str, default: int) -> int:
+    try:
+        return int((os.getenv(name) or "").strip() or default)
+    except ValueError:
+        return default
+
+
+# Outbound HTTP: one pooled requests.Session per scheme+host so repeated calls to GSA, Graph,
+# Search, Foundry, etc. reuse TCP+TLS connections instead of handshaking on every request.
+_HTTP_SESSIONS: dict[str, requests.Session] = {}
+_HTTP_STATS: dict[str, dict] = {}
+_HTTP_LOCK = threading.Lock()
+_HTTP_MAX_SESSIONS = 32
+_HTTP_RETRY_STATUSES = frozenset({429, 500, 502, 503, 504})
+# Non-idempotent calls (sendMail, etc.) only retry when the service says the request was not accepted.
+_HTTP_RETRY_STATUSES_UNSAFE = frozenset({429, 503})
+_HTTP_IDEMPOTENT_METHODS = frozenset({"GET", "HEAD", "PUT", "DELETE", "OPTIONS"})
+
+
+def _worker_thread_count() -> int:
+    """
+    Azure Functions runs sync handlers on a thread pool sized by PYTHON_THREADPOOL_THREAD_COUNT
+    (default min(32, cpu+4)). Connection pools are sized to match so concurrent invocations
+    don't wait on each other for a connection.
+    """
+    return max(1, _env_int("PYTHON_THREADPOOL_THREAD_COUNT", min(32, (os.cpu_count() or 1) + 4)))
+
+
+def _http_host_key(url: str) -> str:
+    parts = urlsplit(url)
+    return f"{parts.scheme}://{parts.netloc}".lower()
+
+
+def _http_session(url: str) -> requests.Session:
+    key = _http_host_key(url)
+    with _HTTP_LOCK:
+        session = _HTTP_SESSIONS.pop(key, None)
+        if session is not None:
+            _HTTP_SESSIONS[key] = session  # most recently used goes last
+            return session
+        # imageUrl can point anywhere; don't let arbitrary hosts grow the session table without bound.
+        # The evicted session is only dropped, not closed: another thread may still be mid-request
+        # on it, and its pooled connections are released when the last reference goes away.
+        if len(_HTTP_SESSIONS) >= _HTTP_MAX_SESSIONS:
+            _HTTP_SESSIONS.pop(next(iter(_HTTP_SESSIONS)))
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=_worker_thread_count(), max_retries=0)
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        _HTTP_SESSIONS[key] = session
+        return session
+
+
+def _record_http_stat(host: str, elapsed_s: float, status: Optional[int], retried: bool) -> None:
+    with _HTTP_LOCK:
+        st = _HTTP_STATS.get(host)
+        if st is None:
+            st = {"count": 0, "errors": 0, "retries": 0, "totalMs": 0.0, "maxMs": 0.0, "lastStatus": None}
+            _HTTP_STATS[host] = st
+        ms = elapsed_s * 1000.0
+        st["count"] += 1
+        st["totalMs"] += ms
+        st["maxMs"] = max(st["maxMs"], ms)
+        st["lastStatus"] = status
+        if status is None or status >= 400:
+            st["errors"] += 1
+        if retried:
+            st["retries"] += 1
+
+
+def _http_stats_snapshot() -> dict:
+    """Per-host outbound latency counters since process start (used by /api/health?stats=1)."""
+    with _HTTP_LOCK:
+        out = {}
+        for host, st in _HTTP_STATS.items():
+            row = dict(st)
+            row["avgMs"] = round(st["totalMs"] / st["count"], 1) if st["count"] else 0.0
+            row["totalMs"] = round(st["totalMs"], 1)
+            row["maxMs"] = round(st["maxMs"], 1)
+            out[host] = row
+        return out
+
+
+def _retry_after_seconds(resp: requests.Response) -> Optional[float]:
+    raw = (resp.headers.get("Retry-After") or "").strip()
+    if not raw:
+        return None
+    try:
+        return max(0.0, float(raw))
+    except ValueError:
+        pass
+    try:
+        when = parsedate_to_datetime(raw)
+        if when.tzinfo is None:
+            when = when.replace(tzinfo=timezone.utc)
+        return max(0.0, (when - datetime.now(timezone.utc)).total_seconds())
+    except Exception:
+        return None
+
+
+def _backoff_seconds(attempt: int) -> float:
+    # "Full jitter" exponential backoff: spreads retries from concurrent invocations apart.
+    base = 0.5 * (2 ** attempt)
+    return random.uniform(0, min(base, float(_env_int("HTTP_RETRY_MAX_WAIT_SECONDS", 30))))
+
+
+def _http_request(
+    method: str,
+    url: str,
+    *,
+    headers: Optional[dict] = None,
+    params: Optional[dict] = None,
+    json_body=None,
+    data=None,
+    timeout_s: float = 30,
+    retries: Optional[int] = None,
+    retry_statuses: Optional[frozenset] = None,
+    stream: bool = False,
+) -> requests.Response:
+    """
+    Single entry point for outbound HTTP calls.
+
+    Uses the pooled per-host session, applies a timeout, and retries throttling/server errors with
+    jittered backoff (honoring Retry-After). GET/PUT/DELETE retry on 429/5xx and connection errors;
+    other methods only retry 429/503 and failed connects, so a slow sendMail is never sent twice.
+    Returns the final response (callers keep their own status handling) or raises the last
+    requests exception once retries are exhausted.
+    """
+    method = method.upper()
+    idempotent = method in _HTTP_IDEMPOTENT_METHODS
+    if retries is None:
+        retries = max(0, _env_int("HTTP_MAX_RETRIES", 3))
+    if retry_statuses is None:
+        retry_statuses = _HTTP_RETRY_STATUSES if idempotent else _HTTP_RETRY_STATUSES_UNSAFE
+    retry_exceptions = (requests.ConnectionError, requests.Timeout) if idempotent else (requests.ConnectTimeout,)
+    max_wait = float(_env_int("HTTP_RETRY_MAX_WAIT_SECONDS", 30))
+
+    host = urlsplit(url).netloc.lower()
+    session = _http_session(url)
+    attempt = 0
+    while True:
+        started = time.perf_counter()
+        try:
+            resp = session.request(
+                method,
+                url,
+                headers=headers,
+                params=params,
+                json=json_body,
+                data=data,
+                timeout=timeout_s,
+                stream=stream,
+            )
+        except requests.RequestException as e:
+            _record_http_stat(host, time.perf_counter() - started, None, attempt > 0)
+            if attempt >= retries or not isinstance(e, retry_exceptions):
+                raise
+            delay = _backoff_seconds(attempt)
+            logging.info("HTTP %s %s failed (%s); retry %s in %.2fs", method, host, e, attempt + 1, delay)
+        else:
+            _record_http_stat(host, time.perf_counter() - started, resp.status_code, attempt > 0)
+            if resp.status_code not in retry_statuses or attempt >= retries:
+                return resp
+            delay = _retry_after_seconds(resp)
+            if delay is None:
+                delay = _backoff_seconds(attempt)
+            logging.info("HTTP %s %s returned %s; retry %s in %.2fs", method, host, resp.status_code, attempt + 1, delay)
+            resp.close()
+        time.sleep(min(delay, max_wait))
+        attempt += 1
+
+
 def _orgchart_search_by_email(email: str, debug: bool = False) -> tuple[Optional[dict], Optional[str], list]:
     endpoint = (os.getenv("ORGCHART_SEARCH_ENDPOINT") or "").strip().rstrip("/")
     index_name = (os.getenv("ORGCHART_SEARCH_INDEX") or "").strip()
@@ -339,7 +527,7 @@ def _orgchart_search_by_email(email: str, debug: bool = False) -> tuple[Optional
     # plain search and enforce strict matching in code.
     filter_body = {"search": "*", "filter": f"tolower({email_field}) eq '{email_l}'", "top": 5}
     try:
-        resp = requests.post(url, headers=headers, json=filter_body, timeout=15)
+        resp = _http_request("POST", url, headers=headers, json_body=filter_body, timeout_s=15, retry_statuses=_HTTP_RETRY_STATUSES)
     except Exception as e:
         return None, f"OrgChart search request failed: {e}", attempts
 
@@ -383,7 +571,7 @@ def _orgchart_search_by_email(email: str, debug: bool = False) -> tuple[Optional
             "searchFields": search_fields,
         }
         try:
-            r = requests.post(url, headers=headers, json=body, timeout=15)
+            r = _http_request("POST", url, headers=headers, json_body=body, timeout_s=15, retry_statuses=_HTTP_RETRY_STATUSES)
         except Exception as e:
             return None, f"OrgChart search request failed: {e}", []
 
@@ -391,7 +579,7 @@ def _orgchart_search_by_email(email: str, debug: bool = False) -> tuple[Optional
             # If the index rejects searchFields (fields not searchable/unknown), retry without it.
             body.pop("searchFields", None)
             try:
-                r = requests.post(url, headers=headers, json=body, timeout=15)
+                r = _http_request("POST", url, headers=headers, json_body=body, timeout_s=15, retry_statuses=_HTTP_RETRY_STATUSES)
             except Exception as e:
                 return None, f"OrgChart search request failed: {e}", []
 
@@ -474,7 +662,7 @@ def _zip_to_place(zip_code: str) -> tuple[Optional[str], Optional[str], Optional
     base = (os.getenv("ZIP_GEOCODE_BASE_URL") or "https://api.zippopotam.us/us").strip().rstrip("/")
     url = f"{base}/{zip_code}"
     try:
-        resp = requests.get(url, timeout=10)
+        resp = _http_request("GET", url, timeout_s=10)
     except Exception as e:
         return None, None, f"ZIP geocode request failed: {e}"
 
@@ -779,7 +967,7 @@ def _gsa_per_diem_city_state_lookup(city: str, state: str, travel_date: Optional
 
     attempts = []
     try:
-        resp = requests.get(city_url, headers=headers, params=params, timeout=15)
+        resp = _http_request("GET", city_url, headers=headers, params=params, timeout_s=15)
     except Exception as e:
         return None, f"GSA per diem request failed: {e}"
 
@@ -816,7 +1004,7 @@ def _gsa_per_diem_lookup(zip_code: str, travel_date: Optional[date], debug: bool
 
     def _try(url: str):
         try:
-            resp = requests.get(url, headers=headers, params=params, timeout=15)
+            resp = _http_request("GET", url, headers=headers, params=params, timeout_s=15)
         except Exception as e:
             return None, None, f"GSA per diem request failed: {e}"
 
@@ -1147,7 +1335,11 @@ def per_diem_lookup(req: func.HttpRequest) -> func.HttpResponse:
 
 @app.route(route="health", methods=["GET"], auth_level=func.AuthLevel.FUNCTION)
 def health(req: func.HttpRequest) -> func.HttpResponse:
-    return func.HttpResponse(json.dumps({"ok": True}), mimetype="application/json")
+    payload = {"ok": True}
+    if str(req.params.get("stats") or "").strip().lower() in ("1", "true", "yes"):
+        # Per-host outbound latency counters for this worker process.
+        payload["http"] = _http_stats_snapshot()
+    return func.HttpResponse(json.dumps(payload), mimetype="application/json")
 
 
 @app.route(route="expense-codes", methods=["GET"], auth_level=func.AuthLevel.FUNCTION)
@@ -1404,6 +1596,70 @@ def import_csv(req: func.HttpRequest) -> func.HttpResponse:
     return func.HttpResponse(output.getvalue(), mimetype="text/csv")
 
 
+# Graph accepts base64 "contentBytes" attachments only up to ~3 MB per request; larger files go
+# through a draft + upload session, which allows up to 150 MB per attachment.
+_GRAPH_INLINE_ATTACHMENT_LIMIT = 3 * 1024 * 1024
+_GRAPH_UPLOAD_SESSION_MAX_BYTES = 150 * 1024 * 1024
+# Upload-session chunks must be under 4 MB and a multiple of 320 KiB.
+_GRAPH_UPLOAD_CHUNK_BYTES = 12 * 320 * 1024
+
+
+def _file_attachment(name: str, content_type: str, content) -> dict:
+    """
+    Graph fileAttachment with the raw content kept under "_content" (bytes or a readable file object).
+    _graph_send_mail decides whether to inline it as base64 or stream it through an upload session.
+    """
+    return {
+        "@odata.type": "#microsoft.graph.fileAttachment",
+        "name": name,
+        "contentType": content_type,
+        "_content": content,
+    }
+
+
+def _attachment_size(att: dict) -> int:
+    content = att.get("_content")
+    if content is None:
+        # Pre-encoded attachment (contentBytes already base64).
+        return len(att.get("contentBytes") or "") * 3 // 4
+    if isinstance(content, (bytes, bytearray, memoryview)):
+        return len(content)
+    pos = content.tell()
+    content.seek(0, os.SEEK_END)
+    size = content.tell()
+    content.seek(pos)
+    return size
+
+
+def _iter_attachment_chunks(att: dict, chunk_size: int):
+    content = att.get("_content")
+    if content is None:
+        content = base64.b64decode(att.get("contentBytes") or "")
+    if isinstance(content, (bytes, bytearray, memoryview)):
+        view = memoryview(content)
+        for i in range(0, len(view), chunk_size):
+            yield bytes(view[i : i + chunk_size])
+        return
+    content.seek(0)
+    while True:
+        chunk = content.read(chunk_size)
+        if not chunk:
+            return
+        yield chunk
+
+
+def _attachment_bytes(att: dict) -> bytes:
+    return b"".join(_iter_attachment_chunks(att, 1024 * 1024))
+
+
+def _inline_attachment(att: dict) -> dict:
+    if att.get("_content") is None:
+        return att
+    out = {k: v for k, v in att.items() if k != "_content"}
+    out["contentBytes"] = base64.b64encode(_attachment_bytes(att)).decode("ascii")
+    return out
+
+
 def _graph_send_mail(
     *,
     from_user: str,
@@ -1444,18 +1700,8 @@ def _graph_send_mail(
         except (ValueError, binascii.Error, UnicodeDecodeError) as e:
             logging.warning("Failed to decode Graph token claims: %s", e)
 
-    url = f"https://graph.microsoft.com/v1.0/users/{from_user}/sendMail"
-    csv_b64 = base64.b64encode(csv_text.encode("utf-8")).decode("ascii")
-    attachments = [
-        {
-            "@odata.type": "#microsoft.graph.fileAttachment",
-            "name": csv_filename,
-            "contentType": "text/csv",
-            "contentBytes": csv_b64,
-        }
-    ]
-    if additional_attachments:
-        attachments.extend(additional_attachments)
+    csv_attachment = _file_attachment(csv_filename, "text/csv", csv_text.encode("utf-8"))
+    attachments = [csv_attachment] + list(additional_attachments or [])
 
     body_content_type = "Text"
     body_content = body_text
@@ -1463,25 +1709,33 @@ def _graph_send_mail(
         body_content_type = "HTML"
         body_content = body_html
 
-    payload = {
-        "message": {
-            "subject": subject,
-            "body": {"contentType": body_content_type, "content": body_content},
-            "toRecipients": [{"emailAddress": {"address": to_email}}],
-            "attachments": attachments,
-        },
-        "saveToSentItems": "true",
+    message = {
+        "subject": subject,
+        "body": {"contentType": body_content_type, "content": body_content},
+        "toRecipients": [{"emailAddress": {"address": to_email}}],
     }
 
     cc_emails = [e.strip() for e in (cc_emails or []) if (e or "").strip()]
     if len(cc_emails) > 0:
-        payload["message"]["ccRecipients"] = [{"emailAddress": {"address": e}} for e in cc_emails]
+        message["ccRecipients"] = [{"emailAddress": {"address": e}} for e in cc_emails]
+
+    sizes = [_attachment_size(a) for a in attachments]
+    too_big = [a.get("name") for a, n in zip(attachments, sizes) if n > _GRAPH_UPLOAD_SESSION_MAX_BYTES]
+    if too_big:
+        return f"Attachment(s) exceed Graph's {_GRAPH_UPLOAD_SESSION_MAX_BYTES} byte limit: {', '.join(too_big)}"
+    if sum(sizes) > _env_int("GRAPH_INLINE_ATTACHMENT_BYTES", _GRAPH_INLINE_ATTACHMENT_LIMIT):
+        return _graph_send_mail_via_draft(token=token, from_user=from_user, message=message, attachments=attachments, sizes=sizes)
+
+    url = f"https://graph.microsoft.com/v1.0/users/{from_user}/sendMail"
+    message["attachments"] = [_inline_attachment(a) for a in attachments]
+    payload = {"message": message, "saveToSentItems": "true"}
 
-    resp = requests.post(
+    resp = _http_request(
+        "POST",
         url,
         headers={"Authorization": f"Bearer {token}", "Content-Type": "application/json"},
         data=json.dumps(payload),
-        timeout=30,
+        timeout_s=30,
     )
     logging.info("Graph sendMail request complete: status=%s", resp.status_code)
     if resp.status_code not in (202, 200):
@@ -1490,6 +1744,161 @@ def _graph_send_mail(
     return None
 
 
+def _graph_send_mail_via_draft(*, token: str, from_user: str, message: dict, attachments: list[dict], sizes: list[int]) -> Optional[str]:
+    """
+    Large-attachment send path: create a draft, stream big attachments into it through
+    attachments/createUploadSession in fixed-size chunks, then send the draft.
+
+    Small attachments (e.g. the CSV) ride along inline on the draft. Only one chunk of a large
+    attachment is in memory at a time, and nothing is ever base64 encoded.
+    """
+    base = f"https://graph.microsoft.com/v1.0/users/{from_user}"
+    auth = {"Authorization": f"Bearer {token}"}
+    inline_budget = _env_int("GRAPH_INLINE_ATTACHMENT_BYTES", _GRAPH_INLINE_ATTACHMENT_LIMIT)
+    inline: list[dict] = []
+    streamed: list[tuple[dict, int]] = []
+    for att, size in zip(attachments, sizes):
+        if size <= inline_budget:
+            inline_budget -= size
+            inline.append(_inline_attachment(att))
+        else:
+            streamed.append((att, size))
+
+    draft = dict(message)
+    if inline:
+        draft["attachments"] = inline
+    message_id, err = _graph_create_tagged_draft(base=base, auth=auth, draft=draft)
+    if err:
+        return err
+
+    msg_url = f"{base}/messages/{message_id}"
+    try:
+        for att, size in streamed:
+            _graph_upload_attachment(auth=auth, message_url=msg_url, att=att, size=size)
+        resp = _http_request("POST", f"{msg_url}/send", headers=auth, timeout_s=30)
+        logging.info("Graph draft send complete: status=%s streamed=%s", resp.status_code, len(streamed))
+        if resp.status_code not in (200, 202):
+            raise RuntimeError(f"send failed: {resp.status_code} {(resp.text or '')[:500]}")
+    except Exception as e:
+        # Don't leave half-built drafts in the sender's mailbox.
+        try:
+            _http_request("DELETE", msg_url, headers=auth, timeout_s=30)
+        except Exception as del_err:
+            logging.warning("Failed to delete Graph draft %s: %s", message_id, del_err)
+        logging.warning("Graph sendMail (upload session) failed: %s", e)
+        return f"Graph sendMail (upload session) failed: {e}"
+    return None
+
+
+# Named MAPI property used to tag drafts so a create whose response was lost can be found again.
+_GRAPH_DRAFT_TAG_PROPERTY = "String {8b0d6f3e-5a41-4f2c-9c77-2e1d4a9b6c05} Name TravelExpenseDraftTag"
+
+
+def _graph_find_tagged_draft(*, base: str, auth: dict, tag: str) -> Optional[str]:
+    flt = (
+        f"singleValueExtendedProperties/any(ep: ep/id eq '{_GRAPH_DRAFT_TAG_PROPERTY}' and ep/value eq '{tag}')"
+    )
+    resp = _http_request(
+        "GET",
+        f"{base}/mailFolders/drafts/messages",
+        headers=auth,
+        params={"$filter": flt, "$select": "id", "$top": "1"},
+        timeout_s=30,
+    )
+    if resp.status_code != 200:
+        return None
+    found = (resp.json() or {}).get("value") or []
+    return found[0].get("id") if found else None
+
+
+def _graph_create_tagged_draft(*, base: str, auth: dict, draft: dict) -> tuple[Optional[str], Optional[str]]:
+    """
+    Returns (message_id, error). Creating a draft isn't idempotent, so the POST goes out with
+    retries off and the draft carries a unique tag: after a throttle, 5xx or lost response the
+    drafts folder is searched for the tag before creating again, so no orphan duplicate is left.
+    """
+    import secrets
+
+    tag = secrets.token_hex(16)
+    draft = dict(draft, singleValueExtendedProperties=[{"id": _GRAPH_DRAFT_TAG_PROPERTY, "value": tag}])
+    attempts = max(0, _env_int("HTTP_MAX_RETRIES", 3)) + 1
+    last_err = "Graph create draft failed"
+    for attempt in range(attempts):
+        try:
+            resp = _http_request(
+                "POST",
+                f"{base}/messages",
+                headers={**auth, "Content-Type": "application/json"},
+                data=json.dumps(draft),
+                timeout_s=30,
+                retries=0,
+            )
+        except requests.RequestException as e:
+            resp = None
+            last_err = f"Graph create draft failed: {e}"
+        if resp is not None and resp.status_code in (200, 201):
+            message_id = (resp.json() or {}).get("id")
+            return (message_id, None) if message_id else (None, "Graph create draft returned no message id")
+        if resp is not None:
+            last_err = f"Graph create draft failed: {resp.status_code} {resp.text}"
+            if resp.status_code not in _HTTP_RETRY_STATUSES:
+                logging.warning("Graph create draft failed response (truncated): %s", (resp.text or "")[:2000])
+                return None, last_err
+        try:
+            existing = _graph_find_tagged_draft(base=base, auth=auth, tag=tag)
+        except requests.RequestException:
+            existing = None
+        if existing:
+            return existing, None
+        if attempt + 1 < attempts:
+            delay = _retry_after_seconds(resp) if resp is not None else None
+            if delay is None:
+                delay = _backoff_seconds(attempt)
+            time.sleep(min(delay, float(_env_int("HTTP_RETRY_MAX_WAIT_SECONDS", 30))))
+    logging.warning("%s", last_err[:2000])
+    return None, last_err
+
+
+def _graph_upload_attachment(*, auth: dict, message_url: str, att: dict, size: int) -> None:
+    body = {
+        "AttachmentItem": {
+            "attachmentType": "file",
+            "name": att.get("name") or "attachment",
+            "size": size,
+            "contentType": att.get("contentType") or "application/octet-stream",
+        }
+    }
+    resp = _http_request(
+        "POST",
+        f"{message_url}/attachments/createUploadSession",
+        headers={**auth, "Content-Type": "application/json"},
+        data=json.dumps(body),
+        timeout_s=30,
+    )
+    if resp.status_code not in (200, 201):
+        raise RuntimeError(f"createUploadSession for '{att.get('name')}' failed: {resp.status_code} {(resp.text or '')[:500]}")
+    upload_url = (resp.json() or {}).get("uploadUrl")
+    if not upload_url:
+        raise RuntimeError(f"createUploadSession for '{att.get('name')}' returned no uploadUrl")
+
+    offset = 0
+    for chunk in _iter_attachment_chunks(att, _GRAPH_UPLOAD_CHUNK_BYTES):
+        end = offset + len(chunk) - 1
+        # uploadUrl is pre-authenticated; Graph rejects chunk PUTs that also carry an Authorization header.
+        resp = _http_request(
+            "PUT",
+            upload_url,
+            headers={"Content-Type": "application/octet-stream", "Content-Range": f"bytes {offset}-{end}/{size}"},
+            data=chunk,
+            timeout_s=120,
+        )
+        if resp.status_code not in (200, 201):
+            raise RuntimeError(
+                f"upload of '{att.get('name')}' failed at bytes {offset}-{end}: {resp.status_code} {(resp.text or '')[:500]}"
+            )
+        offset = end + 1
+
+
 def _graph_access_token() -> str:
     return DefaultAzureCredential().get_token("https://graph.microsoft.com/.default").token
 
@@ -1498,7 +1907,7 @@ def _graph_request(method: str, url: str, *, headers: Optional[dict] = None, jso
     hdrs = {"Authorization": f"Bearer {_graph_access_token()}"}
     if headers:
         hdrs.update(headers)
-    return requests.request(method, url, headers=hdrs, json=json_body, timeout=timeout_s)
+    return _http_request(method, url, headers=hdrs, json_body=json_body, timeout_s=timeout_s)
 
 
 def _graph_get_json(url: str, *, timeout_s: int = 60) -> dict:
@@ -1508,17 +1917,64 @@ def _graph_get_json(url: str, *, timeout_s: int = 60) -> dict:
     return resp.json()
 
 
-def _graph_get_bytes(url: str, *, timeout_s: int = 120) -> bytes:
-    resp = _graph_request("GET", url, headers={"Accept": "application/octet-stream"}, timeout_s=timeout_s)
-    if resp.status_code not in (200, 201, 202):
-        raise RuntimeError(f"Graph GET (bytes) failed: url={url} status={resp.status_code} {(resp.text or '')[:500]}")
-    return resp.content or b""
+# Graph JSON batching allows at most 20 sub-requests per $batch POST.
+_GRAPH_BATCH_MAX = 20
+
+
+def _graph_error_message(body: dict) -> str:
+    err = body.get("error") if isinstance(body, dict) else None
+    if isinstance(err, dict):
+        return str(err.get("message") or err.get("code") or "").strip()[:300]
+    return ""
+
 
+def _graph_batch(sub_requests: list[dict], *, timeout_s: int = 60) -> dict[str, dict]:
+    """
+    Sends Graph sub-requests ({"id", "method", "url"} with url relative to /v1.0) through JSON $batch,
+    20 per POST. Returns {id: {"status", "headers", "body"}}.
 
-def _graph_delete(url: str, *, timeout_s: int = 60) -> None:
-    resp = _graph_request("DELETE", url, headers={"Accept": "application/json"}, timeout_s=timeout_s)
-    if resp.status_code not in (200, 202, 204):
-        raise RuntimeError(f"Graph DELETE failed: url={url} status={resp.status_code} {(resp.text or '')[:500]}")
+    Throttled (429) and 5xx sub-requests are retried in a follow-up batch after the longest
+    Retry-After they reported; any other per-item status is returned for the caller to handle.
+    """
+    results: dict[str, dict] = {}
+    pending = list(sub_requests)
+    retries = max(0, _env_int("HTTP_MAX_RETRIES", 3))
+    max_wait = float(_env_int("HTTP_RETRY_MAX_WAIT_SECONDS", 30))
+    headers = {"Authorization": f"Bearer {_graph_access_token()}", "Content-Type": "application/json"}
+    attempt = 0
+    while pending:
+        retry_next: list[dict] = []
+        wait_s = 0.0
+        for i in range(0, len(pending), _GRAPH_BATCH_MAX):
+            chunk = pending[i : i + _GRAPH_BATCH_MAX]
+            resp = _http_request(
+                "POST",
+                "https://graph.microsoft.com/v1.0/$batch",
+                headers=headers,
+                data=json.dumps({"requests": chunk}),
+                timeout_s=timeout_s,
+                retry_statuses=_HTTP_RETRY_STATUSES,
+            )
+            if resp.status_code != 200:
+                raise RuntimeError(f"Graph $batch failed: status={resp.status_code} {(resp.text or '')[:500]}")
+            by_id = {r["id"]: r for r in chunk}
+            for r in (resp.json() or {}).get("responses") or []:
+                rid = str(r.get("id"))
+                status = int(r.get("status") or 0)
+                sub_headers = r.get("headers") or {}
+                if (status == 429 or status >= 500) and attempt < retries and rid in by_id:
+                    retry_next.append(by_id[rid])
+                    try:
+                        wait_s = max(wait_s, float(sub_headers.get("Retry-After") or sub_headers.get("retry-after") or 0))
+                    except (TypeError, ValueError):
+                        pass
+                    continue
+                results[rid] = {"status": status, "headers": sub_headers, "body": r.get("body")}
+        pending = retry_next
+        if pending:
+            time.sleep(min(max(wait_s, _backoff_seconds(attempt)), max_wait))
+            attempt += 1
+    return results
 
 
 def _parse_sharepoint_item_ids(payload: dict) -> list[str]:
@@ -1551,7 +2007,173 @@ def _graph_share_id(url: str) -> str:
     return f"u!{b64}"
 
 
-def _download_receipts_from_sharepoint(payload: dict) -> tuple[list[bytes], list[str], Optional[str]]:
+# Process-level share URL -> driveItem cache, only used when SHAREPOINT_SHARE_CACHE_TTL_SECONDS > 0.
+# Entries hold (driveId, itemId, name, size); downloadUrl expires quickly so it is never kept here.
+_SP_SHARE_CACHE: dict[str, tuple[float, dict]] = {}
+_SP_SHARE_CACHE_MAX = 512
+_SP_SHARE_LOCK = threading.Lock()
+
+
+def _sharepoint_share_cache_get(url: str, cache: Optional[dict]) -> Optional[dict]:
+    if cache is not None and url in cache:
+        return cache[url]
+    ttl = _env_int("SHAREPOINT_SHARE_CACHE_TTL_SECONDS", 0)
+    if ttl <= 0:
+        return None
+    with _SP_SHARE_LOCK:
+        entry = _SP_SHARE_CACHE.get(url)
+    if entry is None or time.monotonic() - entry[0] > ttl:
+        return None
+    item = dict(entry[1], downloadUrl="")
+    if cache is not None:
+        cache[url] = item
+    return item
+
+
+def _sharepoint_share_cache_put(url: str, item: dict, cache: Optional[dict]) -> None:
+    if cache is not None:
+        cache[url] = item
+    if _env_int("SHAREPOINT_SHARE_CACHE_TTL_SECONDS", 0) <= 0:
+        return
+    keep = {k: item.get(k) for k in ("driveId", "itemId", "name", "size")}
+    with _SP_SHARE_LOCK:
+        _SP_SHARE_CACHE.pop(url, None)
+        while len(_SP_SHARE_CACHE) >= _SP_SHARE_CACHE_MAX:
+            _SP_SHARE_CACHE.pop(next(iter(_SP_SHARE_CACHE)))
+        _SP_SHARE_CACHE[url] = (time.monotonic(), keep)
+
+
+def _sharepoint_share_cache_forget(urls: list[str], cache: Optional[dict]) -> None:
+    with _SP_SHARE_LOCK:
+        for u in urls:
+            _SP_SHARE_CACHE.pop(u, None)
+            if cache is not None:
+                cache.pop(u, None)
+
+
+def _graph_resolve_sharepoint_items(
+    payload: dict, *, need_metadata: bool = True, resolve_cache: Optional[dict] = None
+) -> tuple[list[dict], list[str]]:
+    """
+    Resolves the SharePoint receipts referenced by the payload to
+    [{"driveId", "itemId", "name", "size", "downloadUrl"}] in input order.
+
+    Share URLs (and driveId+itemIds when metadata is needed) are looked up through Graph $batch,
+    so 10 receipts cost one round-trip instead of 10-20. Share URLs already present in
+    resolve_cache (request-scoped, see submit_report) or the process cache are not looked up again.
+    Returns (items, errors); each error names the URL/item that failed so one bad link doesn't
+    hide the others.
+    """
+    drive_id = _coalesce(payload.get("sharepointDriveId"), payload.get("sharePointDriveId"), payload.get("spDriveId"))
+    item_ids = _parse_sharepoint_item_ids(payload)
+    urls = _parse_sharepoint_urls(payload)
+    # downloadUrl is a short-lived pre-authenticated link; fetching it with the metadata saves the
+    # /content redirect per file and lets downloads run without a Graph token.
+    select = "$select=id,name,size,file,parentReference,@microsoft.graph.downloadUrl"
+
+    known: dict[int, dict] = {}
+    if drive_id and item_ids:
+        if not need_metadata:
+            return [{"driveId": drive_id, "itemId": i, "name": "", "size": None, "downloadUrl": ""} for i in item_ids], []
+        labels = item_ids
+        reqs = [
+            {"id": str(n), "method": "GET", "url": f"/drives/{drive_id}/items/{item_id}?{select}"}
+            for n, item_id in enumerate(item_ids)
+        ]
+    elif urls:
+        labels = urls
+        for n, u in enumerate(urls):
+            hit = _sharepoint_share_cache_get(u, resolve_cache)
+            if hit is not None:
+                known[n] = hit
+        reqs = [
+            {"id": str(n), "method": "GET", "url": f"/shares/{_graph_share_id(u)}/driveItem?{select}"}
+            for n, u in enumerate(urls)
+            if n not in known
+        ]
+    else:
+        return [], []
+
+    results = _graph_batch(reqs) if reqs else {}
+    items: list[dict] = []
+    errors: list[str] = []
+    for n, label in enumerate(labels):
+        if n in known:
+            items.append(known[n])
+            continue
+        res = results.get(str(n)) or {}
+        status = res.get("status")
+        body = res.get("body") if isinstance(res.get("body"), dict) else {}
+        pref = body.get("parentReference") if isinstance(body.get("parentReference"), dict) else {}
+        item_drive = pref.get("driveId") or drive_id
+        if status != 200 or not body.get("id") or not item_drive:
+            errors.append(f"'{label}' (HTTP {status}: {_graph_error_message(body)})")
+            continue
+        item = {
+            "driveId": str(item_drive),
+            "itemId": str(body["id"]),
+            "name": str(body.get("name") or "").strip(),
+            "size": body.get("size"),
+            "downloadUrl": str(body.get("@microsoft.graph.downloadUrl") or ""),
+        }
+        items.append(item)
+        if not (drive_id and item_ids):
+            _sharepoint_share_cache_put(label, item, resolve_cache)
+    return items, errors
+
+
+def _spool_download(url: str, *, headers: Optional[dict] = None, timeout_s: int = 120):
+    """
+    Streams a GET response into a SpooledTemporaryFile: kept in memory up to RECEIPT_SPOOL_MEMORY_BYTES
+    (default 8 MB), then rolled to local temp storage. Returns the file positioned at 0.
+    """
+    resp = _http_request("GET", url, headers=headers, timeout_s=timeout_s, stream=True)
+    try:
+        if resp.status_code != 200:
+            raise RuntimeError(f"GET failed: status={resp.status_code} {(resp.text or '')[:500]}")
+        spool = tempfile.SpooledTemporaryFile(max_size=_env_int("RECEIPT_SPOOL_MEMORY_BYTES", 8 * 1024 * 1024))
+        for chunk in resp.iter_content(chunk_size=1024 * 1024):
+            spool.write(chunk)
+        spool.seek(0)
+        return spool
+    finally:
+        resp.close()
+
+
+def _blob_bytes(blob) -> bytes:
+    """Receipt content is either bytes or a spooled temp file (SharePoint downloads)."""
+    if isinstance(blob, (bytes, bytearray)):
+        return bytes(blob)
+    blob.seek(0)
+    return blob.read()
+
+
+def _blob_len(blob) -> int:
+    if isinstance(blob, (bytes, bytearray)):
+        return len(blob)
+    blob.seek(0, os.SEEK_END)
+    size = blob.tell()
+    blob.seek(0)
+    return size
+
+
+def _close_blobs(blobs) -> None:
+    """Closes the spooled temp files among receipt contents (bytes and None are skipped)."""
+    for blob in blobs:
+        if blob is not None and not isinstance(blob, (bytes, bytearray, memoryview)):
+            blob.close()
+
+
+def _blob_head(blob, n: int = 16) -> bytes:
+    if isinstance(blob, (bytes, bytearray)):
+        return bytes(blob[:n])
+    blob.seek(0)
+    head = blob.read(n)
+    blob.seek(0)
+    return head
+
+
+def _download_receipts_from_sharepoint(payload: dict, *, resolve_cache: Optional[dict] = None) -> tuple[list, list[str], Optional[str]]:
     """
     Downloads files from SharePoint/OneDrive via Microsoft Graph.
 
@@ -1561,101 +2183,169 @@ def _download_receipts_from_sharepoint(payload: dict) -> tuple[list[bytes], list
         - sharepointItemIds (list or comma-separated string of driveItem ids)
       B) share URLs (best for tools that only return webUrl):
         - sharepointFileUrls (list or comma-separated)
-    """
-    drive_id = _coalesce(payload.get("sharepointDriveId"), payload.get("sharePointDriveId"), payload.get("spDriveId"))
-    item_ids = _parse_sharepoint_item_ids(payload)
-    urls = _parse_sharepoint_urls(payload)
 
-    downloaded: list[bytes] = []
-    filenames: list[str] = []
+    Files download concurrently (SHAREPOINT_DOWNLOAD_CONCURRENCY, default 4) from their
+    pre-authenticated downloadUrl and are returned as spooled temp files in the original order.
+    """
     try:
-        # Form B: resolve share URLs -> driveId/itemId
-        if not (drive_id and item_ids) and urls:
-            for i, u in enumerate(urls):
-                sid = _graph_share_id(u)
-                meta = _graph_get_json(
-                    f"https://graph.microsoft.com/v1.0/shares/{sid}/driveItem?$select=id,name,parentReference",
-                    timeout_s=30,
-                )
-                item_id = meta.get("id")
-                pref = meta.get("parentReference") if isinstance(meta, dict) else {}
-                drive_id = (pref.get("driveId") if isinstance(pref, dict) else None) or drive_id
-                if item_id and drive_id:
-                    item_ids.append(str(item_id))
-
-        if not drive_id or not item_ids:
+        items, errors = _graph_resolve_sharepoint_items(payload, need_metadata=True, resolve_cache=resolve_cache)
+        if errors:
+            return [], [], f"Failed to resolve SharePoint receipts: {'; '.join(errors)}"
+        if not items:
             return [], [], "sharepointDriveId+sharepointItemIds or sharepointFileUrls are required to fetch receipts from SharePoint"
 
-        for i, item_id in enumerate(item_ids):
-            meta = _graph_get_json(
-                f"https://graph.microsoft.com/v1.0/drives/{drive_id}/items/{item_id}?$select=id,name,file",
-                timeout_s=30,
-            )
-            name = (meta.get("name") or "").strip() or f"receipt-{i+1}"
-            content = _graph_get_bytes(
-                f"https://graph.microsoft.com/v1.0/drives/{drive_id}/items/{item_id}/content",
+        def _fetch(it: dict):
+            if it.get("downloadUrl"):
+                return _spool_download(it["downloadUrl"], timeout_s=120)
+            # No downloadUrl (e.g. restricted item): fall back to the authenticated /content redirect.
+            return _spool_download(
+                f"https://graph.microsoft.com/v1.0/drives/{it['driveId']}/items/{it['itemId']}/content",
+                headers={"Authorization": f"Bearer {_graph_access_token()}"},
                 timeout_s=120,
             )
-            if not content:
-                continue
-            sniff_ext, _sniff_type = _sniff_file_type(content)
-            if "." not in name and sniff_ext:
-                name = f"{name}.{sniff_ext}"
-            downloaded.append(content)
-            filenames.append(name)
 
-        if not downloaded:
-            return [], [], "SharePoint receipts were empty or could not be downloaded"
+        workers = max(1, min(len(items), _env_int("SHAREPOINT_DOWNLOAD_CONCURRENCY", 4)))
+        with contextlib.ExitStack() as cleanup:
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                futures = [pool.submit(_fetch, it) for it in items]
+            # The pool has joined: every spool that did download is closed if another file
+            # failed (result() re-raises below) or nothing usable came back.
+            for fut in futures:
+                if fut.exception() is None:
+                    cleanup.callback(fut.result().close)
+            spools = [fut.result() for fut in futures]
+
+            downloaded: list = []
+            filenames: list[str] = []
+            for i, (it, content) in enumerate(zip(items, spools)):
+                if _blob_len(content) == 0:
+                    content.close()
+                    continue
+                name = it["name"] or f"receipt-{i+1}"
+                sniff_ext, _sniff_type = _sniff_file_type(_blob_head(content))
+                if "." not in name and sniff_ext:
+                    name = f"{name}.{sniff_ext}"
+                downloaded.append(content)
+                filenames.append(name)
+
+            if not downloaded:
+                return [], [], "SharePoint receipts were empty or could not be downloaded"
+            cleanup.pop_all()
         return downloaded, filenames, None
     except Exception as e:
         return [], [], f"Failed to download receipts from SharePoint: {e}"
 
 
-def _purge_sharepoint_items(payload: dict) -> Optional[str]:
+def _purge_sharepoint_items(payload: dict, *, resolve_cache: Optional[dict] = None) -> Optional[str]:
     """
     Best-effort deletion of temp items after successful send.
     Supports:
       - sharepointDriveId+sharepointItemIds
-      - sharepointFileUrls (resolved to driveItem and then deleted)
+      - sharepointFileUrls (resolved to driveItem and then deleted; pass the resolve_cache the
+        download used so the URLs are not resolved a second time)
+    Deletes are sent through Graph $batch; items that are already gone (404) count as purged.
     """
-    drive_id = _coalesce(payload.get("sharepointDriveId"), payload.get("sharePointDriveId"), payload.get("spDriveId"))
-    item_ids = _parse_sharepoint_item_ids(payload)
-    urls = _parse_sharepoint_urls(payload)
     try:
-        if urls and not (drive_id and item_ids):
-            for u in urls:
-                sid = _graph_share_id(u)
-                meta = _graph_get_json(
-                    f"https://graph.microsoft.com/v1.0/shares/{sid}/driveItem?$select=id,parentReference",
-                    timeout_s=30,
-                )
-                item_id = meta.get("id")
-                pref = meta.get("parentReference") if isinstance(meta, dict) else {}
-                drive_id = (pref.get("driveId") if isinstance(pref, dict) else None) or drive_id
-                if item_id and drive_id:
-                    item_ids.append(str(item_id))
-        if not drive_id or not item_ids:
-            return None
-        for item_id in item_ids:
-            _graph_delete(f"https://graph.microsoft.com/v1.0/drives/{drive_id}/items/{item_id}")
+        items, errors = _graph_resolve_sharepoint_items(payload, need_metadata=False, resolve_cache=resolve_cache)
+        if items:
+            results = _graph_batch(
+                [
+                    {"id": str(n), "method": "DELETE", "url": f"/drives/{it['driveId']}/items/{it['itemId']}"}
+                    for n, it in enumerate(items)
+                ]
+            )
+            for n, it in enumerate(items):
+                res = results.get(str(n)) or {}
+                if res.get("status") not in (200, 202, 204, 404):
+                    body = res.get("body") if isinstance(res.get("body"), dict) else {}
+                    errors.append(f"'{it['itemId']}' (HTTP {res.get('status')}: {_graph_error_message(body)})")
+        # Deleted items must not be served from the share cache on a later request.
+        _sharepoint_share_cache_forget(_parse_sharepoint_urls(payload), resolve_cache)
+        if errors:
+            return f"Failed to purge SharePoint receipts: {'; '.join(errors)}"
         return None
     except Exception as e:
         return f"Failed to purge SharePoint receipts: {e}"
 
 
+# Tolerant base64 input: one bytes.translate pass maps URL-safe "-_" to "+/" and drops whitespace.
+_B64_URLSAFE_TO_STD = bytes.maketrans(b"-_", b"+/")
+_B64_WHITESPACE = b" \t\r\n\f\v"
+_B64_STRICT_RE = re.compile(rb"[A-Za-z0-9+/]*={0,2}")
+# JSON int-array receipts are parsed this many characters at a time.
+_INT_ARRAY_CHUNK_CHARS = 64 * 1024
+
+
+def _b64decode_strict(raw: str) -> bytes:
+    try:
+        # Python 3.11+: validates in C without first copying the str to bytes.
+        return binascii.a2b_base64(raw, strict_mode=True)
+    except TypeError:
+        return base64.b64decode(raw, validate=True)
+
+
 def _decode_b64(data_b64: str) -> bytes:
+    """
+    Decodes standard or URL-safe base64 with optional quotes, data: URL prefix, whitespace/line
+    breaks and missing padding.
+
+    Clean standard base64 (the common case) decodes directly. Anything else is normalized with a
+    single translate pass into a bytearray that is padded in place, so a multi-MB string costs two
+    copies instead of one per cleanup step.
+    """
     raw = (data_b64 or "").strip()
     if len(raw) >= 2 and raw[0] in {"'", '"'} and raw[-1] == raw[0]:
         raw = raw[1:-1].strip()
-    if raw.startswith("data:") and "," in raw:
-        raw = raw.split(",", 1)[1]
-    # Be tolerant of missing padding and stray whitespace from clients.
-    raw = "".join(raw.split())
-    raw = raw.replace("-", "+").replace("_", "/")
-    missing = len(raw) % 4
+    if raw.startswith("data:"):
+        comma = raw.find(",")
+        if comma != -1:
+            raw = raw[comma + 1 :]
+    try:
+        return _b64decode_strict(raw)
+    except (binascii.Error, ValueError):
+        pass
+
+    try:
+        buf = bytearray(raw, "ascii")
+    except UnicodeEncodeError as e:
+        raise binascii.Error(f"Non-base64 character in input: {e}") from None
+    buf = buf.translate(_B64_URLSAFE_TO_STD, _B64_WHITESPACE)
+    missing = len(buf) % 4
     if missing:
-        raw += "=" * (4 - missing)
-    return base64.b64decode(raw, validate=True)
+        buf.extend(b"=" * (4 - missing))
+    try:
+        return binascii.a2b_base64(buf, strict_mode=True)
+    except TypeError:
+        pass
+    if _B64_STRICT_RE.fullmatch(buf) is None:
+        raise binascii.Error("Non-base64 digit found")
+    return binascii.a2b_base64(buf)
+
+
+def _int_array_text_to_bytes(raw: str) -> Optional[bytes]:
+    """
+    Parses a JSON array of byte values ("[137,80,78,...]") straight into bytes, a bounded slice of
+    text at a time, instead of json.loads materializing a list of millions of ints.
+    Returns None when the text is not a flat array of integers.
+    """
+    out = bytearray()
+    pos, stop = 1, len(raw) - 1
+    while pos < stop:
+        end = min(pos + _INT_ARRAY_CHUNK_CHARS, stop)
+        if end < stop:
+            # Cut on a comma so no number is split across slices.
+            comma = raw.rfind(",", pos, end)
+            if comma == -1:
+                comma = raw.find(",", end, stop)
+            end = stop if comma == -1 else comma
+        chunk = raw[pos:end]
+        if chunk.strip():
+            try:
+                out.extend(bytes(json.loads(f"[{chunk}]")))
+            except (TypeError, ValueError):
+                return None
+        pos = end + 1
+    return bytes(out)
 
 
 def _coerce_bytes(value) -> bytes:
@@ -1663,25 +2353,99 @@ def _coerce_bytes(value) -> bytes:
         return b""
     if isinstance(value, (bytes, bytearray)):
         return bytes(value)
-    if isinstance(value, list) and all(isinstance(x, int) for x in value):
-        return bytes(value)
-    if isinstance(value, dict) and isinstance(value.get("data"), list) and all(
-        isinstance(x, int) for x in value.get("data", [])
-    ):
-        return bytes(value["data"])
+    if isinstance(value, dict) and isinstance(value.get("data"), list):
+        value = value["data"]
+    if isinstance(value, list):
+        # bytes() validates element types and the 0-255 range itself; no separate all(...) pass.
+        try:
+            return bytes(value)
+        except TypeError:
+            return b""
     if isinstance(value, str):
         raw = value.strip()
         if raw.startswith("[") and raw.endswith("]"):
-            try:
-                parsed = json.loads(raw)
-            except Exception:
-                parsed = None
-            if isinstance(parsed, list) and all(isinstance(x, int) for x in parsed):
-                return bytes(parsed)
+            parsed = _int_array_text_to_bytes(raw)
+            if parsed is not None:
+                return parsed
         return _decode_b64(raw)
     return b""
 
 
+def _is_multipart(req: func.HttpRequest) -> bool:
+    return (req.headers.get("Content-Type") or "").strip().lower().startswith("multipart/form-data")
+
+
+def _parse_multipart_form(body: bytes, content_type: str) -> list[dict]:
+    """
+    Splits a multipart/form-data body into [{"name", "filename", "contentType", "content"}].
+    Parts are sliced straight out of the request body (one copy each); nothing is base64 encoded.
+    Raises ValueError on a malformed body.
+    """
+    header = Message()
+    header["Content-Type"] = content_type
+    boundary = header.get_param("boundary")
+    if not boundary:
+        raise ValueError("multipart boundary is missing from Content-Type")
+    delim = b"--" + str(boundary).encode("latin-1")
+
+    pos = body.find(delim)
+    if pos < 0:
+        raise ValueError("multipart boundary not found in body")
+    pos += len(delim)
+    parts: list[dict] = []
+    while not body.startswith(b"--", pos):
+        if body.startswith(b"\r\n", pos):
+            pos += 2
+        head_end = body.find(b"\r\n\r\n", pos)
+        if head_end < 0:
+            raise ValueError("malformed multipart part headers")
+        part_headers = Message()
+        for line in body[pos:head_end].decode("utf-8", errors="replace").split("\r\n"):
+            if ":" in line:
+                k, v = line.split(":", 1)
+                part_headers[k.strip()] = v.strip()
+        end = body.find(b"\r\n" + delim, head_end + 4)
+        if end < 0:
+            raise ValueError("multipart body is not terminated")
+        parts.append(
+            {
+                "name": str(part_headers.get_param("name", header="content-disposition") or ""),
+                "filename": part_headers.get_filename(),
+                "contentType": part_headers.get_content_type() if part_headers.get("Content-Type") else "",
+                "content": body[head_end + 4 : end],
+            }
+        )
+        pos = end + 2 + len(delim)
+    return parts
+
+
+def _parse_multipart_request(req: func.HttpRequest) -> tuple[dict, list[dict]]:
+    """
+    Returns (fields, files) for a multipart/form-data request.
+
+    A part sent as application/json becomes the request object, whatever its name; other non-file
+    parts are string fields, so a plain "data" or "body" form field is never parsed as JSON. Parts
+    with a filename are returned as files in body order.
+    """
+    fields: dict = {}
+    files: list[dict] = []
+    for part in _parse_multipart_form(req.get_body() or b"", req.headers.get("Content-Type") or ""):
+        if part["filename"] is not None:
+            files.append(part)
+            continue
+        text = part["content"].decode("utf-8", errors="replace")
+        if part["contentType"] == "application/json":
+            parsed = json.loads(text)
+            if isinstance(parsed, dict):
+                fields.update(parsed)
+            else:
+                fields["draftItemsJson"] = text
+            continue
+        if part["name"]:
+            fields[part["name"]] = text
+    return fields, files
+
+
 def _sniff_file_type(data: bytes) -> tuple[Optional[str], Optional[str]]:
     if data.startswith(b"%PDF-"):
         return "pdf", "application/pdf"
@@ -1692,9 +2456,115 @@ def _sniff_file_type(data: bytes) -> tuple[Optional[str], Optional[str]]:
     return None, None
 
 
+def _pdf_font_widths(spec: str) -> tuple[int, ...]:
+    # AFM advance widths (1/1000 em) for WinAnsi codes 32..126.
+    return tuple(int(w) for w in spec.split())
+
+
+# Standard-14 fonts need no embedding; widths are parsed once at import for text fitting.
+_PDF_FONT_WIDTHS = {
+    "F1": _pdf_font_widths(  # Helvetica
+        "278 278 355 556 556 889 667 191 333 333 389 584 278 333 278 278 556 556 556 556 556 556 556 "
+        "556 556 556 278 278 584 584 584 556 1015 667 667 722 722 667 611 778 722 278 500 667 556 833 "
+        "722 778 667 778 722 667 611 722 667 944 667 667 611 278 278 278 469 556 333 556 556 500 556 "
+        "556 278 556 556 222 222 500 222 833 556 556 556 556 333 500 278 556 500 722 500 500 500 334 "
+        "260 334 584"
+    ),
+    "F2": _pdf_font_widths(  # Helvetica-Bold
+        "278 333 474 556 556 889 722 238 333 333 389 584 278 333 278 278 556 556 556 556 556 556 556 "
+        "556 556 556 333 333 584 584 584 611 975 722 722 722 722 667 611 778 722 278 556 722 611 833 "
+        "722 778 667 778 722 667 611 722 667 944 667 667 611 333 278 333 584 556 333 556 611 556 611 "
+        "556 333 611 611 278 278 556 278 889 611 611 611 611 389 556 333 611 556 778 556 556 500 389 "
+        "280 389 584"
+    ),
+}
+_PDF_FONT_NAMES = {"F1": "Helvetica", "F2": "Helvetica-Bold"}
+_PDF_DEFAULT_WIDTH = 556  # non-ASCII WinAnsi glyphs; close enough for column fitting
+
+
+def _pdf_text_width(text: str, font: str, size: float) -> float:
+    widths = _PDF_FONT_WIDTHS[font]
+    units = 0
+    for ch in text:
+        code = ord(ch) - 32
+        units += widths[code] if 0 <= code < len(widths) else _PDF_DEFAULT_WIDTH
+    return units * size / 1000.0
+
+
+def _pdf_fit_text(text: str, font: str, size: float, max_w: float) -> str:
+    """Truncates text with "..." so it renders within max_w points."""
+    if _pdf_text_width(text, font, size) <= max_w:
+        return text
+    budget = max_w - _pdf_text_width("...", font, size)
+    widths = _PDF_FONT_WIDTHS[font]
+    used = 0.0
+    for i, ch in enumerate(text):
+        code = ord(ch) - 32
+        used += (widths[code] if 0 <= code < len(widths) else _PDF_DEFAULT_WIDTH) * size / 1000.0
+        if used > budget:
+            return text[:i].rstrip() + "..."
+    return text
+
+
+def _pdf_string(text: str) -> bytes:
+    raw = text.encode("cp1252", errors="replace")
+    return b"(" + raw.replace(b"\\", b"\\\\").replace(b"(", b"\\(").replace(b")", b"\\)") + b")"
+
+
+def _pdf_write_document(page_streams: list[bytes], page_w: float, page_h: float) -> bytes:
+    """
+    Writes a minimal PDF: one page per content stream, Helvetica/Helvetica-Bold as F1/F2.
+    Content streams are Flate-compressed.
+    """
+    objects: list[bytes] = []
+    n_pages = len(page_streams)
+    # 1 catalog, 2 pages, 3-4 fonts, then (page, contents) pairs.
+    kids = " ".join(f"{5 + 2 * i} 0 R" for i in range(n_pages))
+    objects.append(b"<< /Type /Catalog /Pages 2 0 R >>")
+    objects.append(f"<< /Type /Pages /Kids [{kids}] /Count {n_pages} >>".encode("ascii"))
+    for key in ("F1", "F2"):
+        objects.append(
+            f"<< /Type /Font /Subtype /Type1 /BaseFont /{_PDF_FONT_NAMES[key]} "
+            f"/Encoding /WinAnsiEncoding >>".encode("ascii")
+        )
+    for i, stream in enumerate(page_streams):
+        objects.append(
+            f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 {page_w:g} {page_h:g}] "
+            f"/Resources << /Font << /F1 3 0 R /F2 4 0 R >> >> /Contents {6 + 2 * i} 0 R >>".encode("ascii")
+        )
+        objects.append(_pdf_stream_object(zlib.compress(stream, 6), "/Filter /FlateDecode"))
+    return _pdf_serialize(objects)
+
+
+def _pdf_stream_object(data: bytes, entries: str = "") -> bytes:
+    head = f"<< /Length {len(data)} {entries} >>" if entries else f"<< /Length {len(data)} >>"
+    return head.encode("ascii") + b"\nstream\n" + data + b"\nendstream"
+
+
+def _pdf_serialize(objects: list[bytes]) -> bytes:
+    """Writes numbered objects (object 1 must be the catalog) with a classic xref table."""
+    out = BytesIO()
+    out.write(b"%PDF-1.4\n%\xe2\xe3\xcf\xd3\n")
+    offsets = []
+    for num, body in enumerate(objects, start=1):
+        offsets.append(out.tell())
+        out.write(f"{num} 0 obj\n".encode("ascii"))
+        out.write(body)
+        out.write(b"\nendobj\n")
+    xref_at = out.tell()
+    out.write(f"xref\n0 {len(objects) + 1}\n0000000000 65535 f \n".encode("ascii"))
+    for off in offsets:
+        out.write(f"{off:010d} 00000 n \n".encode("ascii"))
+    out.write(
+        f"trailer\n<< /Size {len(objects) + 1} /Root 1 0 R >>\nstartxref\n{xref_at}\n%%EOF\n".encode("ascii")
+    )
+    return out.getvalue()
+
+
 def _build_summary_table_pdf(payload: dict) -> Optional[bytes]:
     """
-    Renders a summary table of expense items as a PDF page using PIL.
+    Renders a summary table of expense items as a vector PDF (text + line operators, no raster).
+    Long tables continue onto further pages with the header row repeated.
     Returns PDF bytes, or None if no items are available.
     """
     items = payload.get("items")
@@ -1706,12 +2576,6 @@ def _build_summary_table_pdf(payload: dict) -> Optional[bytes]:
     if not isinstance(items, list) or len(items) == 0:
         return None
 
-    try:
-        from PIL import ImageDraw, ImageFont
-    except ImportError:
-        logging.warning("PIL ImageDraw not available for summary table")
-        return None
-
     try:
         # Table data
         headers = ["Type", "Date", "Description", "Account", "Dept", "Activity", "Amount"]
@@ -1731,140 +2595,815 @@ def _build_summary_table_pdf(payload: dict) -> Optional[bytes]:
             except (ValueError, TypeError):
                 amt = 0.0
             total += amt
-            rows.append([item_type, date_val, ref[:40], account, dept, activity, f"${amt:.2f}"])
+            rows.append([item_type, date_val, ref, account, dept, activity, f"${amt:.2f}"])
 
         if not rows:
             return None
 
         requester = str(payload.get("requesterEmail") or payload.get("toEmail") or "").strip()
 
-        # Rendering settings
-        dpi = 150
-        page_w = int(8.5 * dpi)
-        page_h = int(11 * dpi)
-        margin = int(0.5 * dpi)
-
-        # Use default font
-        try:
-            font = ImageFont.truetype("arial.ttf", 14)
-            font_bold = ImageFont.truetype("arialbd.ttf", 14)
-            font_header = ImageFont.truetype("arialbd.ttf", 18)
-        except Exception:
-            font = ImageFont.load_default()
-            font_bold = font
-            font_header = font
+        # Letter page in points
+        page_w, page_h = 612.0, 792.0
+        margin = 36.0
+        font_size = 8.5
+        row_height = 14.0
+        pad = 3.0
 
-        # Column widths (proportional to page width)
+        # Column widths (proportional to usable width); the last column takes the remainder
         usable_w = page_w - 2 * margin
         col_ratios = [0.08, 0.12, 0.28, 0.10, 0.10, 0.10, 0.12]
         total_ratio = sum(col_ratios)
-        col_widths = [int(r / total_ratio * usable_w) for r in col_ratios]
-        # Adjust last column to fill remaining space
-        col_widths[-1] = usable_w - sum(col_widths[:-1])
-
-        row_height = 22
-        header_area = 60
-
-        img = Image.new("RGB", (page_w, page_h), "white")
-        draw = ImageDraw.Draw(img)
-
-        y = margin
-
-        # Title and metadata
-        draw.text((margin, y), "Travel Expense Summary", fill="black", font=font_header)
-        y += 28
-        if requester:
-            draw.text((margin, y), f"Requester: {requester}", fill="black", font=font)
-            y += 20
-        from datetime import date as _date_type
-        draw.text((margin, y), f"Date: {_date_type.today().isoformat()}", fill="black", font=font)
-        y += 20
-        draw.text((margin, y), f"Items: {len(rows)}    Total: ${total:.2f}", fill="black", font=font)
-        y += 30
-
-        # Draw table header
-        x = margin
-        for i, h in enumerate(headers):
-            draw.rectangle([x, y, x + col_widths[i], y + row_height], fill="#4472C4", outline="black")
-            draw.text((x + 4, y + 3), h, fill="white", font=font_bold)
-            x += col_widths[i]
-        y += row_height
-
-        # Draw rows
-        for row_idx, row in enumerate(rows):
-            bg = "#F2F2F2" if row_idx % 2 == 0 else "white"
+        col_widths = [round(r / total_ratio * usable_w, 2) for r in col_ratios]
+        col_widths[-1] = round(usable_w - sum(col_widths[:-1]), 2)
+        amount_col = len(headers) - 1
+
+        def cell_text(ops: list, text: str, font: str, x: float, y: float, col: int, rgb: str) -> None:
+            avail = col_widths[col] - 2 * pad
+            fitted = _pdf_fit_text(text, font, font_size, avail)
+            if not fitted:
+                return
+            tx = x + pad
+            if col == amount_col:
+                tx = x + col_widths[col] - pad - _pdf_text_width(fitted, font, font_size)
+            color_op = "g" if len(rgb.split()) == 1 else "rg"  # gray takes one operand, RGB three
+            ops.append(
+                f"BT {rgb} {color_op} /{font} {font_size:g} Tf {tx:.2f} {y + 4:.2f} Td ".encode("ascii")
+                + _pdf_string(fitted)
+                + b" Tj ET"
+            )
+
+        def table_row(ops: list, cells: list, y: float, fill: str, stroke: str, font: str, rgb: str) -> None:
             x = margin
-            for i, cell in enumerate(row):
-                draw.rectangle([x, y, x + col_widths[i], y + row_height], fill=bg, outline="#CCCCCC")
-                # Truncate text to fit column
-                text = str(cell)
-                draw.text((x + 4, y + 3), text, fill="black", font=font)
-                x += col_widths[i]
-            y += row_height
-
-        # Draw total row
-        x = margin
-        total_label_w = sum(col_widths[:-1])
-        draw.rectangle([x, y, x + total_label_w, y + row_height], fill="#D9E2F3", outline="black")
-        draw.text((x + total_label_w - 60, y + 3), "Total:", fill="black", font=font_bold)
-        x += total_label_w
-        draw.rectangle([x, y, x + col_widths[-1], y + row_height], fill="#D9E2F3", outline="black")
-        draw.text((x + 4, y + 3), f"${total:.2f}", fill="black", font=font_bold)
-
-        # Convert to PDF
-        out = BytesIO()
-        img.save(out, format="PDF", resolution=dpi)
-        return out.getvalue()
+            for col, cell in enumerate(cells):
+                ops.append(
+                    f"{fill} rg {stroke} RG {x:.2f} {y:.2f} {col_widths[col]:.2f} {row_height:g} re B".encode("ascii")
+                )
+                x += col_widths[col]
+            x = margin
+            for col, cell in enumerate(cells):
+                cell_text(ops, str(cell), font, x, y, col, rgb)
+                x += col_widths[col]
+
+        header_fill = "0.267 0.447 0.769"  # #4472C4
+        stripe_fill = "0.949 0.949 0.949"  # #F2F2F2
+        total_fill = "0.851 0.886 0.953"  # #D9E2F3
+
+        def new_page(first: bool) -> tuple[list, float]:
+            ops: list[bytes] = [b"0.5 w"]
+            y = page_h - margin
+            if first:
+                lines = [("F2", 14.0, "Travel Expense Summary")]
+                if requester:
+                    lines.append(("F1", 9.0, f"Requester: {requester}"))
+                lines.append(("F1", 9.0, f"Date: {date.today().isoformat()}"))
+                lines.append(("F1", 9.0, f"Items: {len(rows)}    Total: ${total:.2f}"))
+                for font, size, text in lines:
+                    y -= size + 4
+                    ops.append(
+                        f"BT 0 g /{font} {size:g} Tf {margin:.2f} {y:.2f} Td ".encode("ascii")
+                        + _pdf_string(_pdf_fit_text(text, font, size, usable_w))
+                        + b" Tj ET"
+                    )
+                y -= 10
+            y -= row_height
+            table_row(ops, headers, y, header_fill, "0 0 0", "F2", "1 1 1")
+            return ops, y
+
+        pages: list[list[bytes]] = []
+        ops, y = new_page(True)
+        bottom = margin + 14  # keep room for the page footer
+        for row_idx, row in enumerate(rows):
+            if y - row_height < bottom:
+                pages.append(ops)
+                ops, y = new_page(False)
+            y -= row_height
+            fill = stripe_fill if row_idx % 2 == 0 else "1 1 1"
+            table_row(ops, row, y, fill, "0.8 0.8 0.8", "F1", "0")
+
+        if y - row_height < bottom:
+            pages.append(ops)
+            ops, y = new_page(False)
+        y -= row_height
+        label_w = sum(col_widths[:-1])
+        ops.append(
+            f"{total_fill} rg 0 0 0 RG {margin:.2f} {y:.2f} {label_w:.2f} {row_height:g} re B "
+            f"{margin + label_w:.2f} {y:.2f} {col_widths[-1]:.2f} {row_height:g} re B".encode("ascii")
+        )
+        label_x = margin + label_w - pad - _pdf_text_width("Total:", "F2", font_size)
+        ops.append(
+            f"BT 0 g /F2 {font_size:g} Tf {label_x:.2f} {y + 4:.2f} Td ".encode("ascii") + _pdf_string("Total:") + b" Tj ET"
+        )
+        cell_text(ops, f"${total:.2f}", "F2", margin + label_w, y, amount_col, "0")
+        pages.append(ops)
+
+        streams = []
+        for n, page_ops in enumerate(pages, start=1):
+            if len(pages) > 1:
+                footer = f"Page {n} of {len(pages)}"
+                fx = page_w - margin - _pdf_text_width(footer, "F1", 8)
+                page_ops.append(
+                    f"BT 0.4 g /F1 8 Tf {fx:.2f} {margin - 4:.2f} Td ".encode("ascii") + _pdf_string(footer) + b" Tj ET"
+                )
+            streams.append(b"\n".join(page_ops))
+        return _pdf_write_document(streams, page_w, page_h)
     except Exception as e:
         logging.warning("Failed to build summary table PDF: %s", e)
         return None
 
 
-def _merge_pdf_bytes(pdf_blobs: list[bytes]) -> bytes:
+def _max_rss_bytes() -> int:
+    """Process high-water RSS, ru_maxrss (0 where the resource module is unavailable)."""
+    try:
+        import resource
+    except ImportError:
+        return 0
+    return int(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss) * 1024
+
+
+def _merge_pdf_blobs(pdf_blobs: list, *, report: Optional[dict] = None):
+    """
+    Merges PDFs (bytes or spooled temp files) into a SpooledTemporaryFile positioned at 0.
+    Output stays in memory up to PDF_MERGE_SPOOL_BYTES (default 16 MB), then rolls to temp storage.
+    Inputs are parsed lazily from their streams; content streams are Flate-compressed and
+    identical objects (fonts, images repeated across receipts) are written once.
+    Fills report["merge"] with sizes and the process RSS high-water mark when a dict is passed.
+    """
+    started = time.monotonic()
+    rss_before = _max_rss_bytes()
+    input_bytes = 0
     writer = PdfWriter()
     for blob in pdf_blobs:
-        reader = PdfReader(BytesIO(blob))
+        if isinstance(blob, (bytes, bytearray)):
+            stream = BytesIO(blob)
+        else:
+            blob.seek(0)
+            stream = blob
+        input_bytes += _blob_len(blob)
+        reader = PdfReader(stream)
         for page in reader.pages:
             writer.add_page(page)
-    out = BytesIO()
-    writer.write(out)
-    return out.getvalue()
 
+    for page in writer.pages:
+        try:
+            page.compress_content_streams()
+        except Exception as e:
+            # A malformed content stream is left as-is rather than failing the bundle.
+            logging.warning("PDF merge: could not compress page content stream: %s", e)
+    if hasattr(writer, "compress_identical_objects"):
+        writer.compress_identical_objects(remove_identicals=True, remove_orphans=True)
+
+    spool_max = _env_int("PDF_MERGE_SPOOL_BYTES", 16 * 1024 * 1024)
+    out = tempfile.SpooledTemporaryFile(max_size=spool_max)
+    try:
+        writer.write(out)
+    except BaseException:
+        out.close()
+        raise
+    output_bytes = out.tell()
+    out.seek(0)
+    if report is not None:
+        max_rss = _max_rss_bytes()
+        report["merge"] = {
+            "inputs": len(pdf_blobs),
+            "pages": len(writer.pages),
+            "inputBytes": input_bytes,
+            "outputBytes": output_bytes,
+            # SpooledTemporaryFile rolls over once its size exceeds max_size (0 = never).
+            "spooledToDisk": bool(spool_max) and output_bytes > spool_max,
+            # ru_maxrss is the process-lifetime high-water mark, not the merge's own peak: the
+            # growth is non-zero only when this merge pushed the process to a new maximum.
+            "processMaxRssBytes": max_rss,
+            "processMaxRssGrowthBytes": max(0, max_rss - rss_before),
+            "ms": int((time.monotonic() - started) * 1000),
+        }
+    return out
+
+
+# Longest edge (px) for receipt images embedded in the bundle PDF; keeps receipts readable.
+_RECEIPT_MAX_EDGE = 2000
+_RECEIPT_PDF_DPI = 150
+
+
+def _single_image_pdf(stream: bytes, width: int, height: int, image_entries: str) -> bytes:
+    """One-page PDF showing a single image XObject (already encoded) at _RECEIPT_PDF_DPI."""
+    page_w = width * 72.0 / _RECEIPT_PDF_DPI
+    page_h = height * 72.0 / _RECEIPT_PDF_DPI
+    content = f"q {page_w:.4f} 0 0 {page_h:.4f} 0 0 cm /Im0 Do Q".encode("ascii")
+    objects = [
+        b"<< /Type /Catalog /Pages 2 0 R >>",
+        b"<< /Type /Pages /Kids [3 0 R] /Count 1 >>",
+        f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 {page_w:.4f} {page_h:.4f}] "
+        f"/Resources << /XObject << /Im0 4 0 R >> >> /Contents 5 0 R >>".encode("ascii"),
+        _pdf_stream_object(
+            stream, f"/Type /XObject /Subtype /Image /Width {width} /Height {height} {image_entries}"
+        ),
+        _pdf_stream_object(content),
+    ]
+    return _pdf_serialize(objects)
 
-def _bytes_to_pdf(blob: bytes) -> tuple[bytes, Optional[str]]:
+
+def _jpeg_passthrough_pdf(blob: bytes, img: Image.Image, max_edge: int = _RECEIPT_MAX_EDGE) -> Optional[bytes]:
     """
-    Returns (pdf_bytes, error). Supports PDFs and common image formats.
-    Resizes large images to keep PDF attachments under email size limits.
+    Wraps an unmodified baseline/progressive JPEG as a single-page PDF (DCTDecode image XObject).
+    Returns None when the JPEG can't be embedded as-is (colour mode, size), so the caller re-encodes.
     """
-    _ext, ctype = _sniff_file_type(blob)
-    if ctype == "application/pdf":
-        return blob, None
-    if ctype in {"image/png", "image/jpeg"}:
-        try:
-            img = Image.open(BytesIO(blob))
+    if img.format != "JPEG" or img.mode not in {"L", "RGB"}:
+        return None
+    w, h = img.size
+    if w <= 0 or h <= 0 or max(w, h) > max_edge:
+        return None
+    colorspace = "/DeviceGray" if img.mode == "L" else "/DeviceRGB"
+    return _single_image_pdf(blob, w, h, f"/ColorSpace {colorspace} /BitsPerComponent 8 /Filter /DCTDecode")
 
-            if getattr(img, "mode", None) not in {"RGB"}:
-                img = img.convert("RGB")
 
-            # Resize large images to max 2000px on longest side (keeps receipts readable)
-            max_dim = 2000
-            if img.width > max_dim or img.height > max_dim:
-                ratio = min(max_dim / img.width, max_dim / img.height)
-                new_w = int(img.width * ratio)
-                new_h = int(img.height * ratio)
-                img = img.resize((new_w, new_h), Image.LANCZOS)
+def _bilevel_pdf(img: Image.Image) -> bytes:
+    """1-bit page: CCITT G4 via Pillow when libtiff is available, otherwise Flate-packed bits."""
+    if pil_features.check("libtiff"):
+        out = BytesIO()
+        img.save(out, format="PDF", resolution=_RECEIPT_PDF_DPI)
+        return out.getvalue()
+    # Mode "1" packs 8 pixels per byte MSB-first with 1 = white, matching 1-bit DeviceGray.
+    return _single_image_pdf(
+        zlib.compress(img.tobytes(), 9),
+        img.width,
+        img.height,
+        "/ColorSpace /DeviceGray /BitsPerComponent 1 /Filter /FlateDecode",
+    )
 
-            out = BytesIO()
-            img.save(out, format="PDF", resolution=150, quality=90)
-            pdf_bytes = out.getvalue()
-            if not pdf_bytes.startswith(b"%PDF-"):
-                return b"", "image-to-pdf conversion did not produce a PDF"
+
+def _payload_or_env_flag(payload: dict, key: str, env_name: str) -> bool:
+    """payload[key] when present, otherwise the env_name setting (default off)."""
+    v = payload.get(key)
+    if isinstance(v, bool):
+        return v
+    if isinstance(v, (int, float)):
+        return bool(v)
+    raw = v if isinstance(v, str) and v.strip() else os.getenv(env_name)
+    return (raw or "").strip().lower() in {"1", "true", "yes", "y"}
+
+
+def _receipt_compaction_enabled(payload: dict) -> bool:
+    """payload.compactReceipts, falling back to the RECEIPT_COMPACTION setting."""
+    return _payload_or_env_flag(payload, "compactReceipts", "RECEIPT_COMPACTION")
+
+
+# Longest edge of the analysis thumbnail used for cropping and bilevel detection.
+_COMPACT_PROBE_EDGE = 256
+
+
+def _compact_receipt_image(img: Image.Image) -> tuple[Image.Image, Optional[int]]:
+    """
+    Returns (grayscale_image, bilevel_threshold). Applies the EXIF orientation, crops to the
+    bright paper region (Otsu threshold + small erosion on a thumbnail) and converts to "L".
+    bilevel_threshold is set when the page is effectively black-and-white, so the caller can
+    store it as 1-bit after resizing.
+    """
+    img = ImageOps.exif_transpose(img)
+    gray = img.convert("L")
+
+    probe = gray.copy()
+    probe.thumbnail((_COMPACT_PROBE_EDGE, _COMPACT_PROBE_EDGE))
+    hist = probe.histogram()
+    total = sum(hist)
+    # Otsu: threshold maximising between-class variance.
+    sum_all = sum(i * c for i, c in enumerate(hist))
+    sum_bg = weight_bg = 0
+    best_var, threshold = -1.0, 128
+    for t in range(256):
+        weight_bg += hist[t]
+        if weight_bg == 0 or weight_bg == total:
+            continue
+        sum_bg += t * hist[t]
+        mean_bg = sum_bg / weight_bg
+        mean_fg = (sum_all - sum_bg) / (total - weight_bg)
+        var = weight_bg * (total - weight_bg) * (mean_bg - mean_fg) ** 2
+        if var > best_var:
+            best_var, threshold = var, t
+
+    # Paper bounds: bright pixels, eroded so specks on the desk don't widen the box.
+    mask = probe.point(lambda v: 255 if v > threshold else 0).filter(ImageFilter.MinFilter(5))
+    bbox = mask.getbbox()
+    if bbox:
+        sx = gray.width / probe.width
+        sy = gray.height / probe.height
+        left, top, right, bottom = bbox
+        # Pad by the erosion radius plus a pixel, then scale back to full resolution.
+        box = (
+            max(0, int((left - 3) * sx)),
+            max(0, int((top - 3) * sy)),
+            min(gray.width, int((right + 3) * sx)),
+            min(gray.height, int((bottom + 3) * sy)),
+        )
+        area = (box[2] - box[0]) * (box[3] - box[1])
+        # Only crop when it removes something and the region is plausibly the whole receipt.
+        if 0.2 * gray.width * gray.height <= area < 0.97 * gray.width * gray.height:
+            gray = gray.crop(box)
+            probe = probe.crop(bbox)
+            hist = probe.histogram()
+            total = sum(hist)
+
+    # Effectively bilevel when almost nothing sits in the mid-tones.
+    mid = sum(hist[64:192])
+    bilevel = threshold if total and mid / total < 0.04 else None
+    return gray, bilevel
+
+
+def _bytes_to_pdf(
+    blob: bytes, *, max_edge: int = _RECEIPT_MAX_EDGE, quality: Optional[int] = None, compact: bool = False
+) -> tuple[bytes, Optional[str]]:
+    """
+    Returns (pdf_bytes, error). Supports PDFs and common image formats.
+    JPEGs within max_edge are embedded as-is (no decode/re-encode) unless an explicit JPEG
+    quality is requested; larger images are decoded at reduced scale (JPEG draft mode /
+    reduce()) before the final resample.
+    compact=True applies EXIF orientation, crops to the paper and stores grayscale JPEG
+    (or 1-bit when the page is effectively black-and-white).
+    """
+    _ext, ctype = _sniff_file_type(blob)
+    if ctype == "application/pdf":
+        return blob, None
+    if ctype in {"image/png", "image/jpeg"}:
+        try:
+            # Image.open only parses headers; pixel data is decoded lazily on first access.
+            img = Image.open(BytesIO(blob))
+
+            if ctype == "image/jpeg" and quality is None and not compact:
+                passthrough = _jpeg_passthrough_pdf(blob, img, max_edge)
+                if passthrough is not None:
+                    return passthrough, None
+
+            # Resize large images to max_edge px on longest side (keeps receipts readable)
+            max_dim = max_edge
+            target = None
+            if img.width > max_dim or img.height > max_dim:
+                ratio = min(max_dim / img.width, max_dim / img.height)
+                target = (max(1, int(img.width * ratio)), max(1, int(img.height * ratio)))
+            if img.format == "JPEG" and (target or compact):
+                # Let libjpeg decode at 1/2, 1/4 or 1/8 scale (never below the target size), and
+                # straight to grayscale when compacting.
+                mode = "L" if compact else (img.mode if img.mode in {"L", "RGB"} else "RGB")
+                img.draft(mode, target or img.size)
+
+            bilevel = None
+            if compact:
+                img, bilevel = _compact_receipt_image(img)
+                # Orientation and crop change the geometry; re-derive the target size.
+                target = None
+                if img.width > max_dim or img.height > max_dim:
+                    ratio = min(max_dim / img.width, max_dim / img.height)
+                    target = (max(1, int(img.width * ratio)), max(1, int(img.height * ratio)))
+            elif getattr(img, "mode", None) not in {"RGB", "L"}:
+                img = img.convert("RGB")
+
+            if target and img.size != target:
+                # reducing_gap box-reduces by an integer factor (Image.reduce) before the LANCZOS pass.
+                img = img.resize(target, Image.LANCZOS, reducing_gap=2.0)
+
+            if bilevel is not None:
+                return _bilevel_pdf(img.point(lambda v: 255 if v > bilevel else 0, mode="1")), None
+
+            out = BytesIO()
+            img.save(out, format="PDF", resolution=_RECEIPT_PDF_DPI, quality=quality or 90)
+            pdf_bytes = out.getvalue()
+            if not pdf_bytes.startswith(b"%PDF-"):
+                return b"", "image-to-pdf conversion did not produce a PDF"
             return pdf_bytes, None
         except Exception as e:
             return b"", f"image-to-pdf conversion failed: {e}"
     return b"", "unsupported receipt type (only PDF/JPG/PNG supported)"
 
 
+# Converted receipt pages are cached by content: sha256(source) + conversion settings.
+# Bump the version when _bytes_to_pdf output changes so stale pages are not reused.
+_PAGE_CACHE_VERSION = 1
+_PAGE_CACHE_PREFIX = "converted/"
+_PAGE_CACHE: dict[str, bytes] = {}
+_PAGE_CACHE_BYTES = 0
+_PAGE_CACHE_LOCK = threading.Lock()
+
+
+def _page_cache_key(data: bytes, max_edge: int, quality: Optional[int], compact: bool) -> str:
+    digest = hashlib.sha256(data).hexdigest()
+    return f"{digest}-e{max_edge}-q{quality or 0}-{'c' if compact else 'n'}-v{_PAGE_CACHE_VERSION}"
+
+
+def _blob_cache_container(setting: str, label: str):
+    """
+    Container client for a cache's Blob tier (a prefix next to uploads/), or None when storage
+    isn't configured or the app setting named by `setting` is false.
+    """
+    if (os.getenv(setting) or "true").strip().lower() in {"0", "false", "no", "n"}:
+        return None
+    if not (os.getenv("RECEIPTS_STORAGE_CONNECTION_STRING") or os.getenv("RECEIPTS_STORAGE_ACCOUNT_URL") or "").strip():
+        return None
+    try:
+        return _receipts_container()
+    except Exception as e:
+        logging.warning("%s: blob tier unavailable: %s", label, e)
+        return None
+
+
+def _page_cache_container():
+    """Blob tier of the converted page cache (converted/); off with RECEIPT_PAGE_CACHE_BLOB=false."""
+    return _blob_cache_container("RECEIPT_PAGE_CACHE_BLOB", "Converted page cache")
+
+
+def _page_cache_get(key: str, container) -> Optional[bytes]:
+    with _PAGE_CACHE_LOCK:
+        hit = _PAGE_CACHE.pop(key, None)
+        if hit is not None:
+            _PAGE_CACHE[key] = hit  # most recently used goes last
+            return hit
+    if container is None:
+        return None
+    try:
+        pdf_bytes = container.download_blob(f"{_PAGE_CACHE_PREFIX}{key}.pdf").readall()
+    except Exception:
+        return None
+    if not pdf_bytes.startswith(b"%PDF-"):
+        return None
+    _page_cache_put(key, pdf_bytes, None)
+    return pdf_bytes
+
+
+def _page_cache_put(key: str, pdf_bytes: bytes, container) -> None:
+    """Local tier is an LRU bounded by RECEIPT_PAGE_CACHE_BYTES (default 64 MB; 0 disables)."""
+    global _PAGE_CACHE_BYTES
+    limit = _env_int("RECEIPT_PAGE_CACHE_BYTES", 64 * 1024 * 1024)
+    if 0 < len(pdf_bytes) <= limit:
+        with _PAGE_CACHE_LOCK:
+            old = _PAGE_CACHE.pop(key, None)
+            if old is not None:
+                _PAGE_CACHE_BYTES -= len(old)
+            while _PAGE_CACHE and _PAGE_CACHE_BYTES + len(pdf_bytes) > limit:
+                _PAGE_CACHE_BYTES -= len(_PAGE_CACHE.pop(next(iter(_PAGE_CACHE))))
+            _PAGE_CACHE[key] = pdf_bytes
+            _PAGE_CACHE_BYTES += len(pdf_bytes)
+    if container is not None:
+        try:
+            container.upload_blob(
+                name=f"{_PAGE_CACHE_PREFIX}{key}.pdf",
+                data=pdf_bytes,
+                overwrite=True,
+                content_settings=ContentSettings(content_type="application/pdf"),
+            )
+        except Exception as e:
+            logging.warning("Converted page cache: blob write failed for %s: %s", key, e)
+
+
+def _is_passthrough_jpeg(data: bytes, max_edge: int) -> bool:
+    """True when _bytes_to_pdf would embed the JPEG as-is (cheaper than a cache lookup)."""
+    if _sniff_file_type(data)[1] != "image/jpeg":
+        return False
+    try:
+        img = Image.open(BytesIO(data))
+    except Exception:
+        return False
+    return img.mode in {"L", "RGB"} and max(img.size) <= max_edge
+
+
+def _convert_receipts_to_pdfs(
+    blobs: list,
+    labels: list[str],
+    settings: Optional[list[tuple[int, Optional[int]]]] = None,
+    *,
+    compact: bool = False,
+    cache_stats: Optional[dict] = None,
+) -> tuple[list, Optional[str]]:
+    """
+    Returns (pdfs, error). Converts receipts with _bytes_to_pdf on a bounded thread pool
+    (RECEIPT_CONVERT_WORKERS, default min(4, cpu count)); Pillow decode/resample/encode and zlib
+    release the GIL, so pages convert in parallel. Results keep the input order, and the error
+    names the first failing receipt (labels[i] prefixes its message).
+    blobs may be bytes or spooled temp files; PDF inputs are passed through unchanged.
+    settings[i], when given, is the (max_edge, jpeg_quality) for blobs[i]; compact is passed
+    through to _bytes_to_pdf.
+    Converted pages are looked up in the content-addressed page cache (local LRU, then Blob
+    Storage) before converting; cache_stats counts hits/misses when given.
+    """
+    if not blobs:
+        return [], None
+
+    container = _page_cache_container()
+    stats_lock = threading.Lock()
+
+    def _count(field: str) -> None:
+        if cache_stats is not None:
+            with stats_lock:
+                cache_stats[field] = cache_stats.get(field, 0) + 1
+
+    def _convert(i: int) -> tuple[bytes, Optional[str]]:
+        blob = blobs[i]
+        if _blob_head(blob, 5) == b"%PDF-":
+            # Already a PDF: hand the original bytes/spooled file to the merge untouched.
+            return blob, None
+        max_edge, quality = settings[i] if settings else (_RECEIPT_MAX_EDGE, None)
+        data = _blob_bytes(blob)
+        if quality is None and not compact and _is_passthrough_jpeg(data, max_edge):
+            return _bytes_to_pdf(data, max_edge=max_edge)
+        key = _page_cache_key(data, max_edge, quality, compact)
+        cached = _page_cache_get(key, container)
+        if cached is not None:
+            _count("hits")
+            return cached, None
+        _count("misses")
+        pdf_b, err = _bytes_to_pdf(data, max_edge=max_edge, quality=quality, compact=compact)
+        if not err:
+            _page_cache_put(key, pdf_b, container)
+        return pdf_b, err
+
+    workers = max(1, min(len(blobs), _env_int("RECEIPT_CONVERT_WORKERS", min(4, os.cpu_count() or 1))))
+    if workers == 1:
+        results = [_convert(i) for i in range(len(blobs))]
+    else:
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            results = list(pool.map(_convert, range(len(blobs))))
+
+    pdfs: list = []
+    for i, (pdf_b, err) in enumerate(results):
+        if err:
+            label = labels[i] if i < len(labels) else f"receipt-{i+1}"
+            return [], f"{label} {err}"
+        pdfs.append(pdf_b)
+    return pdfs, None
+
+
+# Receipt image settings tried in order when a PDF bundle is over budget: (longest edge px,
+# JPEG quality). The first step is the default conversion (JPEG passthrough where possible);
+# the last is the floor that still keeps a receipt readable.
+_RECEIPT_QUALITY_LADDER: list[tuple[int, Optional[int]]] = [
+    (_RECEIPT_MAX_EDGE, None),
+    (1600, 80),
+    (1400, 70),
+    (1200, 60),
+    (1000, 50),
+]
+
+
+def _receipt_bundle_budget() -> int:
+    """
+    Byte budget for the receipts PDF: RECEIPT_BUNDLE_MAX_BYTES (default 25 MB, which stays under
+    Exchange Online's default 35 MB message limit after base64), capped by GRAPH_MAX_ATTACHMENT_BYTES.
+    """
+    graph_max = _env_int("GRAPH_MAX_ATTACHMENT_BYTES", _GRAPH_UPLOAD_SESSION_MAX_BYTES)
+    return max(1, min(graph_max, _env_int("RECEIPT_BUNDLE_MAX_BYTES", 25 * 1024 * 1024)))
+
+
+def _build_receipts_pdf(blobs: list, labels: list[str], payload: dict, *, report: Optional[dict] = None):
+    """
+    Returns (merged_pdf, error): summary page + receipts converted to PDF and merged.
+
+    When the bundle is over _receipt_bundle_budget(), image receipts step down
+    _RECEIPT_QUALITY_LADDER (lower resolution and JPEG quality), largest pages first, until it
+    fits or every image is at the floor. PDF receipts are kept as-is. The chosen settings are
+    written to report["budget"]. Image compaction follows _receipt_compaction_enabled(payload).
+    A bundle still over budget at the floor is an error (report["budget"]["overBudget"] is set).
+    """
+    summary_pdf = _build_summary_table_pdf(payload)
+    compact = _receipt_compaction_enabled(payload)
+    cache_stats: dict = {"hits": 0, "misses": 0}
+    converted, err = _convert_receipts_to_pdfs(blobs, labels, compact=compact, cache_stats=cache_stats)
+    if err:
+        return None, err
+
+    budget = _receipt_bundle_budget()
+    floor = len(_RECEIPT_QUALITY_LADDER) - 1
+    levels = [0] * len(blobs)
+    adjustable = [_blob_head(b, 5) != b"%PDF-" for b in blobs]
+    fixed_bytes = len(summary_pdf) if summary_pdf else 0
+    rounds = 0
+    while True:
+        sizes = [_blob_len(p) for p in converted]
+        estimate = fixed_bytes + sum(sizes)
+        merged = None
+        if estimate <= budget:
+            # Merging rarely grows the inputs (shared objects are de-duplicated), so only merge
+            # once the parts could fit.
+            merged = _merge_pdf_blobs(([summary_pdf] if summary_pdf else []) + converted, report=report)
+            if _blob_len(merged) <= budget:
+                break
+            excess = _blob_len(merged) - budget
+        else:
+            excess = estimate - budget
+
+        # Step down the largest pages until they cover about twice the excess (a step typically
+        # saves 30-60% of a page).
+        candidates = sorted(
+            (i for i in range(len(blobs)) if adjustable[i] and levels[i] < floor),
+            key=lambda i: sizes[i],
+            reverse=True,
+        )
+        picked: list[int] = []
+        covered = 0
+        for i in candidates:
+            picked.append(i)
+            covered += sizes[i]
+            if covered >= 2 * excess:
+                break
+        if not picked:
+            if merged is None:
+                merged = _merge_pdf_blobs(([summary_pdf] if summary_pdf else []) + converted, report=report)
+            break
+        if merged is not None:
+            merged.close()  # over budget; the next rung merges again
+            merged = None
+        for i in picked:
+            levels[i] += 1
+        redone, err = _convert_receipts_to_pdfs(
+            [blobs[i] for i in picked],
+            [labels[i] for i in picked],
+            [_RECEIPT_QUALITY_LADDER[levels[i]] for i in picked],
+            compact=compact,
+            cache_stats=cache_stats,
+        )
+        if err:
+            return None, err
+        for i, pdf_b in zip(picked, redone):
+            converted[i] = pdf_b
+        rounds += 1
+
+    bundle_bytes = _blob_len(merged)
+    if report is not None:
+        report["pageCache"] = cache_stats
+        report["budget"] = {
+            "budgetBytes": budget,
+            "bundleBytes": bundle_bytes,
+            "fits": bundle_bytes <= budget,
+            "overBudget": bundle_bytes > budget,
+            "rounds": rounds,
+            "compacted": compact,
+            "receipts": [
+                {
+                    "receipt": labels[i] if i < len(labels) else f"receipt-{i+1}",
+                    "pdfBytes": _blob_len(converted[i]),
+                    **(
+                        {
+                            "step": levels[i],
+                            "maxEdge": _RECEIPT_QUALITY_LADDER[levels[i]][0],
+                            "jpegQuality": _RECEIPT_QUALITY_LADDER[levels[i]][1],
+                        }
+                        if adjustable[i]
+                        else {"step": None, "source": "pdf"}
+                    ),
+                }
+                for i in range(len(blobs))
+            ],
+        }
+    if bundle_bytes > budget:
+        # Still over after the last rung (e.g. large PDF receipts, which are kept as-is): the
+        # message would bounce at the mailbox size limit, so fail here with the numbers.
+        merged.close()
+        return None, (
+            f"Receipts PDF is {bundle_bytes} bytes at the lowest quality step, over the {budget} byte "
+            "bundle budget (RECEIPT_BUNDLE_MAX_BYTES / GRAPH_MAX_ATTACHMENT_BYTES). "
+            "Split the report or remove large receipts."
+        )
+    return merged, None
+
+
+def _blob_sha256(blob) -> str:
+    if isinstance(blob, (bytes, bytearray)):
+        return hashlib.sha256(blob).hexdigest()
+    h = hashlib.sha256()
+    blob.seek(0)
+    for chunk in iter(lambda: blob.read(1024 * 1024), b""):
+        h.update(chunk)
+    blob.seek(0)
+    return h.hexdigest()
+
+
+def _receipt_dhash(data: bytes) -> Optional[int]:
+    """256-bit difference hash of an image (16x16 gradient signs on a grayscale thumbnail)."""
+    try:
+        img = Image.open(BytesIO(data))
+        img.draft("L", (128, 128))
+        img = ImageOps.exif_transpose(img).convert("L").resize((17, 16), Image.BILINEAR)
+    except Exception:
+        return None
+    px = img.tobytes()
+    bits = 0
+    for y in range(16):
+        row = px[y * 17 : (y + 1) * 17]
+        for x in range(16):
+            bits = (bits << 1) | (row[x] < row[x + 1])
+    return bits
+
+
+def _find_duplicate_receipts(
+    contents: list, names: list[str], payload: dict
+) -> tuple[list[int], list[dict], list[dict]]:
+    """
+    Returns (kept_indexes, removed, similar). Only exact duplicates (same sha256) are dropped;
+    the first occurrence is kept. With payload.reportNearDuplicateReceipts (or
+    RECEIPT_NEAR_DUPLICATES=true) images whose dHash differs by <= RECEIPT_NEAR_DUPLICATE_BITS
+    (default 12 of 256) from an earlier one are listed in similar but stay in the bundle: two
+    receipts from the same shop can hash that close. contents may be bytes or spooled temp files.
+    """
+    near = _payload_or_env_flag(payload, "reportNearDuplicateReceipts", "RECEIPT_NEAR_DUPLICATES")
+    max_bits = _env_int("RECEIPT_NEAR_DUPLICATE_BITS", 12)
+    first_by_hash: dict[str, int] = {}
+    kept_hashes: list[tuple[int, int]] = []
+    kept: list[int] = []
+    removed: list[dict] = []
+    similar: list[dict] = []
+
+    def _name(i: int) -> str:
+        return (names[i] if i < len(names) else "") or f"receipt-{i+1}"
+
+    for i, content in enumerate(contents):
+        digest = _blob_sha256(content)
+        if digest in first_by_hash:
+            removed.append({"name": _name(i), "duplicateOf": _name(first_by_hash[digest]), "match": "exact"})
+            continue
+        first_by_hash[digest] = i
+        if near and _blob_head(content, 5) != b"%PDF-":
+            dhash = _receipt_dhash(_blob_bytes(content))
+            if dhash is not None:
+                match = next(((j, (dhash ^ h).bit_count()) for j, h in kept_hashes if (dhash ^ h).bit_count() <= max_bits), None)
+                if match is not None:
+                    similar.append(
+                        {"name": _name(i), "similarTo": _name(match[0]), "match": "near", "distance": match[1]}
+                    )
+                kept_hashes.append((i, dhash))
+        kept.append(i)
+    return kept, removed, similar
+
+
+def _record_duplicates(report: Optional[dict], removed: list[dict], similar: list[dict]) -> None:
+    if removed:
+        logging.info("receipt bundle: dropped %s duplicate receipt(s)", len(removed))
+        if report is not None:
+            report.setdefault("duplicates", []).extend(removed)
+    if similar:
+        logging.info("receipt bundle: %s receipt(s) look like near duplicates (kept)", len(similar))
+        if report is not None:
+            report.setdefault("nearDuplicates", []).extend(similar)
+
+
+# Formats that are already entropy-coded; deflating them costs CPU and saves ~nothing.
+_ZIP_STORED_MAGIC = (
+    b"\xff\xd8\xff",  # JPEG
+    b"\x89PNG\r\n\x1a\n",
+    b"PK\x03\x04",  # ZIP/Office
+    b"GIF8",
+    b"RIFF",  # WEBP
+    b"\x1f\x8b",  # gzip
+)
+_ZIP_SAMPLE_BYTES = 64 * 1024
+
+
+def _zip_should_deflate(head: bytes) -> bool:
+    """Deflate only when a level-1 trial on the first 64 KB saves at least 10% (PDFs vary)."""
+    if not head or head.startswith(_ZIP_STORED_MAGIC):
+        return False
+    return len(zlib.compress(head, 1)) < 0.9 * len(head)
+
+
+def _write_receipts_zip(entries, *, report: Optional[dict] = None):
+    """
+    Writes (name, content) entries into a ZIP and returns it as a SpooledTemporaryFile at 0
+    (in memory up to ZIP_BUNDLE_SPOOL_BYTES, default 16 MB). content may be bytes or a file
+    object and is copied in 1 MB chunks. Callers pass receipts that are already downloaded
+    (duplicate detection needs every file first), so zipping does not overlap the downloads.
+    Already-compressed formats are STORED, the rest DEFLATED; zip64 is used for large entries.
+    Duplicate names get a -2, -3... suffix. Fills report["zip"] when a dict is passed.
+    """
+    out = tempfile.SpooledTemporaryFile(max_size=_env_int("ZIP_BUNDLE_SPOOL_BYTES", 16 * 1024 * 1024))
+    stats = {"entries": 0, "stored": 0, "deflated": 0, "inputBytes": 0}
+    seen: set[str] = set()
+    with zipfile.ZipFile(out, "w", allowZip64=True) as zf:
+        for name, content in entries:
+            base, dot, ext = name.rpartition(".")
+            if not dot:
+                base, ext = name, ""
+            unique, n = name, 1
+            while unique.lower() in seen:
+                n += 1
+                unique = f"{base}-{n}.{ext}" if ext else f"{base}-{n}"
+            seen.add(unique.lower())
+
+            size = _blob_len(content)
+            deflate = _zip_should_deflate(_blob_head(content, _ZIP_SAMPLE_BYTES))
+            info = zipfile.ZipInfo(unique, date_time=time.localtime(time.time())[:6])
+            info.compress_type = zipfile.ZIP_DEFLATED if deflate else zipfile.ZIP_STORED
+            info.file_size = size
+            with zf.open(info, "w", force_zip64=size >= zipfile.ZIP64_LIMIT) as dest:
+                if isinstance(content, (bytes, bytearray, memoryview)):
+                    dest.write(content)
+                else:
+                    content.seek(0)
+                    shutil.copyfileobj(content, dest, 1024 * 1024)
+
+            stats["entries"] += 1
+            stats["deflated" if deflate else "stored"] += 1
+            stats["inputBytes"] += size
+    stats["outputBytes"] = out.tell()
+    out.seek(0)
+    if report is not None:
+        report["zip"] = stats
+    return out
+
+
 def _receipt_bundle_format(payload: dict) -> str:
     """
     Returns 'pdf' or 'zip'.
@@ -1888,26 +3427,63 @@ def _foundry_get_access_token() -> str:
     return DefaultAzureCredential().get_token("https://ai.azure.com/.default").token
 
 
+_BLOB_CLIENT: Optional[tuple[str, BlobServiceClient]] = None
+_BLOB_CLIENT_LOCK = threading.Lock()
+_CONTAINER_READY: set[str] = set()
+
+
 def _blob_service_client() -> BlobServiceClient:
     """
     Uses either a connection string (preferred for simplicity) or Managed Identity.
     Configure one of:
       - RECEIPTS_STORAGE_CONNECTION_STRING
       - RECEIPTS_STORAGE_ACCOUNT_URL (e.g., https://<acct>.blob.core.windows.net)
+    The client (and its connection pool / credential token cache) is reused for the process.
     """
+    global _BLOB_CLIENT
     conn = (os.getenv("RECEIPTS_STORAGE_CONNECTION_STRING") or "").strip()
-    if conn:
-        return BlobServiceClient.from_connection_string(conn)
     account_url = (os.getenv("RECEIPTS_STORAGE_ACCOUNT_URL") or "").strip()
-    if not account_url:
-        raise RuntimeError("RECEIPTS_STORAGE_ACCOUNT_URL (or RECEIPTS_STORAGE_CONNECTION_STRING) is not configured")
-    return BlobServiceClient(account_url=account_url, credential=DefaultAzureCredential())
+    config = conn or account_url
+    cached = _BLOB_CLIENT
+    if cached is not None and cached[0] == config:
+        return cached[1]
+    with _BLOB_CLIENT_LOCK:
+        if _BLOB_CLIENT is not None and _BLOB_CLIENT[0] == config:
+            return _BLOB_CLIENT[1]
+        if conn:
+            client = BlobServiceClient.from_connection_string(conn)
+        elif account_url:
+            client = BlobServiceClient(account_url=account_url, credential=DefaultAzureCredential())
+        else:
+            raise RuntimeError("RECEIPTS_STORAGE_ACCOUNT_URL (or RECEIPTS_STORAGE_CONNECTION_STRING) is not configured")
+        _BLOB_CLIENT = (config, client)
+        return client
 
 
 def _receipt_container_name() -> str:
     return (os.getenv("RECEIPTS_CONTAINER") or "travel-expense-receipts").strip() or "travel-expense-receipts"
 
 
+def _receipts_container(*, ensure: bool = False):
+    """
+    Container client for the receipts container. ensure=True creates it on first use per process
+    (later calls skip the round-trip); call _forget_receipts_container if a write hits 404.
+    """
+    name = _receipt_container_name()
+    container = _blob_service_client().get_container_client(name)
+    if ensure and name not in _CONTAINER_READY:
+        try:
+            container.create_container()
+        except ResourceExistsError:
+            pass
+        _CONTAINER_READY.add(name)
+    return container
+
+
+def _forget_receipts_container() -> None:
+    _CONTAINER_READY.discard(_receipt_container_name())
+
+
 def _new_upload_id() -> str:
     # URL-safe, human-pastable id
     import secrets
@@ -1919,6 +3495,183 @@ def _upload_prefix(upload_id: str) -> str:
     return f"uploads/{upload_id.strip().replace('..','')}/"
 
 
+def _upload_blob_name(upload_id: str, filename: str) -> str:
+    return _upload_prefix(upload_id) + filename.replace("\\", "/").split("/")[-1]
+
+
+_UPLOAD_MANIFEST = "manifest.json"
+
+
+def _upload_manifest_name(upload_id: str) -> str:
+    return _upload_prefix(upload_id) + _UPLOAD_MANIFEST
+
+
+def _is_upload_manifest(blob_name: str) -> bool:
+    return blob_name.rsplit("/", 1)[-1] == _UPLOAD_MANIFEST
+
+
+def _read_upload_manifest(container, upload_id: str) -> tuple[Optional[dict], Optional[str]]:
+    """Returns (manifest, etag), or (None, None) when the upload has no manifest."""
+    try:
+        downloader = container.download_blob(_upload_manifest_name(upload_id))
+        manifest = json.loads(downloader.readall())
+    except ResourceNotFoundError:
+        return None, None
+    if not isinstance(manifest, dict) or not isinstance(manifest.get("files"), list):
+        return None, None
+    return manifest, downloader.properties.etag
+
+
+def _record_upload_manifest(container, upload_id: str, entries: list[dict]) -> list[dict]:
+    """
+    Adds/replaces file entries in uploads/{id}/manifest.json and returns them as recorded.
+    Concurrent uploads to the same id are serialized with ETag conditions (If-Match /
+    If-None-Match) and a short retry loop. A re-recorded filename keeps its original position.
+    Entries are {"status": "pending"} while a direct (SAS) upload is outstanding and
+    {"status": "complete", size, contentType, ...} once the file is in place.
+    """
+    name = _upload_manifest_name(upload_id)
+    for attempt in range(8):
+        manifest, etag = _read_upload_manifest(container, upload_id)
+        if manifest is None:
+            manifest = {"uploadId": upload_id, "files": []}
+        files = [f for f in manifest["files"] if isinstance(f, dict)]
+        rows = []
+        for entry in entries:
+            previous = next((f for f in files if f.get("filename") == entry["filename"]), None)
+            if previous is not None:
+                row = dict(entry, order=previous.get("order", 0))
+                files = [row if f is previous else f for f in files]
+            else:
+                row = dict(entry, order=max((int(f.get("order") or 0) for f in files), default=-1) + 1)
+                files.append(row)
+            rows.append(row)
+        manifest["files"] = sorted(files, key=lambda f: int(f.get("order") or 0))
+        manifest["updatedAt"] = datetime.now(timezone.utc).isoformat()
+        data = json.dumps(manifest).encode("utf-8")
+        settings = ContentSettings(content_type="application/json")
+        try:
+            if etag:
+                container.upload_blob(
+                    name=name,
+                    data=data,
+                    overwrite=True,
+                    etag=etag,
+                    match_condition=MatchConditions.IfNotModified,
+                    content_settings=settings,
+                )
+            else:
+                container.upload_blob(name=name, data=data, overwrite=False, content_settings=settings)
+            return rows
+        except (ResourceModifiedError, ResourceExistsError):
+            time.sleep(0.05 * (attempt + 1) + random.random() * 0.05)
+    raise RuntimeError(f"manifest update for upload id '{upload_id}' kept conflicting")
+
+
+def _pending_manifest_entry(blob_name: str) -> dict:
+    return {
+        "filename": blob_name.rsplit("/", 1)[-1],
+        "blob": blob_name,
+        "status": "pending",
+        "issuedAt": datetime.now(timezone.utc).isoformat(),
+    }
+
+
+def _upload_entries(container, upload_id: str) -> list[dict]:
+    """
+    Files in an upload, in upload order, as manifest entries (blob, filename, contentType, size,
+    sha256, order). The manifest is the source of truth: one small read, no listing.
+    A prefix listing is only made when there is no manifest (older uploads) or some entry is still
+    "pending" (a SAS was issued but receipt-upload-complete never arrived). Then manifest entries
+    keep their order (dropped if the blob is absent, reduced to blob/filename/size if pending or
+    changed), and unrecorded blobs follow in listing order.
+    """
+    manifest, _etag = _read_upload_manifest(container, upload_id)
+    files = [f for f in (manifest or {}).get("files", []) if isinstance(f, dict) and f.get("blob")]
+    if manifest is not None and not any(f.get("status") == "pending" for f in files):
+        return files
+
+    listed: dict[str, int] = {}
+    for b in container.list_blobs(name_starts_with=_upload_prefix(upload_id)):
+        blob_name = str(b.name or "")
+        if not _is_upload_manifest(blob_name):
+            listed[blob_name] = b.size
+
+    def _listed_entry(blob_name: str, order: int) -> dict:
+        return {"blob": blob_name, "filename": blob_name.rsplit("/", 1)[-1], "size": listed[blob_name], "order": order}
+
+    out: list[dict] = []
+    for f in files:
+        if f["blob"] not in listed or any(e["blob"] == f["blob"] for e in out):
+            continue
+        recorded = f.get("status") != "pending" and listed[f["blob"]] == f.get("size")
+        out.append(f if recorded else _listed_entry(f["blob"], len(out)))
+    seen = {e["blob"] for e in out}
+    extra = [name for name in listed if name not in seen]
+    if manifest is not None and extra:
+        logging.info("upload %s: %d file(s) missing from the manifest", upload_id, len(extra))
+    out.extend(_listed_entry(name, len(out) + n) for n, name in enumerate(extra))
+    return out
+
+
+def _manifest_entry(blob_name: str, data: bytes, content_type: str) -> dict:
+    return {
+        "filename": blob_name.rsplit("/", 1)[-1],
+        "blob": blob_name,
+        "contentType": content_type,
+        "size": len(data),
+        "sha256": hashlib.sha256(data).hexdigest(),
+        "status": "complete",
+        "uploadedAt": datetime.now(timezone.utc).isoformat(),
+    }
+
+
+_SHA256_HEX = re.compile(r"^[0-9a-f]{64}$")
+
+
+_USER_DELEGATION_KEY: Optional[tuple[datetime, object]] = None
+_USER_DELEGATION_LOCK = threading.Lock()
+
+
+def _receipt_upload_sas_enabled() -> bool:
+    return (os.getenv("RECEIPT_UPLOAD_SAS_ENABLED") or "").strip().lower() in {"1", "true", "yes", "y"}
+
+
+def _receipt_upload_sas_url(bsc: BlobServiceClient, blob_name: str) -> tuple[str, datetime]:
+    """
+    Returns (url, expires_on) for a SAS that can only create/write this one blob, valid for
+    RECEIPT_UPLOAD_SAS_MINUTES (default 15). Uses the account key with a connection string, or a
+    cached user delegation key under Managed Identity (needs Storage Blob Delegator).
+    """
+    global _USER_DELEGATION_KEY
+    now = datetime.now(timezone.utc)
+    start = now - timedelta(minutes=5)  # clock skew
+    expiry = now + timedelta(minutes=max(1, _env_int("RECEIPT_UPLOAD_SAS_MINUTES", 15)))
+    container = _receipt_container_name()
+    sas_kwargs = {
+        "account_name": bsc.account_name,
+        "container_name": container,
+        "blob_name": blob_name,
+        # Write-only: the page gets the uncommitted block list for resume from receipt-upload-blocks.
+        "permission": BlobSasPermissions(create=True, write=True),
+        "start": start,
+        "expiry": expiry,
+    }
+    account_key = getattr(bsc.credential, "account_key", None)
+    if account_key:
+        sas = generate_blob_sas(account_key=account_key, **sas_kwargs)
+    else:
+        with _USER_DELEGATION_LOCK:
+            cached = _USER_DELEGATION_KEY
+            if cached is None or cached[0] - now < timedelta(minutes=30):
+                key_expiry = now + timedelta(hours=6)
+                cached = (key_expiry, bsc.get_user_delegation_key(start, key_expiry))
+                _USER_DELEGATION_KEY = cached
+        sas = generate_blob_sas(user_delegation_key=cached[1], **sas_kwargs)
+    blob_url = bsc.get_blob_client(container, blob_name).url
+    return f"{blob_url}?{sas}", expiry
+
+
 def _sniff_extension_for_name(data: bytes, fallback_name: str) -> str:
     ext, _ = _sniff_file_type(data)
     if ext:
@@ -1930,26 +3683,40 @@ def _sniff_extension_for_name(data: bytes, fallback_name: str) -> str:
     return "bin"
 
 
-def _download_receipts_from_blob(upload_id: str) -> tuple[list[bytes], list[str], Optional[str]]:
+def _download_receipts_from_blob(
+    upload_id: str, *, concurrency: Optional[int] = None
+) -> tuple[list[bytes], list[str], Optional[str]]:
     """
     Returns (bytes_list, filenames, error).
+    concurrency caps the blob connections this call opens (default RECEIPT_BLOB_DOWNLOAD_CONCURRENCY).
     """
     if not upload_id or not str(upload_id).strip():
         return [], [], "receiptUploadId is required"
     try:
-        bsc = _blob_service_client()
-        container = bsc.get_container_client(_receipt_container_name())
-        prefix = _upload_prefix(str(upload_id))
-        blobs = list(container.list_blobs(name_starts_with=prefix))
-        if not blobs:
+        container = _receipts_container()
+        # Manifest order and metadata (reconciled with the listing); empty files are skipped before any download.
+        entries = [e for e in _upload_entries(container, str(upload_id)) if e.get("size") != 0]
+        if not entries:
             return [], [], f"No receipts found for upload id '{upload_id}'"
 
+        # Files download concurrently; whatever the file pool leaves of the connection budget
+        # goes to ranged parallel GETs per blob (a single large file gets all of it), so files x
+        # ranges never exceeds the budget or the client's connection pool. Upload order is kept.
+        names = [str(e["blob"]) for e in entries]
+        budget = max(1, concurrency or _env_int("RECEIPT_BLOB_DOWNLOAD_CONCURRENCY", 4))
+        workers = max(1, min(len(names), budget))
+        ranges = max(1, budget // workers)
+
+        def _fetch(name: str) -> bytes:
+            return container.download_blob(name, max_concurrency=ranges).readall()
+
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            contents = list(pool.map(_fetch, names))
+
         downloaded: list[bytes] = []
         filenames: list[str] = []
-        for b in blobs:
-            name = str(b.name or "")
+        for name, content in zip(names, contents):
             fn = name.split("/")[-1] if "/" in name else name
-            content = container.download_blob(name).readall()
             if not content:
                 continue
             downloaded.append(content)
@@ -1962,79 +3729,338 @@ def _download_receipts_from_blob(upload_id: str) -> tuple[list[bytes], list[str]
         return [], [], f"Failed to download receipts from blob storage: {e}"
 
 
-def _bundle_blobs_as_attachment(*, blobs: list[bytes], filenames: list[str], payload: dict) -> tuple[list[dict], int, bool, Optional[str]]:
+def _bundle_blobs_as_attachment(
+    *, blobs: list, filenames: list[str], payload: dict, report: Optional[dict] = None
+) -> tuple[list[dict], int, bool, Optional[str]]:
     """
     Returns (attachments, raw_bytes, bundled, error).
+    blobs may be bytes or spooled temp files (see _download_receipts_from_sharepoint).
+    Exact duplicate receipts are dropped first; near duplicates are only reported.
+    Bundle stats (merge size/memory, duplicates) are written into report when given.
     """
     if not blobs:
         return [], 0, False, "No receipt bytes provided to bundle"
     bundle_format = _receipt_bundle_format(payload)
+    kept, removed, similar = _find_duplicate_receipts(blobs, filenames, payload)
+    _record_duplicates(report, removed, similar)
+    filenames = [(filenames[i] if i < len(filenames) else "") or f"receipt-{i+1}" for i in kept]
+    blobs = [blobs[i] for i in kept]
 
     if bundle_format == "pdf":
-        pdfs: list[bytes] = []
-        # Prepend summary table page
-        summary_pdf = _build_summary_table_pdf(payload)
-        if summary_pdf:
-            pdfs.append(summary_pdf)
-        for i, b in enumerate(blobs):
-            pdf_b, err = _bytes_to_pdf(b)
-            if err:
-                name = filenames[i] if i < len(filenames) else f"receipt-{i+1}"
-                return [], 0, False, f"receipt '{name}' {err}"
-            pdfs.append(pdf_b)
-        merged = _merge_pdf_bytes(pdfs)
+        names = [(filenames[i] if i < len(filenames) else "") or f"receipt-{i+1}" for i in range(len(blobs))]
+        merged, err = _build_receipts_pdf(blobs, [f"receipt '{name}'" for name in names], payload, report=report)
+        if err:
+            return [], 0, False, err
         pdf_name = (payload.get("receiptPdfName") or "receipts.pdf").strip() or "receipts.pdf"
         if not pdf_name.lower().endswith(".pdf"):
             pdf_name = f"{pdf_name}.pdf"
         return (
-            [
-                {
-                    "@odata.type": "#microsoft.graph.fileAttachment",
-                    "name": pdf_name,
-                    "contentType": "application/pdf",
-                    "contentBytes": base64.b64encode(merged).decode("ascii"),
-                }
-            ],
-            len(merged),
+            [_file_attachment(pdf_name, "application/pdf", merged)],
+            _blob_len(merged),
             True,
             None,
         )
 
     zip_name = (payload.get("receiptZipName") or "receipts.zip").strip() or "receipts.zip"
-    zip_buf = BytesIO()
-    with zipfile.ZipFile(zip_buf, "w", compression=zipfile.ZIP_DEFLATED) as zf:
-        for i, content in enumerate(blobs):
-            name = filenames[i] if i < len(filenames) else f"receipt-{i+1}"
-            if not name:
-                name = f"receipt-{i+1}"
-            zf.writestr(name, content)
-    zip_bytes = zip_buf.getvalue()
-    if len(zip_bytes) == 0:
+    zip_file = _write_receipts_zip(
+        (((filenames[i] if i < len(filenames) else "") or f"receipt-{i+1}", content) for i, content in enumerate(blobs)),
+        report=report,
+    )
+    zip_size = _blob_len(zip_file)
+    if zip_size == 0:
         return [], 0, False, "Generated receipts.zip was empty"
     return (
-        [
-            {
-                "@odata.type": "#microsoft.graph.fileAttachment",
-                "name": zip_name,
-                "contentType": "application/zip",
-                "contentBytes": base64.b64encode(zip_bytes).decode("ascii"),
-            }
-        ],
-        len(zip_bytes),
+        [_file_attachment(zip_name, "application/zip", zip_file)],
+        zip_size,
         True,
         None,
     )
 
 
-# Receipt upload is a human-facing fallback page; keep it ANONYMOUS so users can access it
-# without embedding a function key into client-side JavaScript.
-@app.route(route="receipt-upload-init", methods=["POST"], auth_level=func.AuthLevel.ANONYMOUS)
-def receipt_upload_init(req: func.HttpRequest) -> func.HttpResponse:
+_THUMBNAIL_PREFIX = "thumbnails/"
+
+
+def _thumbnail_blob_name(upload_blob_name: str) -> str:
+    """uploads/{uploadId}/{name} -> thumbnails/{uploadId}/{name} (outside uploads/ so it doesn't trigger)."""
+    rel = upload_blob_name.split("/", 1)[1] if upload_blob_name.startswith("uploads/") else upload_blob_name
+    return f"{_THUMBNAIL_PREFIX}{rel}"
+
+
+def _pdf_first_page_image(data: bytes) -> Optional[Image.Image]:
+    """
+    Largest raster image on the first PDF page (scans, phone captures and our own passthrough
+    pages are one image per page). There is no PDF renderer in the build, so text-only PDFs get None.
+    """
+    try:
+        page = PdfReader(BytesIO(data)).pages[0]
+        best = None
+        for img_file in page.images:
+            img = img_file.image
+            if img is not None and (best is None or img.width * img.height > best.width * best.height):
+                best = img
+        return best
+    except Exception:
+        return None
+
+
+def _pdf_placeholder_thumbnail(edge: int) -> Image.Image:
+    w, h = int(edge * 0.77), edge  # Letter aspect
+    img = Image.new("RGB", (w, h), (245, 245, 245))
+    draw = ImageDraw.Draw(img)
+    draw.rectangle((0, 0, w - 1, h - 1), outline=(190, 190, 190))
+    draw.text((w // 2, h // 2), "PDF", fill=(120, 120, 120), anchor="mm")
+    return img
+
+
+def _render_thumbnail(data: bytes) -> tuple[Optional[bytes], Optional[str]]:
+    """
+    Returns (thumbnail bytes, content type): WebP when Pillow has it, else JPEG, longest edge
+    RECEIPT_THUMBNAIL_EDGE (default 320). PDFs use the first page's image. (None, None) for
+    anything that isn't a receipt image/PDF.
+    """
+    edge = max(64, _env_int("RECEIPT_THUMBNAIL_EDGE", 320))
+    _ext, ctype = _sniff_file_type(data)
+    if ctype == "application/pdf":
+        img = _pdf_first_page_image(data) or _pdf_placeholder_thumbnail(edge)
+    elif ctype in {"image/png", "image/jpeg"}:
+        img = Image.open(BytesIO(data))
+        img.draft("RGB", (edge, edge))  # JPEG: decode at 1/2..1/8 scale
+        img = ImageOps.exif_transpose(img)
+    else:
+        return None, None
+    if img.mode not in ("RGB", "L"):
+        img = img.convert("RGBA")
+        flat = Image.new("RGB", img.size, (255, 255, 255))
+        flat.paste(img, mask=img.getchannel("A"))
+        img = flat
+    img.thumbnail((edge, edge), Image.LANCZOS, reducing_gap=2.0)
+    out = BytesIO()
+    if pil_features.check("webp"):
+        img.save(out, format="WEBP", quality=70, method=4)
+        return out.getvalue(), "image/webp"
+    img.save(out, format="JPEG", quality=75, optimize=True)
+    return out.getvalue(), "image/jpeg"
+
+
+def _store_thumbnail(container, upload_blob_name: str, data: bytes) -> Optional[str]:
+    """Renders and stores the thumbnail for one upload. Best-effort; returns the thumbnail blob name."""
+    try:
+        thumb, ctype = _render_thumbnail(data)
+        if not thumb:
+            return None
+        name = _thumbnail_blob_name(upload_blob_name)
+        container.upload_blob(
+            name=name,
+            data=thumb,
+            overwrite=True,
+            content_settings=ContentSettings(content_type=ctype),
+        )
+        return name
+    except Exception as e:
+        logging.warning("receipt thumbnail failed for %s: %s", upload_blob_name, e)
+        return None
+
+
+_BLOB_DELETE_BATCH = 256  # Blob Batch API limit per request
+
+
+def _upload_artifact_prefixes(upload_id: str) -> list[str]:
+    """Everything stored for one upload id: the files (+ manifest), upload-time records, thumbnails."""
+    rel = _upload_prefix(upload_id).split("/", 1)[1]
+    return [_upload_prefix(upload_id), f"{_PROCESSED_PREFIX}{rel}", f"{_THUMBNAIL_PREFIX}{rel}"]
+
+
+def _delete_blobs_batched(container, names: list[str]) -> tuple[set[str], list[str]]:
+    """
+    Deletes blobs through the Blob Batch API, 256 per request. Blobs that are already gone count
+    as deleted. Returns (deleted names, errors).
+    """
+    deleted: set[str] = set()
+    errors: list[str] = []
+    for i in range(0, len(names), _BLOB_DELETE_BATCH):
+        chunk = names[i : i + _BLOB_DELETE_BATCH]
+        try:
+            responses = list(container.delete_blobs(*chunk, raise_on_any_failure=False))
+        except Exception as e:
+            errors.append(f"batch of {len(chunk)} failed: {e}")
+            continue
+        for name, resp in zip(chunk, responses):
+            if resp.status_code in (202, 404):
+                deleted.add(name)
+            else:
+                errors.append(f"'{name}' (HTTP {resp.status_code})")
+    return deleted, errors
+
+
+def _purge_uploads(container, upload_ids: list[str]) -> dict:
+    """
+    Deletes all blobs of the given upload ids. Returns {"uploadIds", "blobs", "bytes", "errors"},
+    where blobs/bytes are what was actually reclaimed.
+    """
+    listed: list[tuple[str, int]] = []
+    for uid in upload_ids:
+        for prefix in _upload_artifact_prefixes(uid):
+            listed.extend((str(b.name), int(b.size or 0)) for b in container.list_blobs(name_starts_with=prefix))
+    deleted, errors = _delete_blobs_batched(container, [name for name, _size in listed])
+    reclaimed = sum(size for name, size in listed if name in deleted)
+    return {"uploadIds": list(upload_ids), "blobs": len(deleted), "bytes": reclaimed, "errors": errors}
+
+
+# Receipt upload is a human-facing fallback page; keep it ANONYMOUS so users can access it
+# without embedding a function key into client-side JavaScript.
+@app.route(route="receipt-upload-init", methods=["POST"], auth_level=func.AuthLevel.ANONYMOUS)
+def receipt_upload_init(req: func.HttpRequest) -> func.HttpResponse:
+    """
+    Returns an upload id the user can paste back into chat.
+
+    With RECEIPT_UPLOAD_SAS_ENABLED=true and a JSON body {"files": ["a.jpg", ...]} (optionally
+    with an existing "uploadId"), also returns short-lived, blob-scoped SAS URLs so the page
+    uploads straight to Blob Storage:
+      {"uploadId", "uploads": [{"filename", "blob", "url", "expiresOn"}]}
+    The storage account needs a CORS rule allowing PUT from the page origin.
+    """
+    try:
+        body = req.get_json() if req.get_body() else {}
+    except ValueError:
+        body = {}
+    if not isinstance(body, dict):
+        body = {}
+    existing = str(body.get("uploadId") or "").strip()
+    upload_id = existing if existing.startswith("up_") else _new_upload_id()
+    out: dict = {"uploadId": upload_id}
+    files = body.get("files")
+    if _receipt_upload_sas_enabled() and isinstance(files, list) and files:
+        try:
+            bsc = _blob_service_client()
+            # Direct uploads can't create the container themselves.
+            _receipts_container(ensure=True)
+            uploads = []
+            for fn in files[:_env_int("RECEIPT_UPLOAD_MAX_FILES", 50)]:
+                filename = str(fn or "").strip() or "receipt"
+                blob_name = _upload_blob_name(upload_id, filename)
+                if _is_upload_manifest(blob_name):
+                    continue
+                url, expires_on = _receipt_upload_sas_url(bsc, blob_name)
+                uploads.append(
+                    {"filename": filename, "blob": blob_name, "url": url, "expiresOn": expires_on.isoformat()}
+                )
+            # Pending until receipt-upload-complete; readers list the prefix while any are pending.
+            _record_upload_manifest(
+                _receipts_container(), upload_id, [_pending_manifest_entry(u["blob"]) for u in uploads]
+            )
+            out["uploads"] = uploads
+        except Exception as e:
+            # The page falls back to PUT receipt-upload-file when no SAS URLs come back.
+            logging.warning("receipt-upload-init: SAS issue failed: %s", e)
+            out["sasError"] = str(e)
+    return func.HttpResponse(json.dumps(out), mimetype="application/json")
+
+
+@app.route(route="receipt-upload-sas", methods=["GET"], auth_level=func.AuthLevel.ANONYMOUS)
+def receipt_upload_sas(req: func.HttpRequest) -> func.HttpResponse:
+    """
+    Re-issues the SAS URL for one file of an upload (e.g. after the first one expired mid-upload).
+    Query params:
+      - uploadId
+      - filename
+    """
+    if not _receipt_upload_sas_enabled():
+        return func.HttpResponse(
+            json.dumps({"error": "direct uploads are disabled (RECEIPT_UPLOAD_SAS_ENABLED is not true)"}),
+            status_code=404,
+            mimetype="application/json",
+        )
+    upload_id = (req.params.get("uploadId") or "").strip()
+    filename = (req.params.get("filename") or "").strip() or "receipt"
+    if not upload_id.startswith("up_"):
+        return func.HttpResponse(json.dumps({"error": "uploadId is required"}), status_code=400, mimetype="application/json")
+    blob_name = _upload_blob_name(upload_id, filename)
+    if _is_upload_manifest(blob_name):
+        return func.HttpResponse(json.dumps({"error": "reserved filename"}), status_code=400, mimetype="application/json")
+    try:
+        url, expires_on = _receipt_upload_sas_url(_blob_service_client(), blob_name)
+        # The blob may be rewritten with this SAS, so its manifest entry is pending again.
+        _record_upload_manifest(_receipts_container(), upload_id, [_pending_manifest_entry(blob_name)])
+        return func.HttpResponse(
+            json.dumps({"uploadId": upload_id, "filename": filename, "blob": blob_name, "url": url, "expiresOn": expires_on.isoformat()}),
+            mimetype="application/json",
+        )
+    except Exception as e:
+        return func.HttpResponse(json.dumps({"error": f"SAS issue failed: {e}"}), status_code=500, mimetype="application/json")
+
+
+@app.route(route="receipt-upload-blocks", methods=["GET"], auth_level=func.AuthLevel.ANONYMOUS)
+def receipt_upload_blocks(req: func.HttpRequest) -> func.HttpResponse:
+    """
+    Uncommitted blocks already staged for one file of a direct (SAS) upload, so the page can
+    resume without the SAS granting read access. Returns {"blocks": [{"id", "size"}]}.
+    Query params:
+      - uploadId
+      - filename
+    """
+    if not _receipt_upload_sas_enabled():
+        return func.HttpResponse(
+            json.dumps({"error": "direct uploads are disabled (RECEIPT_UPLOAD_SAS_ENABLED is not true)"}),
+            status_code=404,
+            mimetype="application/json",
+        )
+    upload_id = (req.params.get("uploadId") or "").strip()
+    filename = (req.params.get("filename") or "").strip() or "receipt"
+    if not upload_id.startswith("up_"):
+        return func.HttpResponse(json.dumps({"error": "uploadId is required"}), status_code=400, mimetype="application/json")
+    blob_name = _upload_blob_name(upload_id, filename)
+    try:
+        _committed, uncommitted = _receipts_container().get_blob_client(blob_name).get_block_list("uncommitted")
+        # The SDK hands back decoded ids; the page compares the base64 form it sent.
+        blocks = [{"id": base64.b64encode(str(b.id).encode("utf-8")).decode("ascii"), "size": b.size} for b in uncommitted]
+    except ResourceNotFoundError:
+        blocks = []
+    except Exception as e:
+        return func.HttpResponse(json.dumps({"error": f"block list failed: {e}"}), status_code=500, mimetype="application/json")
+    return func.HttpResponse(json.dumps({"blocks": blocks}), mimetype="application/json")
+
+
+@app.route(route="receipt-upload-complete", methods=["POST"], auth_level=func.AuthLevel.ANONYMOUS)
+def receipt_upload_complete(req: func.HttpRequest) -> func.HttpResponse:
     """
-    Returns an upload id the user can paste back into chat.
+    Records a file the page uploaded directly (SAS) in the upload's manifest. Size and content
+    type come from the blob's properties; the file itself is not read here.
+    Query params:
+      - uploadId
+      - filename
+      - sha256 (optional, hex digest computed by the page; stored as clientSha256)
     """
-    upload_id = _new_upload_id()
-    return func.HttpResponse(json.dumps({"uploadId": upload_id}), mimetype="application/json")
+    upload_id = (req.params.get("uploadId") or "").strip()
+    filename = (req.params.get("filename") or "").strip() or "receipt"
+    if not upload_id.startswith("up_"):
+        return func.HttpResponse(json.dumps({"error": "uploadId is required"}), status_code=400, mimetype="application/json")
+    blob_name = _upload_blob_name(upload_id, filename)
+    if _is_upload_manifest(blob_name):
+        return func.HttpResponse(json.dumps({"error": "reserved filename"}), status_code=400, mimetype="application/json")
+    try:
+        container = _receipts_container()
+        props = container.get_blob_client(blob_name).get_blob_properties()
+        content_type = (props.content_settings.content_type or "").strip()
+        if not content_type or content_type == "application/octet-stream":
+            content_type = mimetypes.guess_type(blob_name)[0] or "application/octet-stream"
+        sha256 = (req.params.get("sha256") or "").strip().lower()
+        entry = {
+            "filename": blob_name.rsplit("/", 1)[-1],
+            "blob": blob_name,
+            "contentType": content_type,
+            "size": props.size,
+            # Reported by the page and not verified here; "sha256" is only ever server-computed.
+            "clientSha256": sha256 if _SHA256_HEX.match(sha256) else None,
+            "status": "complete",
+            "uploadedAt": datetime.now(timezone.utc).isoformat(),
+        }
+        # The thumbnail is made on first request to receipt-thumbnail, so no download here either.
+        entry = _record_upload_manifest(container, upload_id, [entry])[0]
+        return func.HttpResponse(json.dumps({"ok": True, "uploadId": upload_id, "file": entry}), mimetype="application/json")
+    except ResourceNotFoundError:
+        return func.HttpResponse(json.dumps({"error": "file has not been uploaded"}), status_code=404, mimetype="application/json")
+    except Exception as e:
+        return func.HttpResponse(json.dumps({"error": f"manifest update failed: {e}"}), status_code=500, mimetype="application/json")
 
 
 @app.route(route="receipt-upload-file", methods=["PUT"], auth_level=func.AuthLevel.ANONYMOUS)
@@ -2068,26 +4094,93 @@ def receipt_upload_file(req: func.HttpRequest) -> func.HttpResponse:
         else:
             content_type = "application/octet-stream"
 
+    blob_name = _upload_blob_name(upload_id, filename)
+    if _is_upload_manifest(blob_name):
+        return func.HttpResponse(json.dumps({"error": "reserved filename"}), status_code=400, mimetype="application/json")
     try:
-        bsc = _blob_service_client()
-        container = bsc.get_container_client(_receipt_container_name())
+        container = _receipts_container(ensure=True)
         try:
-            container.create_container()
-        except Exception:
-            pass
-
-        blob_name = _upload_prefix(upload_id) + filename.replace("\\", "/").split("/")[-1]
-        container.upload_blob(
-            name=blob_name,
-            data=data,
-            overwrite=True,
-            content_settings=ContentSettings(content_type=content_type),
-        )
+            container.upload_blob(
+                name=blob_name,
+                data=data,
+                overwrite=True,
+                content_settings=ContentSettings(content_type=content_type),
+            )
+        except ResourceNotFoundError:
+            # Container deleted since we last checked; recreate once and retry.
+            _forget_receipts_container()
+            container = _receipts_container(ensure=True)
+            container.upload_blob(
+                name=blob_name,
+                data=data,
+                overwrite=True,
+                content_settings=ContentSettings(content_type=content_type),
+            )
+        entry = _manifest_entry(blob_name, data, content_type)
+        thumbnail = _store_thumbnail(container, blob_name, data)
+        if thumbnail:
+            entry["thumbnail"] = thumbnail
+        _record_upload_manifest(container, upload_id, [entry])
         return func.HttpResponse(json.dumps({"ok": True, "uploadId": upload_id, "blob": blob_name}), mimetype="application/json")
     except Exception as e:
         return func.HttpResponse(json.dumps({"error": f"upload failed: {e}"}), status_code=500, mimetype="application/json")
 
 
+@app.route(route="receipt-thumbnail", methods=["GET"], auth_level=func.AuthLevel.FUNCTION)
+def receipt_thumbnail(req: func.HttpRequest) -> func.HttpResponse:
+    """
+    Small preview image of one uploaded receipt (for reviewing the cart without the original file).
+    Query params:
+      - uploadId
+      - filename (as stored, e.g. the "filename" of a manifest entry)
+    Thumbnails are made at upload time; older uploads get theirs on first request.
+    """
+    upload_id = (req.params.get("uploadId") or "").strip()
+    filename = (req.params.get("filename") or "").strip()
+    if not upload_id.startswith("up_") or not filename:
+        return func.HttpResponse(json.dumps({"error": "uploadId and filename are required"}), status_code=400, mimetype="application/json")
+    blob_name = _upload_blob_name(upload_id, filename)
+    if _is_upload_manifest(blob_name):
+        return func.HttpResponse(json.dumps({"error": "not a receipt"}), status_code=404, mimetype="application/json")
+    # Receipt images: private (no shared caches), cached by the client for a bounded time
+    # (RECEIPT_THUMBNAIL_MAX_AGE seconds, default 1 day) since a re-upload of the same filename
+    # keeps the URL; after that the ETag makes revalidation a cheap 304.
+    max_age = max(0, _env_int("RECEIPT_THUMBNAIL_MAX_AGE", 86400))
+    headers = {"Cache-Control": f"private, max-age={max_age}"}
+    if_none_match = (req.headers.get("If-None-Match") or "").strip()
+    try:
+        container = _receipts_container()
+        try:
+            if if_none_match:
+                downloader = container.download_blob(
+                    _thumbnail_blob_name(blob_name), etag=if_none_match, match_condition=MatchConditions.IfModified
+                )
+            else:
+                downloader = container.download_blob(_thumbnail_blob_name(blob_name))
+        except ResourceNotFoundError:
+            if not _store_thumbnail(container, blob_name, container.download_blob(blob_name).readall()):
+                return func.HttpResponse(json.dumps({"error": "no preview for this file type"}), status_code=404, mimetype="application/json")
+            downloader = container.download_blob(_thumbnail_blob_name(blob_name))
+        except HttpResponseError as e:
+            # The storage layer may surface the 304 as ResourceNotModifiedError or ResourceModifiedError.
+            if e.status_code != 304:
+                raise
+            return func.HttpResponse(status_code=304, headers=dict(headers, ETag=if_none_match))
+    except ResourceNotFoundError:
+        return func.HttpResponse(json.dumps({"error": "receipt not found"}), status_code=404, mimetype="application/json")
+    except Exception as e:
+        return func.HttpResponse(json.dumps({"error": f"thumbnail failed: {e}"}), status_code=500, mimetype="application/json")
+
+    etag = str(downloader.properties.etag or "")
+    if etag:
+        headers["ETag"] = etag
+    return func.HttpResponse(
+        downloader.readall(),
+        mimetype=downloader.properties.content_settings.content_type or "image/jpeg",
+        headers=headers,
+    )
+
+
 @app.route(route="receipt-upload", methods=["GET"], auth_level=func.AuthLevel.ANONYMOUS)
 def receipt_upload_page(req: func.HttpRequest) -> func.HttpResponse:
     """
@@ -2107,6 +4200,9 @@ def receipt_upload_page(req: func.HttpRequest) -> func.HttpResponse:
       .muted { color: #666; }
       .ok { color: #0a7; }
       .err { color: #b00; }
+      #progress { list-style: none; padding: 0; }
+      #progress li { display: flex; gap: 8px; align-items: center; margin: 4px 0; }
+      #progress progress { flex: 0 0 160px; }
     </style>
   </head>
   <body>
@@ -2118,6 +4214,7 @@ def receipt_upload_page(req: func.HttpRequest) -> func.HttpResponse:
         <p><strong>Upload ID:</strong> <code id="uploadId"></code></p>
         <p><input id="files" type="file" multiple /></p>
         <p><button id="upload">Upload files</button></p>
+        <ul id="progress"></ul>
         <pre id="log" class="muted" style="white-space:pre-wrap"></pre>
         <p id="done" class="ok" style="display:none">Done. Paste the upload id into chat: <code id="uploadId2"></code></p>
       </div>
@@ -2143,17 +4240,216 @@ def receipt_upload_page(req: func.HttpRequest) -> func.HttpResponse:
         statusEl.textContent = '';
       });
 
+      // Large photos are downscaled in the browser before upload (longest edge / JPEG quality
+      // come from RECEIPT_UPLOAD_MAX_EDGE / RECEIPT_UPLOAD_JPEG_QUALITY); several files upload at once.
+      const MAX_EDGE = __MAX_EDGE__;
+      const JPEG_QUALITY = __JPEG_QUALITY__;
+      const FILE_PARALLEL = __FILE_PARALLEL__;
+      const RESIZE_MIN_BYTES = 1024 * 1024;
+
+      // Direct-to-storage uploads: the file is staged in blocks (parallel, retried) and committed
+      // with a block list. Blocks staged by an interrupted attempt are skipped on the next one.
+      const BLOCK_SIZE = 4 * 1024 * 1024;
+      const BLOCK_PARALLEL = 4;
+
+      // Block ids carry a digest of the chunk, so a different file uploaded under the same name
+      // never reuses another file's staged blocks. All ids of a blob must have the same length.
+      async function blockId(i, chunk, file) {
+        let tag;
+        if (window.crypto && crypto.subtle) {
+          const digest = new Uint8Array(await crypto.subtle.digest('SHA-256', await chunk.arrayBuffer()));
+          tag = Array.from(digest.slice(0, 12), b => b.toString(16).padStart(2, '0')).join('');
+        } else {
+          tag = (file.size.toString(36) + 'x' + file.lastModified.toString(36) + 'x' + chunk.size.toString(36)).padEnd(24, '0').slice(0, 24);
+        }
+        return btoa(String(i).padStart(6, '0') + '-' + tag);
+      }
+
+      async function withRetry(fn, attempts) {
+        let last;
+        for (let a = 0; a < attempts; a++) {
+          try { return await fn(); } catch (e) { last = e; await new Promise(r => setTimeout(r, 500 * Math.pow(2, a))); }
+        }
+        throw last;
+      }
+
+      // XHR (unlike fetch) reports upload progress.
+      function xhrPut(url, body, headers, onProgress) {
+        return new Promise((resolve, reject) => {
+          const xhr = new XMLHttpRequest();
+          xhr.open('PUT', url);
+          for (const [k, v] of Object.entries(headers || {})) xhr.setRequestHeader(k, v);
+          xhr.upload.onprogress = (e) => { if (e.lengthComputable && onProgress) onProgress(e.loaded); };
+          xhr.onload = () => (xhr.status >= 200 && xhr.status < 300)
+            ? resolve(xhr.responseText)
+            : reject(new Error('HTTP ' + xhr.status + ' ' + (xhr.responseText || '').slice(0, 200)));
+          xhr.onerror = () => reject(new Error('network error'));
+          xhr.send(body);
+        });
+      }
+
+      async function downscale(file) {
+        if (!/^image\/(jpeg|png|webp)$/.test(file.type) || typeof createImageBitmap !== 'function') return file;
+        let bmp;
+        try { bmp = await createImageBitmap(file, { imageOrientation: 'from-image' }); } catch (e) { return file; }
+        const scale = Math.min(1, MAX_EDGE / Math.max(bmp.width, bmp.height));
+        if (scale === 1 && file.size < RESIZE_MIN_BYTES) { bmp.close(); return file; }
+        const canvas = document.createElement('canvas');
+        canvas.width = Math.round(bmp.width * scale);
+        canvas.height = Math.round(bmp.height * scale);
+        const ctx = canvas.getContext('2d');
+        ctx.fillStyle = '#fff';  // PNG transparency -> white paper
+        ctx.fillRect(0, 0, canvas.width, canvas.height);
+        ctx.drawImage(bmp, 0, 0, canvas.width, canvas.height);
+        bmp.close();
+        const blob = await new Promise(r => canvas.toBlob(r, 'image/jpeg', JPEG_QUALITY));
+        if (!blob || blob.size >= file.size) return file;
+        // Keep the original extension (a.png -> a.png.jpg) so a.png and a.jpg stay distinct blobs.
+        const name = /\.jpe?g$/i.test(file.name) ? file.name : file.name + '.jpg';
+        return new File([blob], name, { type: 'image/jpeg' });
+      }
+
+      async function stagedBlocks(file) {
+        // The SAS is write-only, so the staged block list comes from the function.
+        try {
+          const r = await fetch('./receipt-upload-blocks?uploadId=' + encodeURIComponent(uploadId) + '&filename=' + encodeURIComponent(file.name));
+          if (!r.ok) return new Map();
+          // id -> size; a block is only skipped when both match the chunk being sent.
+          return new Map(((await r.json()).blocks || []).map(b => [b.id, b.size]));
+        } catch (e) {
+          return new Map();
+        }
+      }
+
+      async function uploadViaSas(file, url, onProgress) {
+        const count = Math.max(1, Math.ceil(file.size / BLOCK_SIZE));
+        const ids = new Array(count);
+        const staged = await stagedBlocks(file);
+        const sent = new Array(count).fill(0);
+        const report = () => onProgress(sent.reduce((a, b) => a + b, 0) / Math.max(1, file.size));
+        let next = 0;
+        async function worker() {
+          while (next < count) {
+            const i = next++;
+            const chunk = file.slice(i * BLOCK_SIZE, Math.min(file.size, (i + 1) * BLOCK_SIZE));
+            ids[i] = await blockId(i, chunk, file);
+            if (staged.get(ids[i]) !== chunk.size) {
+              await withRetry(() => xhrPut(
+                url + '&comp=block&blockid=' + encodeURIComponent(ids[i]), chunk, {},
+                (loaded) => { sent[i] = loaded; report(); }
+              ), 4);
+            }
+            sent[i] = chunk.size; report();
+          }
+        }
+        await Promise.all(Array.from({ length: Math.min(BLOCK_PARALLEL, count) }, worker));
+        const blockList = '<?xml version="1.0" encoding="utf-8"?><BlockList>' + ids.map(id => '<Latest>' + id + '</Latest>').join('') + '</BlockList>';
+        await withRetry(() => xhrPut(url + '&comp=blocklist', blockList, {
+          'Content-Type': 'application/xml',
+          'x-ms-blob-content-type': file.type || 'application/octet-stream',
+        }), 4);
+        // Adds the file to the upload manifest (the function never saw the bytes go by, so the
+        // page supplies the SHA-256).
+        let sha = '';
+        if (window.crypto && crypto.subtle) {
+          const digest = new Uint8Array(await crypto.subtle.digest('SHA-256', await file.arrayBuffer()));
+          sha = Array.from(digest, b => b.toString(16).padStart(2, '0')).join('');
+        }
+        await withRetry(async () => {
+          const r = await fetch('./receipt-upload-complete?uploadId=' + encodeURIComponent(uploadId) + '&filename=' + encodeURIComponent(file.name) + '&sha256=' + sha, { method: 'POST' });
+          if (!r.ok) throw new Error('HTTP ' + r.status + ' ' + (await r.text()).slice(0, 200));
+        }, 3);
+      }
+
+      async function uploadViaFunction(file, onProgress) {
+        const url = './receipt-upload-file?uploadId=' + encodeURIComponent(uploadId) + '&filename=' + encodeURIComponent(file.name);
+        const text = await withRetry(() => xhrPut(
+          url, file, { 'Content-Type': file.type || 'application/octet-stream' },
+          (loaded) => onProgress(loaded / Math.max(1, file.size))
+        ), 3);
+        const j = JSON.parse(text || '{}');
+        if (!j.ok) throw new Error(JSON.stringify(j));
+      }
+
+      async function sasTargets(files) {
+        // Empty when direct uploads are disabled; the page then uploads through the function.
+        try {
+          const r = await fetch('./receipt-upload-init', {
+            method: 'POST',
+            headers: { 'Content-Type': 'application/json' },
+            body: JSON.stringify({ uploadId, files: files.map(f => f.name) }),
+          });
+          const j = await r.json();
+          const out = {};
+          for (const u of (j.uploads || [])) out[u.filename] = u.url;
+          return out;
+        } catch (e) {
+          return {};
+        }
+      }
+
+      function progressRow(name) {
+        const li = document.createElement('li');
+        const bar = document.createElement('progress');
+        bar.max = 1; bar.value = 0;
+        const label = document.createElement('span');
+        label.textContent = name;
+        const state = document.createElement('span');
+        state.className = 'muted';
+        li.append(bar, label, state);
+        document.getElementById('progress').append(li);
+        return {
+          progress: (v) => { bar.value = v; },
+          state: (text, cls) => { state.textContent = text; state.className = cls || 'muted'; },
+        };
+      }
+
+      const uploadedKeys = new Set();
+      function fileKey(f) { return f.name + ':' + f.size + ':' + f.lastModified; }
+
+      async function runPool(items, limit, fn) {
+        let next = 0;
+        async function worker() { while (next < items.length) { const i = next++; await fn(items[i], i); } }
+        await Promise.all(Array.from({ length: Math.min(limit, items.length) }, worker));
+      }
+
       document.getElementById('upload').addEventListener('click', async () => {
         const input = document.getElementById('files');
         if (!uploadId) { alert('Click Start upload first'); return; }
         if (!input.files || input.files.length === 0) { alert('Choose files'); return; }
-        log('Uploading ' + input.files.length + ' file(s)...');
-        for (const f of input.files) {
-          log('Uploading: ' + f.name);
-          const url = './receipt-upload-file?uploadId=' + encodeURIComponent(uploadId) + '&filename=' + encodeURIComponent(f.name);
-          const r = await fetch(url, { method: 'PUT', headers: { 'Content-Type': f.type || 'application/octet-stream' }, body: f });
-          const j = await r.json();
-          if (!r.ok || !j.ok) { log('ERROR: ' + JSON.stringify(j)); statusEl.textContent='Upload failed'; statusEl.className='err'; return; }
+        // On a retry click, files that already made it are not sent again.
+        const originals = Array.from(input.files).filter(f => f.size > 0 && !uploadedKeys.has(fileKey(f)));
+        if (originals.length === 0) { statusEl.textContent = 'All files already uploaded'; return; }
+        const rows = originals.map(f => progressRow(f.name));
+        statusEl.textContent = 'Preparing ' + originals.length + ' file(s)...';
+        statusEl.className = 'muted';
+        const files = [];
+        await runPool(originals, FILE_PARALLEL, async (f, i) => {
+          rows[i].state('resizing...');
+          files[i] = await downscale(f);
+          rows[i].state(files[i] === f ? '' : Math.round(f.size / 1024) + ' KB -> ' + Math.round(files[i].size / 1024) + ' KB');
+        });
+        const targets = await sasTargets(files);
+        statusEl.textContent = 'Uploading...';
+        let failed = 0;
+        await runPool(files, FILE_PARALLEL, async (f, i) => {
+          const note = rows[i];
+          try {
+            if (targets[f.name]) await uploadViaSas(f, targets[f.name], note.progress);
+            else await uploadViaFunction(f, note.progress);
+            note.progress(1);
+            note.state('uploaded', 'ok');
+            uploadedKeys.add(fileKey(originals[i]));
+          } catch (e) {
+            failed++;
+            note.state('failed', 'err');
+            log('ERROR: ' + f.name + ': ' + e.message);
+          }
+        });
+        if (failed) {
+          statusEl.textContent = failed + ' file(s) failed; click Upload files to retry';
+          statusEl.className = 'err';
+          return;
         }
         document.getElementById('done').style.display = '';
         statusEl.textContent = 'Upload complete';
@@ -2162,6 +4458,12 @@ def receipt_upload_page(req: func.HttpRequest) -> func.HttpResponse:
     </script>
   </body>
 </html>"""
+    quality = _env_int("RECEIPT_UPLOAD_JPEG_QUALITY", 85)
+    html = (
+        html.replace("__MAX_EDGE__", str(max(256, _env_int("RECEIPT_UPLOAD_MAX_EDGE", _RECEIPT_MAX_EDGE))))
+        .replace("__JPEG_QUALITY__", f"{min(100, max(30, quality)) / 100:.2f}")
+        .replace("__FILE_PARALLEL__", str(max(1, _env_int("RECEIPT_UPLOAD_PARALLEL", 3))))
+    )
     return func.HttpResponse(html, mimetype="text/html")
 
 
@@ -2177,6 +4479,259 @@ def _get_document_intelligence_client():
     return DocumentIntelligenceClient(endpoint=endpoint, credential=credential)
 
 
+def _di_field_val(field):
+    """Extract the value from a DocumentField, handling SDK version differences."""
+    if field is None:
+        return None
+    # Newer SDK: type-specific properties
+    for attr in ("value_string", "value_number", "value_integer", "value_date",
+                  "value_currency", "value_array", "value_object", "content", "value"):
+        v = getattr(field, attr, None)
+        if v is not None:
+            # value_currency is an object with .amount
+            if attr == "value_currency" and hasattr(v, "amount"):
+                return v.amount
+            return v
+    return None
+
+
+_RECEIPT_MODEL_ID = "prebuilt-receipt"
+_ANALYSIS_CACHE_VERSION = 1
+_ANALYSIS_CACHE_PREFIX = "analysis-cache/"
+_ANALYSIS_CACHE: dict[str, dict] = {}
+_ANALYSIS_CACHE_LOCK = threading.Lock()
+
+
+def _analysis_cache_key(image_bytes: bytes, model_id: str) -> str:
+    return f"{model_id}/{hashlib.sha256(image_bytes).hexdigest()}-v{_ANALYSIS_CACHE_VERSION}"
+
+
+def _analysis_cache_get(key: str, container) -> Optional[dict]:
+    with _ANALYSIS_CACHE_LOCK:
+        hit = _ANALYSIS_CACHE.pop(key, None)
+        if hit is not None:
+            _ANALYSIS_CACHE[key] = hit  # most recently used goes last
+            return dict(hit)
+    if container is None:
+        return None
+    try:
+        hit = json.loads(container.download_blob(f"{_ANALYSIS_CACHE_PREFIX}{key}.json").readall())
+    except Exception:
+        return None
+    if not isinstance(hit, dict) or not hit.get("ok"):
+        return None
+    _analysis_cache_put(key, hit, None)
+    return dict(hit)
+
+
+def _analysis_cache_put(key: str, result: dict, container) -> None:
+    """Local tier is an LRU of RECEIPT_ANALYSIS_CACHE_ENTRIES results (default 512; 0 disables)."""
+    limit = _env_int("RECEIPT_ANALYSIS_CACHE_ENTRIES", 512)
+    if limit > 0:
+        with _ANALYSIS_CACHE_LOCK:
+            _ANALYSIS_CACHE.pop(key, None)
+            while len(_ANALYSIS_CACHE) >= limit:
+                _ANALYSIS_CACHE.pop(next(iter(_ANALYSIS_CACHE)))
+            _ANALYSIS_CACHE[key] = dict(result)
+    if container is not None:
+        try:
+            container.upload_blob(
+                name=f"{_ANALYSIS_CACHE_PREFIX}{key}.json",
+                data=json.dumps(result).encode("utf-8"),
+                overwrite=True,
+                content_settings=ContentSettings(content_type="application/json"),
+            )
+        except Exception as e:
+            logging.warning("Receipt analysis cache: blob write failed for %s: %s", key, e)
+
+
+_DOCINTEL_MAX_BYTES = 4 * 1024 * 1024  # Document Intelligence request limit (F0 tier; S0 allows more)
+
+
+def _reduce_for_analysis(image_bytes: bytes) -> bytes:
+    """
+    Downscales a JPEG/PNG receipt to what Document Intelligence needs: longest edge at most
+    DOCINTEL_MAX_EDGE (default 3000 px, short edge kept >= 1000 px) and under the 4 MB request
+    limit. The target size is estimated once from the source's bytes per pixel, JPEGs are decoded
+    at reduced scale with draft(), and there is one resize + encode, plus at most one correction
+    pass if the estimate was off. Anything else (PDFs, small images) is returned unchanged.
+    """
+    if _sniff_file_type(image_bytes)[1] not in {"image/png", "image/jpeg"}:
+        return image_bytes
+    try:
+        img = Image.open(BytesIO(image_bytes))
+        src_w, src_h = img.size
+        max_edge = max(500, _env_int("DOCINTEL_MAX_EDGE", 3000))
+        # Long, narrow till receipts keep a readable width (>= 1000 px) even past max_edge.
+        scale = min(1.0, max(max_edge / max(src_w, src_h), 1000 / min(src_w, src_h)))
+        budget = _DOCINTEL_MAX_BYTES * 0.9  # headroom for the estimate
+        if len(image_bytes) > budget:
+            # JPEG output at q85 runs close to a JPEG source's density; PNG sources are denser than
+            # the JPEG they become, so cap their estimate at a typical photo density.
+            bpp = len(image_bytes) / float(src_w * src_h)
+            if img.format == "PNG":
+                bpp = min(bpp, 0.5)
+            scale = min(scale, (budget / (bpp * src_w * src_h)) ** 0.5)
+        if scale >= 1.0 and len(image_bytes) <= _DOCINTEL_MAX_BYTES:
+            return image_bytes
+        scale = min(scale, 1.0)  # over the limit at full size: re-encode, then correct once
+
+        target = (max(1, round(src_w * scale)), max(1, round(src_h * scale)))
+        img.draft("RGB", target)  # JPEG: DCT-domain downscale to >= target
+        img = ImageOps.exif_transpose(img)
+        if img.mode != "RGB":
+            img = img.convert("RGB")
+        if (src_w > src_h) != (img.width > img.height):
+            target = (target[1], target[0])  # EXIF rotation swapped the axes
+        img = img.resize(target, Image.LANCZOS, reducing_gap=2.0)
+        buf = BytesIO()
+        img.save(buf, format="JPEG", quality=85)
+        if buf.tell() > _DOCINTEL_MAX_BYTES:
+            fix = (budget / buf.tell()) ** 0.5
+            img = img.resize((max(1, int(img.width * fix)), max(1, int(img.height * fix))), Image.LANCZOS)
+            buf = BytesIO()
+            img.save(buf, format="JPEG", quality=85)
+            if buf.tell() > _DOCINTEL_MAX_BYTES:
+                logging.warning("receipt analysis could not resize image under 4MB")
+        if buf.tell() >= len(image_bytes) and len(image_bytes) <= _DOCINTEL_MAX_BYTES:
+            return image_bytes
+        logging.info(
+            "receipt analysis resized image from %d to %d bytes (%dx%d -> %dx%d)",
+            len(image_bytes), buf.tell(), src_w, src_h, img.width, img.height,
+        )
+        return buf.getvalue()
+    except Exception as e:
+        logging.warning("receipt analysis image resize failed: %s", e)
+        return image_bytes
+
+
+def _analyze_receipt_bytes(image_bytes: bytes) -> dict:
+    """
+    Runs the prebuilt-receipt model on image/PDF bytes and returns the receipt-analyze response
+    body ({"ok": True, "merchant", "date", "total", ...}). Raises on analysis failures.
+    Results are cached by SHA-256 of the bytes actually sent plus the model id (local LRU, then
+    analysis-cache/ in Blob Storage unless RECEIPT_ANALYSIS_CACHE_BLOB is false); a cache hit
+    skips Document Intelligence and carries "cached": true.
+    """
+    image_bytes = _reduce_for_analysis(image_bytes)
+
+    cache_key = _analysis_cache_key(image_bytes, _RECEIPT_MODEL_ID)
+    cache_container = _blob_cache_container("RECEIPT_ANALYSIS_CACHE_BLOB", "Receipt analysis cache")
+    cached = _analysis_cache_get(cache_key, cache_container)
+    if cached is not None:
+        cached["cached"] = True
+        return cached
+
+    # Analyze with Document Intelligence
+    client = _get_document_intelligence_client()
+
+    # Use prebuilt-receipt model
+    poller = client.begin_analyze_document(
+        _RECEIPT_MODEL_ID,
+        AnalyzeDocumentRequest(bytes_source=image_bytes),
+    )
+    result = poller.result()
+
+    # Extract receipt data
+    receipt_data = {
+        "ok": True,
+        "merchant": "",
+        "date": "",
+        "total": 0.0,
+        "subtotal": 0.0,
+        "tax": 0.0,
+        "items": [],
+        "category": "other",
+        "rawText": "",
+    }
+
+    if result.documents:
+        doc = result.documents[0]
+        fields = doc.fields or {}
+
+        # Merchant name
+        if "MerchantName" in fields:
+            val = _di_field_val(fields["MerchantName"])
+            if val:
+                receipt_data["merchant"] = str(val)
+
+        # Transaction date
+        if "TransactionDate" in fields:
+            val = _di_field_val(fields["TransactionDate"])
+            if val:
+                if hasattr(val, "strftime"):
+                    receipt_data["date"] = val.strftime("%m/%d/%Y")
+                else:
+                    receipt_data["date"] = str(val)
+
+        # Total
+        if "Total" in fields:
+            val = _di_field_val(fields["Total"])
+            if val is not None:
+                receipt_data["total"] = float(val)
+
+        # Subtotal
+        if "Subtotal" in fields:
+            val = _di_field_val(fields["Subtotal"])
+            if val is not None:
+                receipt_data["subtotal"] = float(val)
+
+        # Tax
+        if "TotalTax" in fields:
+            val = _di_field_val(fields["TotalTax"])
+            if val is not None:
+                receipt_data["tax"] = float(val)
+
+        # Line items
+        if "Items" in fields:
+            items_val = _di_field_val(fields["Items"])
+            if items_val:
+                for item in items_val:
+                    item_fields = _di_field_val(item) if not isinstance(item, dict) else item
+                    if not item_fields:
+                        item_fields = getattr(item, "value_object", None) or {}
+                    line_item = {
+                        "description": "",
+                        "amount": 0.0,
+                        "quantity": 0.0,
+                    }
+                    if "Description" in item_fields:
+                        desc = _di_field_val(item_fields["Description"]) if not isinstance(item_fields["Description"], str) else item_fields["Description"]
+                        if desc:
+                            line_item["description"] = str(desc)
+                    if "TotalPrice" in item_fields:
+                        price = _di_field_val(item_fields["TotalPrice"]) if not isinstance(item_fields["TotalPrice"], (int, float)) else item_fields["TotalPrice"]
+                        if price is not None:
+                            line_item["amount"] = float(price)
+                    if "Quantity" in item_fields:
+                        qty = _di_field_val(item_fields["Quantity"]) if not isinstance(item_fields["Quantity"], (int, float)) else item_fields["Quantity"]
+                        if qty is not None:
+                            line_item["quantity"] = float(qty)
+                    receipt_data["items"].append(line_item)
+
+        # Suggest category based on merchant name
+        merchant_lower = receipt_data["merchant"].lower()
+        if any(kw in merchant_lower for kw in ["hotel", "marriott", "hilton", "hyatt", "inn", "suites", "lodge"]):
+            receipt_data["category"] = "hotel"
+        elif any(kw in merchant_lower for kw in ["airline", "delta", "united", "american", "southwest", "flight"]):
+            receipt_data["category"] = "airfare"
+        elif any(kw in merchant_lower for kw in ["uber", "lyft", "taxi", "cab"]):
+            receipt_data["category"] = "transportation"
+        elif any(kw in merchant_lower for kw in ["parking", "garage"]):
+            receipt_data["category"] = "parking"
+        elif any(kw in merchant_lower for kw in ["restaurant", "cafe", "coffee", "starbucks", "mcdonald", "wendy", "subway", "chipotle", "diner", "grill", "kitchen", "bistro"]):
+            receipt_data["category"] = "meal"
+        elif any(kw in merchant_lower for kw in ["gas", "fuel", "shell", "chevron", "exxon", "bp", "conoco", "phillips"]):
+            receipt_data["category"] = "fuel"
+
+    # Include raw text for debugging/fallback
+    if result.content:
+        receipt_data["rawText"] = result.content[:1000]  # Limit to first 1000 chars
+
+    _analysis_cache_put(cache_key, receipt_data, cache_container)
+    return receipt_data
+
+
 @app.route(route="receipt-analyze", methods=["POST"], auth_level=func.AuthLevel.FUNCTION)
 def receipt_analyze(req: func.HttpRequest) -> func.HttpResponse:
     """
@@ -2185,6 +4740,7 @@ def receipt_analyze(req: func.HttpRequest) -> func.HttpResponse:
     Accepts either:
     - JSON body with base64 encoded image: {"imageBase64": "..."}
     - JSON body with blob reference: {"uploadId": "...", "filename": "..."}
+    - multipart/form-data with the image as a file part (plus an optional application/json part or plain fields)
 
     Returns extracted receipt data:
     - merchant: Merchant/vendor name
@@ -2195,16 +4751,28 @@ def receipt_analyze(req: func.HttpRequest) -> func.HttpResponse:
     - items: Array of line items with description and amount
     - category: Suggested category based on merchant
     """
-    try:
-        body = req.get_json() if req.get_body() else {}
-    except Exception:
-        body = {}
-
     image_bytes = None
+    if _is_multipart(req):
+        # multipart/form-data: optional JSON/fields plus the receipt as a binary file part.
+        try:
+            body, files = _parse_multipart_request(req)
+        except ValueError as e:
+            return func.HttpResponse(
+                json.dumps({"ok": False, "error": f"Invalid multipart body: {e}"}),
+                status_code=400,
+                mimetype="application/json"
+            )
+        if files:
+            image_bytes = files[0]["content"] or None
+    else:
+        try:
+            body = req.get_json() if req.get_body() else {}
+        except Exception:
+            body = {}
 
     # Option 1: Base64 encoded image in request
     image_base64 = body.get("imageBase64", "").strip()
-    if image_base64:
+    if not image_bytes and image_base64:
         try:
             # Remove data URL prefix if present
             if "," in image_base64:
@@ -2222,21 +4790,25 @@ def receipt_analyze(req: func.HttpRequest) -> func.HttpResponse:
     filename = body.get("filename", "").strip()
     if not image_bytes and upload_id:
         try:
-            bsc = _blob_service_client()
-            container = bsc.get_container_client(_receipt_container_name())
+            container = _receipts_container()
 
+            blob_client = None
             # If filename provided, fetch that specific file
             if filename:
                 blob_name = _upload_prefix(upload_id) + filename
                 blob_client = container.get_blob_client(blob_name)
-                image_bytes = blob_client.download_blob().readall()
             else:
                 # Fetch the first file in the upload
-                prefix = _upload_prefix(upload_id)
-                blobs = list(container.list_blobs(name_starts_with=prefix))
-                if blobs:
-                    blob_client = container.get_blob_client(blobs[0].name)
-                    image_bytes = blob_client.download_blob().readall()
+                entries = _upload_entries(container, upload_id)
+                if entries:
+                    blob_client = container.get_blob_client(entries[0]["blob"])
+            if blob_client is not None:
+                # Analysis already done at upload time (receipt_preprocess) for this exact blob version.
+                stored = _stored_receipt_analysis(container, blob_client) if _receipt_preprocess_enabled() else None
+                if stored is not None:
+                    stored["uploadId"] = upload_id
+                    return func.HttpResponse(json.dumps(stored), mimetype="application/json")
+                image_bytes = blob_client.download_blob().readall()
         except Exception as e:
             return func.HttpResponse(
                 json.dumps({"ok": False, "error": f"Failed to fetch from blob storage: {e}"}),
@@ -2249,7 +4821,7 @@ def receipt_analyze(req: func.HttpRequest) -> func.HttpResponse:
     if not image_bytes and image_url:
         try:
             logging.info("receipt-analyze fetching from URL: %s", image_url[:100])
-            resp = requests.get(image_url, timeout=30)
+            resp = _http_request("GET", image_url, timeout_s=30)
             if resp.status_code == 200:
                 image_bytes = resp.content
             else:
@@ -2272,189 +4844,239 @@ def receipt_analyze(req: func.HttpRequest) -> func.HttpResponse:
             mimetype="application/json"
         )
 
-    # Resize large images to fit Document Intelligence limit (4 MB)
-    MAX_IMAGE_BYTES = 4 * 1024 * 1024
-    if len(image_bytes) > MAX_IMAGE_BYTES:
-        try:
-            img = Image.open(BytesIO(image_bytes))
-            orig_fmt = (img.format or "").upper()
-            orig_size = len(image_bytes)
-            # Convert to RGB (drop alpha) so JPEG save always works
-            if img.mode in ("RGBA", "LA", "P"):
-                img = img.convert("RGB")
-            # Progressively scale down until under limit
-            scale = 0.85
-            for _ in range(20):
-                new_w = int(img.width * scale)
-                new_h = int(img.height * scale)
-                if new_w < 100 or new_h < 100:
-                    break
-                resized = img.resize((new_w, new_h), Image.LANCZOS)
-                buf = BytesIO()
-                resized.save(buf, format="JPEG", quality=85)
-                if buf.tell() <= MAX_IMAGE_BYTES:
-                    image_bytes = buf.getvalue()
-                    logging.info("receipt-analyze resized image from %d to %d bytes (%dx%d)",
-                                 orig_size, len(image_bytes), new_w, new_h)
-                    break
-                scale *= 0.75
-                img = resized
-            else:
-                logging.warning("receipt-analyze could not resize image under 4MB")
-        except Exception as e:
-            logging.warning("receipt-analyze image resize failed: %s", e)
+    try:
+        receipt_data = _analyze_receipt_bytes(image_bytes)
+    except Exception as e:
+        logging.exception("Receipt analysis failed")
+        return func.HttpResponse(
+            json.dumps({"ok": False, "error": f"Analysis failed: {e}"}),
+            status_code=500,
+            mimetype="application/json"
+        )
 
-    # Helper to extract value from DocumentField (SDK v1.0+ removed .value)
-    def _field_val(field):
-        """Extract the value from a DocumentField, handling SDK version differences."""
-        if field is None:
-            return None
-        # Newer SDK: type-specific properties
-        for attr in ("value_string", "value_number", "value_integer", "value_date",
-                      "value_currency", "value_array", "value_object", "content", "value"):
-            v = getattr(field, attr, None)
-            if v is not None:
-                # value_currency is an object with .amount
-                if attr == "value_currency" and hasattr(v, "amount"):
-                    return v.amount
-                return v
+    # Echo back uploadId so it can be used for receipt bundling on submit
+    if upload_id:
+        receipt_data["uploadId"] = upload_id
+
+    return func.HttpResponse(
+        json.dumps(receipt_data),
+        mimetype="application/json"
+    )
+
+
+_PROCESSED_PREFIX = "processed/"
+
+
+def _receipt_preprocess_enabled() -> bool:
+    return (os.getenv("RECEIPT_PREPROCESS_ENABLED") or "").strip().lower() in {"1", "true", "yes", "y"}
+
+
+def _processed_record_name(upload_blob_name: str) -> str:
+    """uploads/{uploadId}/{name} -> processed/{uploadId}/{name}.json"""
+    rel = upload_blob_name.split("/", 1)[1] if upload_blob_name.startswith("uploads/") else upload_blob_name
+    return f"{_PROCESSED_PREFIX}{rel}.json"
+
+
+def _stored_receipt_analysis(container, blob_client) -> Optional[dict]:
+    """
+    Returns the receipt-analyze body stored by receipt_preprocess for this upload blob, or None
+    when there is no record, no analysis, or the upload was overwritten after it was processed.
+    """
+    try:
+        record = json.loads(container.download_blob(_processed_record_name(blob_client.blob_name)).readall())
+    except Exception:
+        return None
+    analysis = record.get("analysis") if isinstance(record, dict) else None
+    if not isinstance(analysis, dict):
+        return None
+    try:
+        etag = blob_client.get_blob_properties().etag
+    except Exception:
         return None
+    if not etag or etag != record.get("sourceEtag"):
+        return None
+    return dict(analysis, preprocessed=True)
 
-    # Analyze with Document Intelligence
+
+def _preprocess_receipt(container, blob_name: str, data: bytes) -> dict:
+    """
+    Upload-time work for one receipt in uploads/: content hash, size, the normalized PDF page
+    (stored in the converted-page cache, so submit only merges ready pages), page count and the
+    Document Intelligence analysis. Writes processed/{uploadId}/{name}.json and returns it.
+    """
+    _ext, ctype = _sniff_file_type(data)
     try:
-        client = _get_document_intelligence_client()
+        etag = container.get_blob_client(blob_name).get_blob_properties().etag
+    except Exception:
+        etag = None
+    record: dict = {
+        "blob": blob_name,
+        "sourceEtag": etag,
+        "sha256": hashlib.sha256(data).hexdigest(),
+        "size": len(data),
+        "contentType": ctype or "application/octet-stream",
+        "processedAt": datetime.now(timezone.utc).isoformat(),
+    }
+
+    if ctype == "application/pdf":
+        try:
+            record["pages"] = len(PdfReader(BytesIO(data)).pages)
+        except Exception as e:
+            record["pageError"] = f"unreadable PDF: {e}"
+    elif ctype in {"image/png", "image/jpeg"}:
+        compact = _receipt_compaction_enabled({})
+        if not compact and _is_passthrough_jpeg(data, _RECEIPT_MAX_EDGE):
+            # Embedded as-is at submit; nothing worth caching.
+            record["pages"] = 1
+        else:
+            key = _page_cache_key(data, _RECEIPT_MAX_EDGE, None, compact)
+            pdf_b = _page_cache_get(key, container)
+            if pdf_b is None:
+                pdf_b, err = _bytes_to_pdf(data, compact=compact)
+                if err:
+                    record["pageError"] = err
+                    pdf_b = None
+                else:
+                    _page_cache_put(key, pdf_b, container)
+            if pdf_b:
+                record.update(pages=1, pageBlob=f"{_PAGE_CACHE_PREFIX}{key}.pdf", pageBytes=len(pdf_b))
+    else:
+        record["pageError"] = "unsupported receipt type (only PDF/JPG/PNG supported)"
+
+    if ctype and (os.getenv("DOCUMENT_INTELLIGENCE_ENDPOINT") or "").strip():
+        try:
+            record["analysis"] = _analyze_receipt_bytes(data)
+        except Exception as e:
+            record["analysisError"] = str(e)
+
+    container.upload_blob(
+        name=_processed_record_name(blob_name),
+        data=json.dumps(record).encode("utf-8"),
+        overwrite=True,
+        content_settings=ContentSettings(content_type="application/json"),
+    )
+    return record
+
 
-        # Use prebuilt-receipt model
-        poller = client.begin_analyze_document(
-            "prebuilt-receipt",
-            AnalyzeDocumentRequest(bytes_source=image_bytes),
+# Upload-time preprocessing is opt-in (RECEIPT_PREPROCESS_ENABLED=true). The trigger connection is
+# an app setting name (RECEIPT_PREPROCESS_CONNECTION, default AzureWebJobsStorage) pointing at the
+# receipts storage account; derived artifacts go outside uploads/ so they don't re-trigger.
+if _receipt_preprocess_enabled():
+
+    @app.blob_trigger(
+        arg_name="blob",
+        path=f"{_receipt_container_name()}/uploads/{{uploadId}}/{{name}}",
+        connection=(os.getenv("RECEIPT_PREPROCESS_CONNECTION") or "AzureWebJobsStorage").strip(),
+    )
+    def receipt_preprocess(blob: func.InputStream) -> None:
+        # blob.name is "<container>/uploads/<uploadId>/<name>"
+        blob_name = (blob.name or "").split("/", 1)[-1]
+        if _is_upload_manifest(blob_name):
+            return
+        data = blob.read()
+        if not data:
+            return
+        container = _receipts_container()
+        record = _preprocess_receipt(container, blob_name, data)
+        logging.info(
+            "receipt-preprocess: blob=%s bytes=%s pages=%s analyzed=%s",
+            blob_name,
+            record.get("size"),
+            record.get("pages"),
+            "analysis" in record,
         )
-        result = poller.result()
-
-        # Extract receipt data
-        receipt_data = {
-            "ok": True,
-            "merchant": "",
-            "date": "",
-            "total": 0.0,
-            "subtotal": 0.0,
-            "tax": 0.0,
-            "items": [],
-            "category": "other",
-            "rawText": "",
-        }
 
-        if result.documents:
-            doc = result.documents[0]
-            fields = doc.fields or {}
-
-            # Merchant name
-            if "MerchantName" in fields:
-                val = _field_val(fields["MerchantName"])
-                if val:
-                    receipt_data["merchant"] = str(val)
-
-            # Transaction date
-            if "TransactionDate" in fields:
-                val = _field_val(fields["TransactionDate"])
-                if val:
-                    if hasattr(val, "strftime"):
-                        receipt_data["date"] = val.strftime("%m/%d/%Y")
-                    else:
-                        receipt_data["date"] = str(val)
-
-            # Total
-            if "Total" in fields:
-                val = _field_val(fields["Total"])
-                if val is not None:
-                    receipt_data["total"] = float(val)
-
-            # Subtotal
-            if "Subtotal" in fields:
-                val = _field_val(fields["Subtotal"])
-                if val is not None:
-                    receipt_data["subtotal"] = float(val)
-
-            # Tax
-            if "TotalTax" in fields:
-                val = _field_val(fields["TotalTax"])
-                if val is not None:
-                    receipt_data["tax"] = float(val)
-
-            # Line items
-            if "Items" in fields:
-                items_val = _field_val(fields["Items"])
-                if items_val:
-                    for item in items_val:
-                        item_fields = _field_val(item) if not isinstance(item, dict) else item
-                        if not item_fields:
-                            item_fields = getattr(item, "value_object", None) or {}
-                        line_item = {
-                            "description": "",
-                            "amount": 0.0,
-                            "quantity": 0.0,
-                        }
-                        if "Description" in item_fields:
-                            desc = _field_val(item_fields["Description"]) if not isinstance(item_fields["Description"], str) else item_fields["Description"]
-                            if desc:
-                                line_item["description"] = str(desc)
-                        if "TotalPrice" in item_fields:
-                            price = _field_val(item_fields["TotalPrice"]) if not isinstance(item_fields["TotalPrice"], (int, float)) else item_fields["TotalPrice"]
-                            if price is not None:
-                                line_item["amount"] = float(price)
-                        if "Quantity" in item_fields:
-                            qty = _field_val(item_fields["Quantity"]) if not isinstance(item_fields["Quantity"], (int, float)) else item_fields["Quantity"]
-                            if qty is not None:
-                                line_item["quantity"] = float(qty)
-                        receipt_data["items"].append(line_item)
-
-            # Suggest category based on merchant name
-            merchant_lower = receipt_data["merchant"].lower()
-            if any(kw in merchant_lower for kw in ["hotel", "marriott", "hilton", "hyatt", "inn", "suites", "lodge"]):
-                receipt_data["category"] = "hotel"
-            elif any(kw in merchant_lower for kw in ["airline", "delta", "united", "american", "southwest", "flight"]):
-                receipt_data["category"] = "airfare"
-            elif any(kw in merchant_lower for kw in ["uber", "lyft", "taxi", "cab"]):
-                receipt_data["category"] = "transportation"
-            elif any(kw in merchant_lower for kw in ["parking", "garage"]):
-                receipt_data["category"] = "parking"
-            elif any(kw in merchant_lower for kw in ["restaurant", "cafe", "coffee", "starbucks", "mcdonald", "wendy", "subway", "chipotle", "diner", "grill", "kitchen", "bistro"]):
-                receipt_data["category"] = "meal"
-            elif any(kw in merchant_lower for kw in ["gas", "fuel", "shell", "chevron", "exxon", "bp", "conoco", "phillips"]):
-                receipt_data["category"] = "fuel"
-
-        # Include raw text for debugging/fallback
-        if result.content:
-            receipt_data["rawText"] = result.content[:1000]  # Limit to first 1000 chars
-
-        # Echo back uploadId so it can be used for receipt bundling on submit
-        if upload_id:
-            receipt_data["uploadId"] = upload_id
 
-        return func.HttpResponse(
-            json.dumps(receipt_data),
-            mimetype="application/json"
+def _receipt_upload_sweep_enabled() -> bool:
+    return (os.getenv("RECEIPT_UPLOAD_SWEEP_ENABLED") or "").strip().lower() in {"1", "true", "yes", "y"}
+
+
+def _sweep_abandoned_uploads(container, max_age: timedelta) -> dict:
+    """
+    Purges upload ids whose newest blob (file, manifest, record or thumbnail) is older than
+    max_age. Returns the _purge_uploads report plus "scanned" (upload ids seen).
+    """
+    newest: dict[str, datetime] = {}
+    for prefix in ("uploads/", _PROCESSED_PREFIX, _THUMBNAIL_PREFIX):
+        for b in container.list_blobs(name_starts_with=prefix):
+            parts = str(b.name or "").split("/")
+            if len(parts) < 3 or not parts[1]:
+                continue
+            ts = b.last_modified
+            if ts is not None and (parts[1] not in newest or ts > newest[parts[1]]):
+                newest[parts[1]] = ts
+    cutoff = datetime.now(timezone.utc) - max_age
+    stale = sorted(uid for uid, ts in newest.items() if ts < cutoff)
+    report = _purge_uploads(container, stale) if stale else {"uploadIds": [], "blobs": 0, "bytes": 0, "errors": []}
+    report["scanned"] = len(newest)
+    return report
+
+
+def _sweep_blob_caches(container, max_age: timedelta) -> dict:
+    """
+    Deletes converted-page (converted/) and analysis (analysis-cache/) cache blobs last written
+    more than max_age ago. These are content-addressed and shared across uploads, so upload purges
+    leave them alone; a swept entry is simply recomputed on its next miss.
+    Returns {"blobs", "bytes", "errors"}.
+    """
+    cutoff = datetime.now(timezone.utc) - max_age
+    stale: dict[str, int] = {}
+    for prefix in (_PAGE_CACHE_PREFIX, _ANALYSIS_CACHE_PREFIX):
+        for b in container.list_blobs(name_starts_with=prefix):
+            if b.last_modified is not None and b.last_modified < cutoff:
+                stale[str(b.name)] = int(b.size or 0)
+    deleted, errors = _delete_blobs_batched(container, list(stale))
+    return {"blobs": len(deleted), "bytes": sum(stale[name] for name in deleted), "errors": errors}
+
+
+# Abandoned-upload sweeper is opt-in (RECEIPT_UPLOAD_SWEEP_ENABLED=true). Runs on
+# RECEIPT_UPLOAD_SWEEP_SCHEDULE (NCRONTAB, default daily 03:00 UTC) and removes uploads untouched for
+# RECEIPT_UPLOAD_MAX_AGE_HOURS (default 72), plus page/analysis cache blobs older than
+# RECEIPT_CACHE_MAX_AGE_DAYS (default 30).
+if _receipt_upload_sweep_enabled():
+
+    @app.timer_trigger(
+        arg_name="timer",
+        schedule=(os.getenv("RECEIPT_UPLOAD_SWEEP_SCHEDULE") or "0 0 3 * * *").strip(),
+        run_on_startup=False,
+    )
+    def receipt_upload_sweep(timer: func.TimerRequest) -> None:
+        max_age = timedelta(hours=max(1, _env_int("RECEIPT_UPLOAD_MAX_AGE_HOURS", 72)))
+        report = _sweep_abandoned_uploads(_receipts_container(), max_age)
+        logging.info(
+            "receipt-upload-sweep: scanned=%s purged=%s blobs=%s bytes=%s errors=%s",
+            report["scanned"],
+            len(report["uploadIds"]),
+            report["blobs"],
+            report["bytes"],
+            len(report["errors"]),
         )
+        for err in report["errors"][:20]:
+            logging.warning("receipt-upload-sweep: %s", err)
 
-    except Exception as e:
-        logging.exception("Receipt analysis failed")
-        return func.HttpResponse(
-            json.dumps({"ok": False, "error": f"Analysis failed: {e}"}),
-            status_code=500,
-            mimetype="application/json"
+        cache_age = timedelta(days=max(1, _env_int("RECEIPT_CACHE_MAX_AGE_DAYS", 30)))
+        caches = _sweep_blob_caches(_receipts_container(), cache_age)
+        logging.info(
+            "receipt-upload-sweep: cache blobs=%s bytes=%s errors=%s",
+            caches["blobs"],
+            caches["bytes"],
+            len(caches["errors"]),
         )
+        for err in caches["errors"][:20]:
+            logging.warning("receipt-upload-sweep: %s", err)
 
 
 def _foundry_get_json(project_endpoint: str, path: str) -> dict:
     base = (project_endpoint or "").rstrip("/")
     url = f"{base}{path}"
-    resp = requests.get(
+    resp = _http_request(
+        "GET",
         url,
         headers={
             "Authorization": f"Bearer {_foundry_get_access_token()}",
             "Accept": "application/json",
         },
-        timeout=30,
+        timeout_s=30,
     )
     if resp.status_code not in (200, 202):
         raise RuntimeError(f"Foundry GET failed: url={url} status={resp.status_code} {(resp.text or '')[:500]}")
@@ -2464,13 +5086,14 @@ def _foundry_get_json(project_endpoint: str, path: str) -> dict:
 def _foundry_get_bytes(project_endpoint: str, path: str) -> bytes:
     base = (project_endpoint or "").rstrip("/")
     url = f"{base}{path}"
-    resp = requests.get(
+    resp = _http_request(
+        "GET",
         url,
         headers={
             "Authorization": f"Bearer {_foundry_get_access_token()}",
             "Accept": "application/octet-stream",
         },
-        timeout=60,
+        timeout_s=60,
     )
     if resp.status_code not in (200, 202):
         raise RuntimeError(f"Foundry GET (bytes) failed: url={url} status={resp.status_code} {(resp.text or '')[:500]}")
@@ -2616,7 +5239,9 @@ def _iter_foundry_thread_file_ids_fallback(messages_json: dict) -> list[dict]:
     return uniq
 
 
-def _build_receipts_zip_from_foundry(payload: dict) -> tuple[list[dict], int, bool, Optional[str]]:
+def _build_receipts_zip_from_foundry(
+    payload: dict, *, report: Optional[dict] = None
+) -> tuple[list[dict], int, bool, Optional[str]]:
     """
     Fetches receipt files from Foundry and returns a single bundle attachment (Graph-compatible).
 
@@ -2655,55 +5280,35 @@ def _build_receipts_zip_from_foundry(payload: dict) -> tuple[list[dict], int, bo
                 raise RuntimeError(f"Failed to download file {file_id}: {last_bytes_err}")
             downloaded.append(content)
 
+        kept, removed, similar = _find_duplicate_receipts(downloaded, [f"foundryFileIds[{i}]" for i in range(len(downloaded))], payload)
+        _record_duplicates(report, removed, similar)
+        downloaded = [downloaded[i] for i in kept]
+
         if bundle_format == "pdf":
-            pdfs: list[bytes] = []
-            # Prepend summary table page
-            summary_pdf = _build_summary_table_pdf(payload)
-            if summary_pdf:
-                pdfs.append(summary_pdf)
-            for i, b in enumerate(downloaded):
-                pdf_b, err = _bytes_to_pdf(b)
-                if err:
-                    return [], 0, False, f"foundryFileIds[{i}] {err}"
-                pdfs.append(pdf_b)
-            merged = _merge_pdf_bytes(pdfs)
+            merged, err = _build_receipts_pdf(
+                downloaded, [f"foundryFileIds[{i}]" for i in kept], payload, report=report
+            )
+            if err:
+                return [], 0, False, err
             pdf_name = (payload.get("receiptPdfName") or "receipts.pdf").strip() or "receipts.pdf"
             if not pdf_name.lower().endswith(".pdf"):
                 pdf_name = f"{pdf_name}.pdf"
             return (
-                [
-                    {
-                        "@odata.type": "#microsoft.graph.fileAttachment",
-                        "name": pdf_name,
-                        "contentType": "application/pdf",
-                        "contentBytes": base64.b64encode(merged).decode("ascii"),
-                    }
-                ],
-                len(merged),
+                [_file_attachment(pdf_name, "application/pdf", merged)],
+                _blob_len(merged),
                 True,
                 None,
             )
 
         zip_name = (payload.get("receiptZipName") or "receipts.zip").strip() or "receipts.zip"
-        zip_buf = BytesIO()
-        with zipfile.ZipFile(zip_buf, "w", compression=zipfile.ZIP_DEFLATED) as zf:
-            for i, content in enumerate(downloaded):
-                sniff_ext, _sniff_type = _sniff_file_type(content)
-                name = f"receipt-{i+1}"
-                if sniff_ext:
-                    name = f"{name}.{sniff_ext}"
-                zf.writestr(name, content)
-        zip_bytes = zip_buf.getvalue()
+        names = []
+        for i, content in zip(kept, downloaded):
+            sniff_ext, _sniff_type = _sniff_file_type(content)
+            names.append(f"receipt-{i+1}.{sniff_ext}" if sniff_ext else f"receipt-{i+1}")
+        zip_file = _write_receipts_zip(zip(names, downloaded), report=report)
         return (
-            [
-                {
-                    "@odata.type": "#microsoft.graph.fileAttachment",
-                    "name": zip_name,
-                    "contentType": "application/zip",
-                    "contentBytes": base64.b64encode(zip_bytes).decode("ascii"),
-                }
-            ],
-            len(zip_bytes),
+            [_file_attachment(zip_name, "application/zip", zip_file)],
+            _blob_len(zip_file),
             True,
             None,
         )
@@ -2754,7 +5359,7 @@ def _build_receipts_zip_from_foundry(payload: dict) -> tuple[list[dict], int, bo
                 logging.info("Foundry receipts via filename hints; hints=%s fileIds=%s", filename_hints, file_ids2)
                 payload2 = dict(payload)
                 payload2["foundryFileIds"] = file_ids2
-                return _build_receipts_zip_from_foundry(payload2)
+                return _build_receipts_zip_from_foundry(payload2, report=report)
         except Exception as e:
             logging.warning("Foundry filename-hints fallback failed: %s", e)
 
@@ -2846,61 +5451,44 @@ def _build_receipts_zip_from_foundry(payload: dict) -> tuple[list[dict], int, bo
         filenames.append(filename)
         downloaded.append(content)
 
+    kept, removed, similar = _find_duplicate_receipts(downloaded, filenames, payload)
+    _record_duplicates(report, removed, similar)
+    filenames = [filenames[i] for i in kept]
+    downloaded = [downloaded[i] for i in kept]
+
     if bundle_format == "pdf":
-        pdfs: list[bytes] = []
-        # Prepend summary table page
-        summary_pdf = _build_summary_table_pdf(payload)
-        if summary_pdf:
-            pdfs.append(summary_pdf)
-        for i, b in enumerate(downloaded):
-            pdf_b, err = _bytes_to_pdf(b)
-            if err:
-                return [], 0, False, f"thread attachment '{filenames[i]}' {err}"
-            pdfs.append(pdf_b)
-        merged = _merge_pdf_bytes(pdfs)
+        merged, err = _build_receipts_pdf(
+            downloaded, [f"thread attachment '{fn}'" for fn in filenames], payload, report=report
+        )
+        if err:
+            return [], 0, False, err
         pdf_name = (payload.get("receiptPdfName") or "receipts.pdf").strip() or "receipts.pdf"
         if not pdf_name.lower().endswith(".pdf"):
             pdf_name = f"{pdf_name}.pdf"
         return (
-            [
-                {
-                    "@odata.type": "#microsoft.graph.fileAttachment",
-                    "name": pdf_name,
-                    "contentType": "application/pdf",
-                    "contentBytes": base64.b64encode(merged).decode("ascii"),
-                }
-            ],
-            len(merged),
+            [_file_attachment(pdf_name, "application/pdf", merged)],
+            _blob_len(merged),
             True,
             None,
         )
 
     zip_name = (payload.get("receiptZipName") or "receipts.zip").strip() or "receipts.zip"
-    zip_buf = BytesIO()
-    with zipfile.ZipFile(zip_buf, "w", compression=zipfile.ZIP_DEFLATED) as zf:
-        for filename, content in zip(filenames, downloaded):
-            zf.writestr(filename, content)
-
-    zip_bytes = zip_buf.getvalue()
-    if len(zip_bytes) == 0:
+    zip_file = _write_receipts_zip(zip(filenames, downloaded), report=report)
+    zip_size = _blob_len(zip_file)
+    if zip_size == 0:
         return [], 0, False, "Generated receipts.zip was empty"
 
     return (
-        [
-            {
-                "@odata.type": "#microsoft.graph.fileAttachment",
-                "name": zip_name,
-                "contentType": "application/zip",
-                "contentBytes": base64.b64encode(zip_bytes).decode("ascii"),
-            }
-        ],
-        len(zip_bytes),
+        [_file_attachment(zip_name, "application/zip", zip_file)],
+        zip_size,
         True,
         None,
     )
 
 
-def _build_receipt_attachments(payload: dict) -> tuple[list[dict], int, bool, Optional[str]]:
+def _build_receipt_attachments(
+    payload: dict, *, report: Optional[dict] = None
+) -> tuple[list[dict], int, bool, Optional[str]]:
     """
     Returns (attachments, total_raw_bytes, bundled, error).
 
@@ -2957,86 +5545,86 @@ def _build_receipt_attachments(payload: dict) -> tuple[list[dict], int, bool, Op
         total_bytes += len(data)
         decoded.append((name, content_type, data))
 
+    kept, removed, similar = _find_duplicate_receipts([d[2] for d in decoded], [d[0] for d in decoded], payload)
+    _record_duplicates(report, removed, similar)
+    if removed:
+        decoded = [decoded[i] for i in kept]
+        total_bytes = sum(len(d[2]) for d in decoded)
+
     if bundle_format == "pdf":
-        pdfs: list[bytes] = []
-        # Prepend summary table page
-        summary_pdf = _build_summary_table_pdf(payload)
-        if summary_pdf:
-            pdfs.append(summary_pdf)
-        for i, (name, _content_type, data) in enumerate(decoded):
-            pdf_b, err = _bytes_to_pdf(data)
-            if err:
-                return [], 0, False, f"attachments[{i}] '{name}' {err}"
-            pdfs.append(pdf_b)
-        merged = _merge_pdf_bytes(pdfs)
+        merged, err = _build_receipts_pdf(
+            [data for _name, _content_type, data in decoded],
+            [f"attachments[{i}] '{name}'" for i, (name, _content_type, _data) in zip(kept, decoded)],
+            payload,
+            report=report,
+        )
+        if err:
+            return [], 0, False, err
         return (
-            [
-                {
-                    "@odata.type": "#microsoft.graph.fileAttachment",
-                    "name": pdf_name,
-                    "contentType": "application/pdf",
-                    "contentBytes": base64.b64encode(merged).decode("ascii"),
-                }
-            ],
-            len(merged),
+            [_file_attachment(pdf_name, "application/pdf", merged)],
+            _blob_len(merged),
             True,
             None,
         )
 
     if len(decoded) >= 2 and bool(payload.get("zipReceipts", True)):
-        mem = BytesIO()
-        with zipfile.ZipFile(mem, mode="w", compression=zipfile.ZIP_DEFLATED) as zf:
-            for name, _, data in decoded:
-                zf.writestr(name, data)
-        zip_bytes = mem.getvalue()
+        zip_file = _write_receipts_zip(((name, data) for name, _, data in decoded), report=report)
         return (
-            [
-                {
-                    "@odata.type": "#microsoft.graph.fileAttachment",
-                    "name": zip_name,
-                    "contentType": "application/zip",
-                    "contentBytes": base64.b64encode(zip_bytes).decode("ascii"),
-                }
-            ],
-            len(zip_bytes),
+            [_file_attachment(zip_name, "application/zip", zip_file)],
+            _blob_len(zip_file),
             True,
             None,
         )
 
     graph_attachments = []
     for name, content_type, data in decoded:
-        graph_attachments.append(
-            {
-                "@odata.type": "#microsoft.graph.fileAttachment",
-                "name": name,
-                "contentType": content_type,
-                "contentBytes": base64.b64encode(data).decode("ascii"),
-            }
-        )
+        graph_attachments.append(_file_attachment(name, content_type, data))
     return graph_attachments, total_bytes, False, None
 
 
 @app.route(route="submit-report", methods=["POST"], auth_level=func.AuthLevel.FUNCTION)
 def submit_report(req: func.HttpRequest) -> func.HttpResponse:
     payload: dict = {}
-    try:
-        parsed = req.get_json()
-        if isinstance(parsed, dict):
-            payload = parsed
-        else:
-            # Allow callers to send the draft items as a bare JSON array.
-            payload = {"draftItemsJson": json.dumps(parsed)}
-    except Exception:
-        # Copilot Studio "tools" sometimes struggle to send a typed JSON object body.
-        # Accept a raw string body as draftItemsJson and read the remaining fields from query params.
+    if _is_multipart(req):
+        # multipart/form-data: application/json part (or plain fields) + receipt files as binary parts.
+        # Files join payload.attachments as raw bytes, skipping the base64 round-trip.
+        try:
+            payload, files = _parse_multipart_request(req)
+        except ValueError as e:
+            return func.HttpResponse(
+                json.dumps({"ok": False, "error": f"Invalid multipart body: {e}"}),
+                status_code=400,
+                mimetype="application/json",
+            )
+        if files:
+            existing = payload.get("attachments") if isinstance(payload.get("attachments"), list) else []
+            payload["attachments"] = existing + [
+                {
+                    "name": f["filename"] or f["name"],
+                    "contentType": f["contentType"] or "application/octet-stream",
+                    "contentBytes": f["content"],
+                }
+                for f in files
+            ]
+    else:
         try:
-            raw_body = (req.get_body() or b"").decode("utf-8", errors="ignore").strip()
+            parsed = req.get_json()
+            if isinstance(parsed, dict):
+                payload = parsed
+            else:
+                # Allow callers to send the draft items as a bare JSON array.
+                payload = {"draftItemsJson": json.dumps(parsed)}
         except Exception:
-            raw_body = ""
-        if raw_body:
-            payload = {"draftItemsJson": raw_body}
-        else:
-            payload = {}
+            # Copilot Studio "tools" sometimes struggle to send a typed JSON object body.
+            # Accept a raw string body as draftItemsJson and read the remaining fields from query params.
+            try:
+                raw_body = (req.get_body() or b"").decode("utf-8", errors="ignore").strip()
+            except Exception:
+                raw_body = ""
+            if raw_body:
+                payload = {"draftItemsJson": raw_body}
+            else:
+                payload = {}
 
     # Merge any query-string overrides (useful for custom connector tools).
     try:
@@ -3072,7 +5660,7 @@ def submit_report(req: func.HttpRequest) -> func.HttpResponse:
             if v and (k not in payload or payload.get(k) in {None, ""}):
                 payload[k] = v
 
-        for k in ["sendEmail", "ccRequester", "purgeSharepointReceipts", "allowMissingReceipts"]:
+        for k in ["sendEmail", "ccRequester", "purgeSharepointReceipts", "purgeUploadedReceipts", "allowMissingReceipts"]:
             vb = _q_bool(k)
             if vb is not None and (k not in payload or payload.get(k) is None):
                 payload[k] = vb
@@ -3228,8 +5816,13 @@ def submit_report(req: func.HttpRequest) -> func.HttpResponse:
                     if auth_upload_id and auth_upload_id not in item_upload_ids:
                         item_upload_ids.append(auth_upload_id)
 
+    # Per-request receipt bundle stats (merge sizes/memory), returned as receiptBundle.
+    bundle_report: dict = {}
+    upload_purge: Optional[dict] = None
     if payload.get("attachments") is not None:
-        attachments, attachment_bytes, attachments_zipped, att_error = _build_receipt_attachments(payload)
+        attachments, attachment_bytes, attachments_zipped, att_error = _build_receipt_attachments(
+            payload, report=bundle_report
+        )
         if att_error:
             mail_error = att_error
 
@@ -3237,6 +5830,10 @@ def submit_report(req: func.HttpRequest) -> func.HttpResponse:
     sharepoint_drive_id = _coalesce(payload.get("sharepointDriveId"), payload.get("sharePointDriveId"), payload.get("spDriveId"))
     sharepoint_item_ids = _parse_sharepoint_item_ids(payload)
     sharepoint_urls = _parse_sharepoint_urls(payload)
+    # Share URL -> driveItem resolutions from the download, reused by the purge below.
+    sharepoint_resolved: dict = {}
+    # SharePoint downloads are spooled temp files; closed with the attachments after the send.
+    sp_bytes: list = []
     if (has_receipts or fetch_from_thread) and not mail_error and len(attachments) == 0 and (
         (sharepoint_drive_id and len(sharepoint_item_ids) > 0) or len(sharepoint_urls) > 0
     ):
@@ -3246,12 +5843,14 @@ def submit_report(req: func.HttpRequest) -> func.HttpResponse:
             len(sharepoint_item_ids),
             len(sharepoint_urls),
         )
-        sp_bytes, sp_names, sp_err = _download_receipts_from_sharepoint(payload)
+        sp_bytes, sp_names, sp_err = _download_receipts_from_sharepoint(payload, resolve_cache=sharepoint_resolved)
         if sp_err:
             logging.warning("submit-report receipt-bundle (sharepoint) failed: %s", sp_err)
             mail_error = sp_err
         else:
-            sp_atts, sp_count, sp_bundled, bundle_err = _bundle_blobs_as_attachment(blobs=sp_bytes, filenames=sp_names, payload=payload)
+            sp_atts, sp_count, sp_bundled, bundle_err = _bundle_blobs_as_attachment(
+                blobs=sp_bytes, filenames=sp_names, payload=payload, report=bundle_report
+            )
             if bundle_err:
                 logging.warning("submit-report receipt-bundle (sharepoint) failed: %s", bundle_err)
                 mail_error = bundle_err
@@ -3266,14 +5865,27 @@ def submit_report(req: func.HttpRequest) -> func.HttpResponse:
     all_upload_ids = item_upload_ids.copy()
     if receipt_upload_id and receipt_upload_id not in all_upload_ids:
         all_upload_ids.insert(0, receipt_upload_id)
+    # Upload ids whose files ended up in the bundle; only these may be purged after the send.
+    consumed_upload_ids: list[str] = []
 
     if (has_receipts or fetch_from_thread) and not mail_error and len(attachments) == 0 and len(all_upload_ids) > 0:
         logging.info("submit-report receipt-bundle: source=blob uploadIds=%s", all_upload_ids)
         all_blob_bytes: list[bytes] = []
         all_blob_names: list[str] = []
         blob_err = None
-        for uid in all_upload_ids:
-            uid_bytes, uid_names, uid_err = _download_receipts_from_blob(uid)
+        # Upload ids download concurrently and split RECEIPT_BLOB_DOWNLOAD_CONCURRENCY between
+        # them, so the total number of blob connections stays within it. Results are consumed in
+        # upload id order.
+        budget = max(1, _env_int("RECEIPT_BLOB_DOWNLOAD_CONCURRENCY", 4))
+        workers = max(1, min(len(all_upload_ids), budget))
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            per_upload = list(
+                pool.map(
+                    lambda uid: _download_receipts_from_blob(uid, concurrency=max(1, budget // workers)),
+                    all_upload_ids,
+                )
+            )
+        for uid, (uid_bytes, uid_names, uid_err) in zip(all_upload_ids, per_upload):
             if uid_err:
                 logging.warning("submit-report receipt-bundle (blob) uploadId=%s failed: %s", uid, uid_err)
                 # Continue to try other uploadIds, but track the error
@@ -3294,6 +5906,7 @@ def submit_report(req: func.HttpRequest) -> func.HttpResponse:
                 blobs=all_blob_bytes,
                 filenames=all_blob_names,
                 payload=payload,
+                report=bundle_report,
             )
             if bundle_err:
                 logging.warning("submit-report receipt-bundle (blob) failed: %s", bundle_err)
@@ -3302,6 +5915,7 @@ def submit_report(req: func.HttpRequest) -> func.HttpResponse:
                 attachments = blob_atts
                 attachment_bytes = blob_count
                 attachments_zipped = blob_bundled
+                consumed_upload_ids = [uid for uid, res in zip(all_upload_ids, per_upload) if not res[2]]
 
     # If we have receipt items but no usable attachments were provided, fetch original files from Foundry
     # and build a single receipts bundle (default: receipts.pdf) server-side.
@@ -3321,7 +5935,9 @@ def submit_report(req: func.HttpRequest) -> func.HttpResponse:
             fetch_from_thread,
             (conv_for_fetch or "").strip(),
         )
-        foundry_attachments, foundry_bytes, foundry_zipped, foundry_err = _build_receipts_zip_from_foundry(payload)
+        foundry_attachments, foundry_bytes, foundry_zipped, foundry_err = _build_receipts_zip_from_foundry(
+            payload, report=bundle_report
+        )
         if foundry_err:
             # Hard stop: we don't want "sent=true" emails without receipts.pdf when receipts exist.
             logging.warning("submit-report receipt-bundle failed: %s", foundry_err)
@@ -3351,9 +5967,10 @@ def submit_report(req: func.HttpRequest) -> func.HttpResponse:
     elif requested_send_email and missing_gl_count > 0:
         mail_error = f"Missing GL Account on {missing_gl_count} line(s)."
     elif send_email:
-        # Graph sendMail simple attachments are limited to ~3 MB raw (4 MB base64).
-        # Images are resized in _bytes_to_pdf so combined PDF is typically well under this.
-        max_raw = int(os.getenv("GRAPH_MAX_ATTACHMENT_BYTES") or "7000000")
+        # Bundles over ~3 MB are streamed to Graph via upload sessions (see _graph_send_mail_via_draft),
+        # so the only hard limit is Graph's 150 MB per attachment. Tenants with a lower Exchange
+        # message size limit can lower GRAPH_MAX_ATTACHMENT_BYTES to fail fast.
+        max_raw = _env_int("GRAPH_MAX_ATTACHMENT_BYTES", _GRAPH_UPLOAD_SESSION_MAX_BYTES)
         if attachment_bytes > max_raw:
             mail_error = f"Attachments too large ({attachment_bytes} bytes). Reduce size or set GRAPH_MAX_ATTACHMENT_BYTES higher."
 
@@ -3376,12 +5993,22 @@ def submit_report(req: func.HttpRequest) -> func.HttpResponse:
             )
             # Best-effort purge of temp SharePoint receipts after successful send.
             if mail_error is None and bool(_payload_bool("purgeSharepointReceipts", False)):
-                purge_err = _purge_sharepoint_items(payload)
+                purge_err = _purge_sharepoint_items(payload, resolve_cache=sharepoint_resolved)
                 if purge_err:
                     logging.warning(purge_err)
+            # Best-effort purge of the consumed uploads/{id}/ prefixes (and their upload-time records).
+            if mail_error is None and consumed_upload_ids and bool(_payload_bool("purgeUploadedReceipts", False)):
+                try:
+                    upload_purge = _purge_uploads(_receipts_container(), consumed_upload_ids)
+                except Exception as e:
+                    upload_purge = {"uploadIds": consumed_upload_ids, "blobs": 0, "bytes": 0, "errors": [str(e)]}
+                if upload_purge["errors"]:
+                    logging.warning("Failed to purge uploaded receipts: %s", "; ".join(upload_purge["errors"]))
 
     if requested_send_email and mail_error:
         logging.warning("submit-report not sent: %s", mail_error)
+    _close_blobs(sp_bytes)
+    _close_blobs(att.get("_content") for att in attachments)
 
     return func.HttpResponse(
         json.dumps(
@@ -3395,6 +6022,8 @@ def submit_report(req: func.HttpRequest) -> func.HttpResponse:
                 "emailError": mail_error,
                 "attachmentCount": len(attachments),
                 "attachmentsZipped": attachments_zipped,
+                "receiptBundle": bundle_report or None,
+                "uploadPurge": upload_purge,
                 "hasReceiptItems": has_receipts,
                 "fetchReceiptsFromThread": fetch_from_thread,
                 "allowMissingReceipts": allow_missing_receipts,